@@ -0,0 +1,134 @@
+from collections import deque
+import threading as th
+import time
+
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer
+
+# default frame rate cap (frames per second)
+DEFAULT_MAX_FPS = 30.0
+# number of frame times kept for the statistics
+FRAME_HISTORY = 1000
+
+
+class FrameScheduler(QObject):
+    """
+    Decouples the rendering from the acquisition rate: the acquisition side calls notify() (from any thread) when new
+    data is available, a QTimer calls 'render()' in the GUI thread at most 'max_fps' times per second, and only if
+    something was notified since the last frame. All the blocks received in between are rendered in one frame.
+
+    A frame is counted as skipped when data was waiting but the GUI thread missed the period (the previous frame, or
+    anything else running in the GUI thread, took too long): a period without new data is not a skipped frame. The
+    timer only runs between start() and stop(), e.g. while the acquisition runs.
+    """
+    def __init__(self, render, *, max_fps: float = DEFAULT_MAX_FPS, parent=None):
+        super(FrameScheduler, self).__init__(parent)
+
+        self.render = render
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._on_tick)
+        self.max_fps = max_fps
+
+        self._lock = th.Lock()
+        self._pending = 0
+        # when the first block not rendered yet was notified
+        self._pending_since = 0.0
+        self._reset_stats()
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def notify(self, nblocks: int = 1):
+        """
+        Signals new data (thread safe, does not wait for the GUI thread).
+        """
+        with self._lock:
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending += nblocks
+
+    def start(self):
+        """
+        Starts the timer (and resets the statistics). What was notified while stopped is dropped.
+        """
+        with self._lock:
+            self._pending = 0
+        self._reset_stats()
+        self._timer.start()
+
+    def stop(self):
+        """
+        Stops the timer, what was notified since the last frame is rendered first.
+        """
+        self._timer.stop()
+        self._t_stop = time.monotonic()
+        with self._lock:
+            pending, self._pending = self._pending, 0
+        if pending:
+            self._render(pending)
+
+    @property
+    def is_running(self):
+        return self._timer.isActive()
+
+    @property
+    def max_fps(self):
+        return self._max_fps
+
+    @max_fps.setter
+    def max_fps(self, value: float):
+        if value <= 0:
+            raise ValueError(f"Frame rate must be positive, got {value}")
+        self._max_fps = value
+        self._timer.setInterval(max(int(round(1e3 / value)), 1))
+
+    @property
+    def stats(self):
+        frame_times = np.array(self._frame_times)
+        elapsed = (self._t_stop if self._t_stop is not None else time.monotonic()) - self._t_start
+        return {
+            'frames_rendered': self.frames_rendered,
+            'frames_skipped': self.frames_skipped,
+            'fps': self.frames_rendered / elapsed if elapsed > 0 else 0.0,
+            'blocks_rendered': self.blocks_rendered,
+            'max_blocks_per_frame': self.max_blocks_per_frame,
+            'frame_time_p50_ms': 1e3 * float(np.median(frame_times)) if len(frame_times) else None,
+            'frame_time_p99_ms': 1e3 * float(np.percentile(frame_times, 99)) if len(frame_times) else None,
+            'frame_time_max_ms': 1e3 * self._max_frame_time,
+        }
+
+    #############
+    # INTERNALS #
+    #############
+    def _reset_stats(self):
+        self.frames_rendered = 0
+        self.frames_skipped = 0
+        self.blocks_rendered = 0
+        self.max_blocks_per_frame = 0
+        self._frame_times = deque(maxlen=FRAME_HISTORY)
+        self._max_frame_time = 0.0
+        self._t_start = time.monotonic()
+        self._t_stop = None
+
+    def _on_tick(self):
+        now = time.monotonic()
+        with self._lock:
+            pending, self._pending = self._pending, 0
+            since = self._pending_since
+        if not pending:
+            return
+        # the data should have been rendered at the first tick after it came: count the periods it waited beyond that
+        # (half a period of tolerance for the timer jitter)
+        self.frames_skipped += max(int((now - since) * self._max_fps - 0.5), 0)
+        self._render(pending)
+
+    def _render(self, nblocks):
+        t0 = time.perf_counter()
+        self.render()
+        frame_time = time.perf_counter() - t0
+
+        self.frames_rendered += 1
+        self.blocks_rendered += nblocks
+        self.max_blocks_per_frame = max(self.max_blocks_per_frame, nblocks)
+        self._frame_times.append(frame_time)
+        self._max_frame_time = max(self._max_frame_time, frame_time)
@@ -109,6 +109,16 @@ class Ui_MainWindow(object):
         self.display_time_box.setObjectName("display_time_box")
         self.horizontalLayout_4.addWidget(self.display_time_box)
         self.verticalLayout_3.addLayout(self.horizontalLayout_4)
+        self.horizontalLayout_5 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_5.setObjectName("horizontalLayout_5")
+        self.label_7 = QtWidgets.QLabel(self.groupBox_2)
+        self.label_7.setObjectName("label_7")
+        self.horizontalLayout_5.addWidget(self.label_7)
+        self.scroll_back_box = QtWidgets.QDoubleSpinBox(self.groupBox_2)
+        self.scroll_back_box.setDecimals(1)
+        self.scroll_back_box.setObjectName("scroll_back_box")
+        self.horizontalLayout_5.addWidget(self.scroll_back_box)
+        self.verticalLayout_3.addLayout(self.horizontalLayout_5)
         self.clearplot_bttn = QtWidgets.QPushButton(self.groupBox_2)
         self.clearplot_bttn.setObjectName("clearplot_bttn")
         self.verticalLayout_3.addWidget(self.clearplot_bttn)
@@ -173,6 +183,8 @@ class Ui_MainWindow(object):
         self.param_toggle_acquisition.setText(_translate("MainWindow", "Start Acquisition"))
         self.groupBox_2.setTitle(_translate("MainWindow", "Options - Graph"))
         self.label_3.setText(_translate("MainWindow", "Display time"))
+        self.label_7.setText(_translate("MainWindow", "Scroll back"))
+        self.scroll_back_box.setToolTip(_translate("MainWindow", "Show the display window ending this many seconds before the last point (0: follow the acquisition)"))
         self.clearplot_bttn.setText(_translate("MainWindow", "Clear Plot"))
         self.groupBox_3.setTitle(_translate("MainWindow", "Options - Software Buffer"))
         self.label_2.setText(_translate("MainWindow", "Buffer size"))
@@ -1,5 +1,7 @@
-from pyqtgraph import PlotWidget, mkPen, mkBrush
-from itertools import islice
+from collections import deque
+
+from pyqtgraph import PlotDataItem, PlotWidget, mkPen, mkBrush
+import numpy as np
 
 # SYMBOLS = ['t', 't1', 'o', 't2', 't3', 's', 'p', 'h', 'star', '+', 'd']
 SYMBOLS = ['o', 'o', None, None]
@@ -23,17 +25,100 @@ COLORS = [
 #     (23, 190, 207)
 # ]
 
+# points per curve segment in incremental mode
+SEGMENT_POINTS = 2048
+
+
+def _curve_style(index):
+    return {
+        'pen': COLORS[index % len(COLORS)],
+        'symbol': SYMBOLS[index % len(SYMBOLS)],
+        'symbolPen': COLORS[index % len(COLORS)],
+        'symbolBrush': COLORS[index % len(COLORS)],
+        'symbolSize': 3,
+    }
+
+
+class _Segment:
+    """
+    Preallocated storage of one curve segment and the plot item showing it.
+    """
+    def __init__(self, item, size):
+        self.item = item
+        self.x = np.empty(size)
+        self.y = np.empty(size)
+        self.npoints = 0
+
+
+class _SegmentedCurve:
+    """
+    Curve of the incremental mode, made of fixed size segments (one plot item each): points are appended to the last
+    segment, full segments are never updated again and are recycled once they have scrolled out of view. Each segment
+    starts with the last point of the previous one, so that the line is continuous.
+    """
+    def __init__(self, plot_item, index, segment_points=SEGMENT_POINTS):
+        self._plot_item = plot_item
+        self._style = _curve_style(index)
+        self._segment_points = segment_points
+        self._segments = deque()
+        self._free = []
+
+    def append(self, xdata, ydata):
+        start = 0
+        while start < xdata.shape[0]:
+            if not self._segments or self._segments[-1].npoints == self._segment_points:
+                self._new_segment()
+            segment = self._segments[-1]
+            stop = min(xdata.shape[0], start + self._segment_points - segment.npoints)
+            segment.x[segment.npoints:segment.npoints + stop - start] = xdata[start:stop]
+            segment.y[segment.npoints:segment.npoints + stop - start] = ydata[start:stop]
+            segment.npoints += stop - start
+            segment.item.setData(segment.x[:segment.npoints], segment.y[:segment.npoints])
+            start = stop
+
+    def drop_before(self, xmin):
+        # the last segment is always kept
+        while len(self._segments) > 1 and self._segments[0].x[self._segments[0].npoints - 1] < xmin:
+            self._recycle(self._segments.popleft())
+
+    def clear(self):
+        while self._segments:
+            self._recycle(self._segments.popleft())
+
+    def _new_segment(self):
+        if self._free:
+            segment = self._free.pop()
+        else:
+            segment = _Segment(PlotDataItem(**self._style), self._segment_points)
+        segment.npoints = 0
+        if self._segments:
+            previous = self._segments[-1]
+            segment.x[0] = previous.x[previous.npoints - 1]
+            segment.y[0] = previous.y[previous.npoints - 1]
+            segment.npoints = 1
+        self._plot_item.addItem(segment.item)
+        self._segments.append(segment)
+
+    def _recycle(self, segment):
+        self._plot_item.removeItem(segment.item)
+        segment.item.setData([], [])
+        self._free.append(segment)
+
 
 class ScrollPlot(PlotWidget):
     """
     Implements a scrolling plot (new data appears from the right and scroll toward the left).
     Supports multiple curves
+    Two modes: plot() redraws the curves with the last display_time of the data it is given, append() only adds the
+    new points (incremental mode: the cost of an update is proportional to the new data, not to the display window).
     """
     def __init__(self, parent=None, labels=tuple(), units=tuple(), units_prefixes=tuple()):
         super(ScrollPlot, self).__init__(parent=parent)
 
         # data curve, update rather than re-draw
         self._data_curves = []
+        # curves of the incremental mode
+        self._segmented_curves = []
 
         # set labels
         if not labels:
@@ -59,50 +144,71 @@ class ScrollPlot(PlotWidget):
     # CLIENT INTERFACE #
     ####################
     def plot(self, xdata, *ydatas):
-        # get last time
-        tfin = xdata[-1]
-        tini = tfin - self.display_time
-        # start iterating from the end and see which points are within display_time
-        # todo: can't we implement some quick-sort version of this? Also this is an ordered list
-        i = 0
-        for i, tt in enumerate(reversed(xdata)):
-            if tt < tini:
-                break
-        # filter only to the last values
-        ll = len(xdata)
-        xx = list(islice(xdata, ll-i, ll))
+        """
+        Shows the points within display_time of the last one. 'xdata' (sorted) and each of 'ydatas' are NumPy arrays (or
+        sequences) of the same length, a ydata of None clears its curve. The curves get views on the arrays: the cost
+        does not depend on how much data is passed, only on how much is displayed.
+        """
+        xdata = np.asarray(xdata)
+        if xdata.shape[0] == 0:
+            return
+        # x is sorted: binary search of the first point within display_time
+        start = int(np.searchsorted(xdata, xdata[-1] - self.display_time, side='left'))
+        xx = xdata[start:]
 
         for j, ydata in enumerate(ydatas):
-            # update the plot curve
-            try:
-                # raises TypeError if data is None (used in case we don't want to update this curve any more)
-                yy = list(islice(ydata, ll-i, ll))
-                # raises IndexError if this curve was not update before
-                self._data_curves[j].setData(xx, yy)
-
-            except TypeError:
-                # data is None: clear the curve
-                try:
+            if ydata is None:
+                # clear the curve (used in case we don't want to update this curve any more)
+                if j < len(self._data_curves):
                     self._data_curves[j].setData([], [])
-                except IndexError:
-                    continue
+                continue
 
-            except IndexError:
+            yy = np.asarray(ydata)[start:]
+            if j < len(self._data_curves):
+                # update the plot curve
+                self._data_curves[j].setData(xx, yy)
+            else:
                 # curve does not exist create new
-                new_curve = self.plotItem.plot(
-                    xx,
-                    yy,
-                    pen=COLORS[j % len(COLORS)],
-                    symbol=SYMBOLS[j % len(SYMBOLS)],
-                    symbolPen=COLORS[j % len(COLORS)],
-                    symbolBrush=COLORS[j % len(COLORS)],
-                    symbolSize=3
-                )
+                new_curve = self.plotItem.plot(xx, yy, **_curve_style(j))
                 self._data_curves.append(new_curve)
 
+    def append(self, xdata, *ydatas):
+        """
+        Incremental mode: adds new points ('xdata' sorted and after the points already shown, same length NumPy arrays
+        or sequences, a ydata of None clears its curve) and scrolls the view to the last display_time. Points that
+        scrolled out of view are dropped, call erase() before switching back to plot().
+        """
+        xdata = np.asarray(xdata, dtype=float)
+        if xdata.shape[0] == 0:
+            return
+
+        for j, ydata in enumerate(ydatas):
+            while len(self._segmented_curves) <= j:
+                self._segmented_curves.append(_SegmentedCurve(self.plotItem, len(self._segmented_curves)))
+            if ydata is None:
+                self._segmented_curves[j].clear()
+            else:
+                self._segmented_curves[j].append(xdata, np.asarray(ydata))
+
+        xmin = xdata[-1] - self.display_time
+        for curve in self._segmented_curves:
+            curve.drop_before(xmin)
+        self.setXRange(xmin, xdata[-1], padding=0)
+
     def erase(self):
         for data_curve in self._data_curves:
             data_curve.setData([], [])
+        if self._segmented_curves:
+            for curve in self._segmented_curves:
+                curve.clear()
+            self.enableAutoRange(x=True)
+
+    @property
+    def pixel_width(self):
+        """
+        Width of the plotting area in pixels (the data shown needs no more points than that, see decimation module).
+        """
+        return max(int(self.plotItem.vb.width()), 1)
 
     @property
     def display_time(self):
@@ -0,0 +1,373 @@
+"""
+Headless benchmark of the acquisition chain, driven by the simulator behind hamamatsu.libhandle (fakelib).
+For every gate time the simulated unit is read through the same path used by the GUI (read_block -> pipeline ->
+buffer/storage and display consumers) and the following figures are reported:
+    - sustained samples/s through read -> buffer -> storage
+    - p50/p99 latency from block arrival to the end of the display (plot + FFT data) update
+    - CPU time per stage (thread CPU time, absolute and per sample)
+    - storage writer thread: write latency and backlog
+Results are written as JSON so that runs of different versions can be compared.
+With --storage the log formats are compared instead (CSV, raw binary and compressed binary at a few levels, with and
+without delta encoding): compression ratio (raw uint32 counts / file size) and write/read throughput in MB/s of raw (uint32) counts.
+With --durability the storage writer is run at each durability level (none, periodic, chunk) for CSV and binary logs:
+throughput (samples/s until everything is on disk), number of syncs and time spent in them, caller stalls.
+
+    python -m PhotonCounter.benchmark --duration 2 --output bench.json
+    python -m PhotonCounter.benchmark --storage --samples 2000000
+    python -m PhotonCounter.benchmark --durability --samples 2000000
+"""
+import argparse
+import json
+import os.path
+import platform
+import tempfile
+import threading as th
+import time
+
+import numpy as np
+
+from . import binlog, hamamatsu
+from .hamamatsu import GATE_TIMES, Hamamatsu
+from .buffer import RingBuffer
+from .session import SessionReader
+from .storage import DURABILITY_LEVELS, CsvLogWriter, StorageWriter
+from .pipeline import KEEP_ALL, AcquisitionPipeline
+from .runningstats import StreamingStats
+
+BENCH_VERSION = 5
+
+DEFAULT_DURATION = 2.0
+# same defaults as the GUI
+DEFAULT_BUFFER_SIZE = 1000
+DEFAULT_DISPLAY_TIME = 10.0
+DEFAULT_MVAVG = 10
+# storage benchmark: samples written and log formats compared (codec, level, delta)
+DEFAULT_STORAGE_SAMPLES = 1000000
+STORAGE_FORMATS = [
+    ('csv', None, None),
+    ('none', None, None),
+    ('zlib', 1, True), ('zlib', 1, False), ('zlib', 6, True), ('zlib', 6, False),
+    ('lzma', 0, True), ('lzma', 0, False), ('lzma', 6, True),
+]
+# durability benchmark: samples per write handed to the sink (each one is synced with 'chunk') and periodic sync interval
+DEFAULT_DURABILITY_FLUSH = 10000
+DEFAULT_DURABILITY_INTERVAL = 0.5
+
+
+class StageTimer:
+    """
+    Accumulates thread CPU time and wall time spent in one stage of the chain.
+    """
+    def __init__(self):
+        self.cpu = 0.0
+        self.wall = 0.0
+        self.calls = 0
+
+    def __enter__(self):
+        self._cpu0 = time.thread_time()
+        self._wall0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cpu += time.thread_time() - self._cpu0
+        self.wall += time.perf_counter() - self._wall0
+        self.calls += 1
+
+    def report(self, samples: int):
+        return {
+            'cpu_s': self.cpu,
+            'wall_s': self.wall,
+            'calls': self.calls,
+            'cpu_us_per_sample': 1e6 * self.cpu / samples if samples else None,
+        }
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    return float(np.percentile(values, q))
+
+
+def display_update(buffer, stats, gate_time: float, display_time: float):
+    """
+    Headless equivalent of the data preparation done by PhotonCounterGui._update_plot (time axis, moving average and
+    FFT of the displayed window). 'stats' (StreamingStats) is fed with the same samples as the buffer, before it.
+    """
+    npoints = int(display_time // gate_time) + 1
+    times, ydata = buffer.last(npoints, copy=True)
+    if len(times) == 0:
+        return None
+    xdata = times - times[-1]
+    ydata = ydata.astype(float)
+
+    ydata_avg = stats.last(len(times), ['mean'])[0]
+    yfft = np.fft.rfft(ydata)
+    return xdata, ydata, ydata_avg, yfft
+
+
+def run_gate_time(gate_time: str, duration: float, *, realtime: bool = False, buffer_size: int = DEFAULT_BUFFER_SIZE,
+                  display_time: float = DEFAULT_DISPLAY_TIME, mvavg: int = DEFAULT_MVAVG, folder: str = ''):
+    """
+    Runs the acquisition chain for 'duration' seconds at the given gate time and returns a dictionary of results.
+    """
+    hamamatsu.libhandle.configure(realtime=realtime)
+    hw = Hamamatsu.open()
+    try:
+        hw.gate_time = gate_time
+        hw.setup(mode=1)
+        gtime = GATE_TIMES[gate_time][2]
+
+        path = os.path.join(folder, f'bench_{gate_time}.csv')
+        log = StorageWriter(CsvLogWriter(path, ['Time', 'Counts'], dtypes=[np.float64, np.uint32]),
+                            dtypes=[np.float64, np.uint32])
+        buffer = RingBuffer(buffer_size, path, ['Time', 'Counts'], dtypes=[np.float64, np.uint32], save=True, log=log)
+        stages = {name: StageTimer() for name in ('readout', 'storage', 'display')}
+        latencies = []
+        stats = StreamingStats(mvavg)
+        stored = [0]
+
+        def store(blocks):
+            with stages['storage']:
+                for block in blocks:
+                    stats.push(block.data)
+                    buffer.push_block(block.times, block.data)
+                    stored[0] += len(block)
+
+        def display(blocks):
+            with stages['display']:
+                display_update(buffer, stats, gtime, display_time)
+            t_done = time.time()
+            latencies.extend(t_done - block.t_recv for block in blocks)
+
+        pipe = AcquisitionPipeline()
+        pipe.add_consumer('storage', store, policy=KEEP_ALL)
+        pipe.add_consumer('display', display)
+        pipe.start()
+
+        halt = th.Event()
+
+        def readout():
+            while not halt.is_set():
+                with stages['readout']:
+                    block = hw.read_block()
+                    pipe.put(block)
+                    block.release()
+
+        hw.count_start()
+        t0 = time.perf_counter()
+        reader = th.Thread(name='Bench Reader', target=readout, daemon=True)
+        reader.start()
+        time.sleep(duration)
+        halt.set()
+        reader.join()
+        pipe.stop(timeout=10.0)
+        elapsed = time.perf_counter() - t0
+        hw.count_stop()
+        buffer.close()
+    finally:
+        hw.close()
+
+    samples = stored[0]
+    return {
+        'gate_time': gate_time,
+        'gate_time_s': gtime,
+        'gates_per_block': hw.gates,
+        'realtime': realtime,
+        'elapsed_s': elapsed,
+        'blocks_read': hw.blocks_read,
+        'blocks_lost': hw.blocks_lost,
+        'blocks_late': hw.blocks_late,
+        'samples_stored': samples,
+        'samples_per_s': samples / elapsed,
+        'realtime_samples_per_s': 1.0 / gtime,
+        'latency_p50_ms': 1e3 * _percentile(latencies, 50) if latencies else None,
+        'latency_p99_ms': 1e3 * _percentile(latencies, 99) if latencies else None,
+        'display_updates': stages['display'].calls,
+        'stages': {name: timer.report(samples) for name, timer in stages.items()},
+        'pipeline': pipe.stats,
+        'storage_writer': log.stats,
+    }
+
+
+def run(gate_times=None, duration: float = DEFAULT_DURATION, **kwargs):
+    """
+    Runs the benchmark for each gate time (all the entries of GATE_TIMES by default).
+    """
+    if gate_times is None:
+        gate_times = list(GATE_TIMES.keys())
+
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for gate_time in gate_times:
+            results.append(run_gate_time(gate_time, duration, folder=folder, **kwargs))
+
+    return {
+        'benchmark_version': BENCH_VERSION,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'duration_s': duration,
+        'results': results,
+    }
+
+
+def _acquire_samples(samples: int, gate_time: str):
+    # realistic counts from the simulated hardware
+    hamamatsu.libhandle.configure(realtime=False)
+    hw = Hamamatsu.open()
+    try:
+        hw.gate_time = gate_time
+        hw.setup(mode=1)
+        times, counts = [], []
+        hw.count_start()
+        while sum(len(block) for block in counts) < samples:
+            with hw.read_block() as block:
+                times.append(block.times.copy())
+                counts.append(block.data.copy())
+        hw.count_stop()
+    finally:
+        hw.close()
+    return np.concatenate(times)[:samples], np.concatenate(counts)[:samples]
+
+
+def run_storage(samples: int = DEFAULT_STORAGE_SAMPLES, *, gate_time: str = '1MS', block_size: int = 500):
+    """
+    Writes the same simulated acquisition in each of STORAGE_FORMATS, then reads it back with SessionReader.
+    Returns a dictionary of results.
+    """
+    times, counts = _acquire_samples(samples, gate_time)
+    raw_mb = counts.nbytes / 1e6
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for codec, level, delta in STORAGE_FORMATS:
+            if codec == 'csv':
+                path = os.path.join(folder, 'bench.csv')
+                sink = CsvLogWriter(path, ['Time', 'Counts'], dtypes=[np.float64, np.uint32])
+            else:
+                path = os.path.join(folder, f'bench_{codec}_{level}_{delta}{binlog.EXTENSION}')
+                sink = binlog.BinaryLogWriter(path, gate_time=GATE_TIMES[gate_time][2], codec=codec, level=level,
+                                              delta=bool(delta))
+
+            t0 = time.perf_counter()
+            for start in range(0, samples, block_size):
+                sink.write(times[start:start + block_size], counts[start:start + block_size])
+            sink.close()
+            t_write = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            with SessionReader(path, save_index=False) as session:
+                nread = sum(len(chunk) for chunk, _ in session.iter_chunks())
+            t_read = time.perf_counter() - t0
+            if nread != samples:
+                raise RuntimeError(f'{path}: read {nread} samples back, {samples} written')
+
+            size = os.path.getsize(path)
+            results.append({
+                'format': codec if codec in ('csv', 'none') else f'{codec}-{level}{"-delta" if delta else ""}',
+                'file_mb': size / 1e6,
+                # raw uint32 counts / file size
+                'compression_ratio': counts.nbytes / size,
+                'write_mb_per_s': raw_mb / t_write,
+                'read_mb_per_s': raw_mb / t_read,
+            })
+
+    return {
+        'benchmark_version': BENCH_VERSION,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'samples': samples,
+        'gate_time': gate_time,
+        'raw_counts_mb': raw_mb,
+        'results': results,
+    }
+
+
+def run_durability(samples: int = DEFAULT_STORAGE_SAMPLES, *, gate_time: str = '1MS', block_size: int = 500,
+                   flush_samples: int = DEFAULT_DURABILITY_FLUSH, fsync_interval: float = DEFAULT_DURABILITY_INTERVAL):
+    """
+    Writes the same simulated acquisition through a StorageWriter at each durability level, for CSV and binary logs.
+    Returns a dictionary of results.
+    """
+    times, counts = _acquire_samples(samples, gate_time)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for log_format in ('csv', 'binary'):
+            for durability in DURABILITY_LEVELS:
+                if log_format == 'csv':
+                    sink = CsvLogWriter(os.path.join(folder, f'bench_{durability}.csv'), ['Time', 'Counts'],
+                                        dtypes=[np.float64, np.uint32])
+                else:
+                    sink = binlog.BinaryLogWriter(os.path.join(folder, f'bench_{durability}{binlog.EXTENSION}'),
+                                                  gate_time=GATE_TIMES[gate_time][2])
+                writer = StorageWriter(sink, dtypes=[np.float64, np.uint32], flush_samples=flush_samples,
+                                       durability=durability, fsync_interval=fsync_interval)
+
+                t0 = time.perf_counter()
+                for start in range(0, samples, block_size):
+                    writer.write(times[start:start + block_size], counts[start:start + block_size])
+                writer.close()
+                elapsed = time.perf_counter() - t0
+
+                stats = writer.stats
+                results.append({
+                    'format': log_format,
+                    'durability': durability,
+                    'samples_per_s': samples / elapsed,
+                    'syncs': stats['syncs'],
+                    'sync_time_s': stats['sync_time_s'],
+                    'sync_latency_max_ms': stats['sync_latency_max_ms'],
+                    'write_latency_p99_ms': stats['write_latency_p99_ms'],
+                    'stalls': stats['stalls'],
+                })
+
+    return {
+        'benchmark_version': BENCH_VERSION,
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'samples': samples,
+        'gate_time': gate_time,
+        'flush_samples': flush_samples,
+        'fsync_interval_s': fsync_interval,
+        'results': results,
+    }
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Acquisition chain benchmark (simulated hardware).')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='seconds per gate time')
+    parser.add_argument('--gate-times', nargs='+', choices=list(GATE_TIMES.keys()), default=None,
+                        help='gate times to run (default: all)')
+    parser.add_argument('--realtime', action='store_true', help='pace the simulator in real time')
+    parser.add_argument('--output', default='', help='JSON output file (default: stdout)')
+    parser.add_argument('--storage', action='store_true', help='compare the log formats instead')
+    parser.add_argument('--durability', action='store_true', help='compare the durability levels instead')
+    parser.add_argument('--samples', type=int, default=DEFAULT_STORAGE_SAMPLES,
+                        help='samples for --storage and --durability')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    if not hasattr(hamamatsu.libhandle, 'configure'):
+        raise RuntimeError('The benchmark requires the simulated hardware library (fakelib)')
+
+    if args.storage:
+        report = run_storage(args.samples)
+    elif args.durability:
+        report = run_durability(args.samples)
+    else:
+        report = run(args.gate_times, args.duration, realtime=args.realtime)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f_out:
+            f_out.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
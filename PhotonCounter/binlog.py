@@ -0,0 +1,573 @@
+"""
+Module implements a compact binary format for acquisition logs, much faster to write and to load than the CSV files
+written by buffer.SimpleBuffer.
+
+File layout (little endian):
+    preamble   magic b'BPCLOG\\0\\0', format version (uint32), header size in bytes (uint32)
+    header     JSON text padded to a multiple of 8 bytes: gate time, device uid, start time, chunk size and the NumPy
+               description of a chunk record (so the file can be read without this module)
+    chunks     fixed-size records: t_start (float64), gate_time (float64), npoints (uint32), flags (uint32) followed by
+               chunk_size uint32 counts. Only the first npoints counts are valid (the last chunk is usually partial).
+
+The samples of a chunk are contiguous: sample i was taken at t_start + i * gate_time. A gap in the time axis (lost
+blocks) or a change of gate time closes the current chunk early. The whole file can be loaded with np.fromfile() or
+mapped with np.memmap() using the record dtype: see read_header(), open_chunks() and load().
+
+Compressed logs (format version 2, header 'codec' zlib or lzma) hold variable-size records instead: t_start, gate_time,
+npoints, nbytes followed by nbytes of compressed counts. Before compression the counts are delta encoded (optional,
+zigzag so that small negative steps stay small) and their bytes are shuffled (all the low bytes first...), which makes
+the mostly-zero high bytes of small counts compress very well. Compressed logs are read sequentially (read_records(),
+load()) or through session.SessionReader, which indexes the records.
+
+    python -m PhotonCounter.binlog to-binary Data/log_01.01.24_10.00.00.csv
+    python -m PhotonCounter.binlog to-csv Data/log_01.01.24_10.00.00.bpc
+"""
+from itertools import islice
+import json
+import logging
+import lzma
+import os
+import os.path
+import time
+import zlib
+
+import numpy as np
+
+from .hamamatsu import GATE_TIMES
+
+MAGIC = b'BPCLOG\x00\x00'
+# version of the uncompressed layout and highest version supported (compressed layout)
+FORMAT_VERSION = 1
+COMPRESSED_VERSION = 2
+# log file extension
+EXTENSION = '.bpc'
+# samples per chunk (16 KiB of counts)
+DEFAULT_CHUNK_SIZE = 4096
+# rows parsed at once by the CSV converter
+CSV_BATCH = 65536
+
+# chunk compression codecs and their default (fast) levels
+CODECS = ('none', 'zlib', 'lzma')
+DEFAULT_LEVELS = {'zlib': 1, 'lzma': 0}
+
+_PREAMBLE_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('header_size', '<u4'),
+])
+
+
+# record header of a compressed chunk
+RECORD_DTYPE = np.dtype([
+    ('t_start', '<f8'),
+    ('gate_time', '<f8'),
+    ('npoints', '<u4'),
+    ('nbytes', '<u4'),          # size of the compressed counts following the record header
+])
+
+
+def chunk_dtype(chunk_size: int):
+    """
+    NumPy dtype of one chunk record.
+    """
+    return np.dtype([
+        ('t_start', '<f8'),     # time of the first sample (seconds since the start of the acquisition)
+        ('gate_time', '<f8'),
+        ('npoints', '<u4'),     # number of valid counts
+        ('flags', '<u4'),       # reserved
+        ('counts', '<u4', (chunk_size,)),
+    ])
+
+
+def _gate_time_name(gate_time: float):
+    for name, (_, _, seconds) in GATE_TIMES.items():
+        if np.isclose(seconds, gate_time):
+            return name
+    return None
+
+
+class BinaryLogWriter:
+    """
+    Appends (times, counts) blocks to a binary log. Samples are collected in the current chunk and only complete chunks
+    are written, close() (or flush()) writes the partial one. An existing file with the same chunk size is appended to.
+    'gate_time' is the expected spacing of the times (seconds): any other spacing starts a new chunk.
+    'codec' other than 'none' compresses each chunk (see encode_counts), 'level' is the zlib/lzma compression level
+    (lower is faster), 'delta' enables the delta encoding of the counts.
+    """
+    def __init__(self, path: str, *, gate_time: float, uid: int = None, start_time: float = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, codec: str = 'none', level: int = None, delta: bool = True):
+        if chunk_size <= 0:
+            raise ValueError(f"Chunk size must be positive, got {chunk_size}")
+        if gate_time <= 0:
+            raise ValueError(f"Gate time must be positive, got {gate_time}")
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec {codec}, use one of {CODECS}")
+        if level is None:
+            level = DEFAULT_LEVELS.get(codec)
+
+        folder = os.path.dirname(path)
+        if len(folder) != 0 and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.path = path
+        self.gate_time = gate_time
+        self.chunk_size = chunk_size
+        self.dtype = chunk_dtype(chunk_size)
+        self.codec = codec
+        self.level = level
+        self.delta = delta
+
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            header, offset = read_header(path)
+            if header['chunk_size'] != chunk_size or header.get('codec', 'none') != codec:
+                raise ValueError(f"{path} has chunks of {header['chunk_size']} samples ({header.get('codec', 'none')}),"
+                                 f" not {chunk_size} ({codec})")
+            self.header = header
+            self.delta = header.get('delta', delta)
+            # drop a partially written chunk (interrupted write)
+            dropped = recover(path)
+            if dropped:
+                logging.warning(f'Dropped {dropped} bytes of incomplete data at the end of {path}')
+            self._file = open(path, 'r+b')
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self.header = {
+                'gate_time': gate_time,
+                'gate_time_name': _gate_time_name(gate_time),
+                'uid': uid,
+                'start_time': time.time() if start_time is None else start_time,
+                'chunk_size': chunk_size,
+                'columns': ['Time', 'Counts'],
+                'codec': codec,
+            }
+            if codec == 'none':
+                self.header['chunk_dtype'] = self.dtype.descr
+            else:
+                self.header.update({'level': level, 'delta': delta, 'record_dtype': RECORD_DTYPE.descr})
+            self._file = open(path, 'wb')
+            self._file.write(_pack_header(self.header, FORMAT_VERSION if codec == 'none' else COMPRESSED_VERSION))
+
+        self._chunk = np.zeros(1, dtype=self.dtype)[0]
+        self._npoints = 0
+        self.samples = 0
+        self.chunks_written = 0
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def write(self, times, counts):
+        """
+        Adds a block of samples: 'times' (seconds) and 'counts' sequences of the same length.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        counts = np.asarray(counts)
+        if len(times) != len(counts):
+            raise ValueError(f"Times and counts must have the same length, got {len(times)} and {len(counts)}")
+        if len(times) == 0:
+            return
+
+        # split the block where the time axis is not contiguous
+        breaks = np.flatnonzero(np.abs(np.diff(times) - self.gate_time) > self.gate_time / 2) + 1
+        for start, stop in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(times)]))):
+            self._write_run(times[start], counts[start:stop])
+        self.samples += len(times)
+
+    def flush(self):
+        """
+        Writes the current (partial) chunk and flushes the file.
+        """
+        self._close_chunk()
+        self._file.flush()
+
+    def sync(self):
+        """
+        Makes the chunks written so far durable (fsync), the current partial chunk stays in memory.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+    @property
+    def bytes_written(self):
+        return self._file.tell() if not self._file.closed else os.path.getsize(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    #############
+    # INTERNALS #
+    #############
+    def _write_run(self, t_start, counts):
+        # a run that does not continue the current chunk starts a new one
+        if self._npoints:
+            expected = self._chunk['t_start'] + self._npoints * self._chunk['gate_time']
+            if abs(t_start - expected) > self.gate_time / 2 or self._chunk['gate_time'] != self.gate_time:
+                self._close_chunk()
+
+        done = 0
+        while done < len(counts):
+            if self._npoints == 0:
+                self._chunk['t_start'] = t_start + done * self.gate_time
+                self._chunk['gate_time'] = self.gate_time
+            n = min(len(counts) - done, self.chunk_size - self._npoints)
+            self._chunk['counts'][self._npoints:self._npoints + n] = counts[done:done + n]
+            self._npoints += n
+            done += n
+            if self._npoints == self.chunk_size:
+                self._close_chunk()
+
+    def _close_chunk(self):
+        if self._npoints == 0:
+            return
+        if self.codec == 'none':
+            self._chunk['npoints'] = self._npoints
+            self._chunk['counts'][self._npoints:] = 0
+            self._file.write(self._chunk.tobytes())
+        else:
+            payload = encode_counts(self._chunk['counts'][:self._npoints], self.codec, self.level, self.delta)
+            record = np.array((self._chunk['t_start'], self._chunk['gate_time'], self._npoints, len(payload)),
+                              dtype=RECORD_DTYPE)
+            self._file.write(record.tobytes() + payload)
+        self.chunks_written += 1
+        self._npoints = 0
+
+
+def _pack_header(header: dict, version: int):
+    text = json.dumps(header).encode('utf-8')
+    # keep the chunks 8-byte aligned
+    text += b' ' * (-(len(text) + _PREAMBLE_DTYPE.itemsize) % 8)
+    preamble = np.array((MAGIC, version, len(text)), dtype=_PREAMBLE_DTYPE)
+    return preamble.tobytes() + text
+
+
+###############
+# COMPRESSION #
+###############
+def encode_counts(counts, codec: str, level: int = None, delta: bool = True):
+    """
+    Compresses uint32 counts: optional zigzag delta encoding, byte shuffle, then zlib or lzma. Returns bytes.
+    """
+    values = np.ascontiguousarray(counts, dtype=np.uint32)
+    if delta:
+        # wrapping uint32 differences seen as int32, zigzag maps -1, 1, -2... to 1, 2, 3...
+        steps = np.diff(values, prepend=np.uint32(0)).view(np.int32)
+        values = ((steps << 1) ^ (steps >> 31)).view(np.uint32)
+    shuffled = values.view(np.uint8).reshape(-1, 4).T.tobytes()
+    if level is None:
+        level = DEFAULT_LEVELS[codec]
+    if codec == 'zlib':
+        return zlib.compress(shuffled, level)
+    if codec == 'lzma':
+        return lzma.compress(shuffled, preset=level)
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def decode_counts(payload: bytes, npoints: int, codec: str, delta: bool = True):
+    """
+    Inverse of encode_counts(). Returns a uint32 array of npoints counts.
+    """
+    if codec == 'zlib':
+        shuffled = zlib.decompress(payload)
+    elif codec == 'lzma':
+        shuffled = lzma.decompress(payload)
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+    values = np.frombuffer(shuffled, dtype=np.uint8).reshape(4, npoints).T.copy().view(np.uint32).ravel()
+    if delta:
+        steps = (values >> 1) ^ -(values & 1)
+        values = np.cumsum(steps, dtype=np.uint32)
+    return values
+
+
+def scan_records(f_in, offset: int):
+    """
+    Yields (offset, record header) for each complete record of a compressed log, starting at 'offset'. The payloads
+    are skipped, not read.
+    """
+    size = os.fstat(f_in.fileno()).st_size
+    while offset + RECORD_DTYPE.itemsize <= size:
+        f_in.seek(offset)
+        record = np.frombuffer(f_in.read(RECORD_DTYPE.itemsize), dtype=RECORD_DTYPE)[0]
+        end = offset + RECORD_DTYPE.itemsize + int(record['nbytes'])
+        if end > size:
+            break
+        yield offset, record
+        offset = end
+
+
+def _records_end(f_in, offset):
+    # end of the last complete record (a crash can also leave zeros, not only a short file)
+    for offset, record in scan_records(f_in, offset):
+        if record['npoints'] == 0 or not record['gate_time'] > 0:
+            break
+        offset += RECORD_DTYPE.itemsize + int(record['nbytes'])
+    return offset
+
+
+def _chunks_end(f_in, header, offset):
+    # end of the last complete, valid chunk
+    dtype = chunk_dtype(header['chunk_size'])
+    nchunks = (os.fstat(f_in.fileno()).st_size - offset) // dtype.itemsize
+    while nchunks:
+        f_in.seek(offset + (nchunks - 1) * dtype.itemsize)
+        chunk = np.frombuffer(f_in.read(dtype.itemsize), dtype=dtype)[0]
+        if 0 < chunk['npoints'] <= header['chunk_size'] and chunk['gate_time'] > 0:
+            break
+        nchunks -= 1
+    return offset + nchunks * dtype.itemsize
+
+
+def recover(path: str):
+    """
+    Repairs a binary log left by an interrupted write (crash, power loss): drops the incomplete (or zero filled) chunks
+    or records at the end of the file. Returns the number of bytes dropped.
+    """
+    header, offset = read_header(path)
+    with open(path, 'r+b') as f_out:
+        size = os.fstat(f_out.fileno()).st_size
+        end = _records_end(f_out, offset) if is_compressed(header) else _chunks_end(f_out, header, offset)
+        if end < size:
+            f_out.truncate(end)
+    return size - end
+
+
+def read_records(f_in, header: dict, offset: int):
+    """
+    Yields (record header, counts) for each complete record of a compressed log, starting at 'offset'.
+    """
+    f_in.seek(offset)
+    while True:
+        raw = f_in.read(RECORD_DTYPE.itemsize)
+        if len(raw) < RECORD_DTYPE.itemsize:
+            return
+        record = np.frombuffer(raw, dtype=RECORD_DTYPE)[0]
+        payload = f_in.read(int(record['nbytes']))
+        if len(payload) < record['nbytes']:
+            return
+        yield record, decode_counts(payload, int(record['npoints']), header['codec'], header.get('delta', True))
+
+
+def is_compressed(header: dict):
+    return header.get('codec', 'none') != 'none'
+
+
+def read_header(path: str):
+    """
+    Returns (header dictionary, offset of the first chunk in bytes).
+    """
+    with open(path, 'rb') as f_in:
+        raw = f_in.read(_PREAMBLE_DTYPE.itemsize)
+        if len(raw) < _PREAMBLE_DTYPE.itemsize:
+            raise ValueError(f"{path} is not a binary acquisition log (file too short)")
+        preamble = np.frombuffer(raw, dtype=_PREAMBLE_DTYPE)[0]
+        if raw[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a binary acquisition log")
+        if preamble['version'] > COMPRESSED_VERSION:
+            raise ValueError(f"{path} has format version {preamble['version']}, "
+                             f"only versions up to {COMPRESSED_VERSION} are supported")
+        header = json.loads(f_in.read(int(preamble['header_size'])).decode('utf-8'))
+    return header, _PREAMBLE_DTYPE.itemsize + int(preamble['header_size'])
+
+
+def open_chunks(path: str, *, mmap: bool = True):
+    """
+    Returns (header, chunk records). With mmap the records are a read-only np.memmap (nothing is read until used),
+    otherwise they are read with np.fromfile. A trailing partial record (interrupted write) is ignored.
+    """
+    header, offset = read_header(path)
+    if is_compressed(header):
+        raise ValueError(f"{path} is compressed ({header['codec']}), its chunks can only be read sequentially")
+    dtype = np.dtype([tuple(field) for field in _as_tuples(header['chunk_dtype'])])
+    nchunks = (os.path.getsize(path) - offset) // dtype.itemsize
+    if nchunks == 0:
+        return header, np.zeros(0, dtype=dtype)
+    if mmap:
+        return header, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(nchunks,))
+    return header, np.fromfile(path, dtype=dtype, count=nchunks, offset=offset)
+
+
+def _as_tuples(descr):
+    # JSON turns the tuples (and sub-array shapes) of dtype.descr into lists
+    return [tuple(tuple(item) if isinstance(item, list) else item for item in field) for field in descr]
+
+
+def unpack(chunks):
+    """
+    Returns the (times, counts) arrays of a sequence of chunk records.
+    """
+    chunk_size = chunks.dtype['counts'].shape[0]
+    offsets = np.arange(chunk_size)
+    valid = offsets < chunks['npoints'][:, None]
+    counts = chunks['counts'][valid]
+    times = (chunks['t_start'][:, None] + offsets * chunks['gate_time'][:, None])[valid]
+    return times, counts
+
+
+def unpack_records(records):
+    """
+    Returns the (times, counts) arrays of a sequence of (record header, counts) of a compressed log.
+    """
+    if not records:
+        return np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.uint32)
+    times = np.concatenate([record['t_start'] + np.arange(len(counts)) * record['gate_time']
+                            for record, counts in records])
+    return times, np.concatenate([counts for _, counts in records])
+
+
+def iter_blocks(path: str, samples: int = CSV_BATCH):
+    """
+    Yields (header, times, counts) for successive groups of chunks of about 'samples' samples (at least one chunk).
+    """
+    header, offset = read_header(path)
+    step = max(samples // header['chunk_size'], 1)
+    if not is_compressed(header):
+        _, chunks = open_chunks(path)
+        for start in range(0, len(chunks), step):
+            yield (header,) + unpack(chunks[start:start + step])
+        return
+
+    with open(path, 'rb') as f_in:
+        records = []
+        for record in read_records(f_in, header, offset):
+            records.append(record)
+            if len(records) == step:
+                yield (header,) + unpack_records(records)
+                records = []
+        if records:
+            yield (header,) + unpack_records(records)
+
+
+def load(path: str, *, mmap: bool = False):
+    """
+    Loads a whole binary log. Returns (header, times, counts).
+    """
+    header, offset = read_header(path)
+    if is_compressed(header):
+        with open(path, 'rb') as f_in:
+            times, counts = unpack_records(list(read_records(f_in, header, offset)))
+        return header, times, counts
+
+    header, chunks = open_chunks(path, mmap=mmap)
+    times, counts = unpack(chunks)
+    return header, times, counts
+
+
+##############
+# CONVERTERS #
+##############
+def _read_csv_header(f_in):
+    """
+    Reads the comment lines at the beginning of a CSV log. Returns (gate time name or None, column names or None, first
+    data line).
+    """
+    gate_time = None
+    columns = None
+    for line in f_in:
+        if not line.startswith('#'):
+            return gate_time, columns, line
+        if line.startswith('# GATE TIME'):
+            gate_time = line[len('# GATE TIME'):].strip().rstrip('.')
+        else:
+            columns = line.strip().lstrip('#').split(',')
+    return gate_time, columns, ''
+
+
+def csv_to_binary(csv_path: str, bin_path: str = None, *, gate_time: float = None, uid: int = None,
+                  chunk_size: int = DEFAULT_CHUNK_SIZE, codec: str = 'none', level: int = None):
+    """
+    Converts a CSV log (as written by SimpleBuffer/RingBuffer: Time,Counts) to a binary log. The gate time is taken
+    from 'gate_time', then from a '# GATE TIME' header line, then from the median spacing of the first rows.
+    Older logs with only a Counts column are converted too (they need a gate time: the time of row i is i times the
+    gate time). Returns the path of the binary log.
+    """
+    if bin_path is None:
+        bin_path = os.path.splitext(csv_path)[0] + EXTENSION
+
+    writer = None
+    with open(csv_path, 'r') as f_in:
+        name, columns, first = _read_csv_header(f_in)
+        if gate_time is None and name in GATE_TIMES:
+            gate_time = GATE_TIMES[name][2]
+        counts_only = columns is not None and len(columns) == 1
+        if counts_only and gate_time is None:
+            raise ValueError(f"{csv_path} has no time column and no gate time")
+
+        nrows = 0
+
+        lines = [first] if first else []
+        try:
+            while True:
+                lines.extend(islice(f_in, CSV_BATCH - len(lines)))
+                if not lines:
+                    break
+                rows = np.loadtxt(lines, delimiter=',', ndmin=2)
+                lines = []
+                if counts_only:
+                    rows = np.column_stack(((nrows + np.arange(len(rows))) * gate_time, rows[:, 0]))
+                nrows += len(rows)
+                if writer is None:
+                    if gate_time is None:
+                        if len(rows) < 2:
+                            raise ValueError(f"Cannot tell the gate time of {csv_path}")
+                        gate_time = float(np.median(np.diff(rows[:, 0])))
+                    # only a complete file replaces an existing binary log
+                    if os.path.isfile(bin_path):
+                        os.remove(bin_path)
+                    writer = BinaryLogWriter(bin_path, gate_time=gate_time, uid=uid, chunk_size=chunk_size,
+                                             codec=codec, level=level)
+                writer.write(rows[:, 0], rows[:, 1].astype(np.uint32))
+        finally:
+            if writer is not None:
+                writer.close()
+
+    if writer is None:
+        raise ValueError(f"{csv_path} contains no data")
+    return bin_path
+
+
+def binary_to_csv(bin_path: str, csv_path: str = None):
+    """
+    Converts a binary log to the CSV layout written by SimpleBuffer (gate time header line, then Time,Counts).
+    Chunks are converted a few at a time, memory use does not depend on the file size.
+    Returns the path of the CSV file.
+    """
+    if csv_path is None:
+        csv_path = os.path.splitext(bin_path)[0] + '.csv'
+
+    header, _ = read_header(bin_path)
+    gate_time = header['gate_time_name'] or f"{header['gate_time']}S"
+    with open(csv_path, 'w') as f_out:
+        f_out.write(f'# GATE TIME {gate_time}.\n')
+        f_out.write('#' + ','.join(header['columns']) + '\n')
+        for _, times, counts in iter_blocks(bin_path):
+            np.savetxt(f_out, np.column_stack((times, counts)), fmt=['%.12g', '%d'], delimiter=',')
+    return csv_path
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert acquisition logs between CSV and binary.')
+    parser.add_argument('direction', choices=['to-binary', 'to-csv'])
+    parser.add_argument('input')
+    parser.add_argument('output', nargs='?', default=None)
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='samples per chunk')
+    parser.add_argument('--codec', choices=CODECS, default='none', help='chunk compression (to-binary)')
+    parser.add_argument('--level', type=int, default=None, help='compression level')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    if args.direction == 'to-binary':
+        out = csv_to_binary(args.input, args.output, chunk_size=args.chunk_size, codec=args.codec, level=args.level)
+    else:
+        out = binary_to_csv(args.input, args.output)
+    print(f'{args.input} -> {out} ({os.path.getsize(args.input) / 1e6:.1f} MB -> {os.path.getsize(out) / 1e6:.1f} MB, '
+          f'{time.perf_counter() - t0:.2f}s)')
@@ -0,0 +1,122 @@
+"""
+Module implements the adaptive choice of the number of gates read per C8855ReadData call.
+Few gates per call means low display latency but the fixed per-call cost (USB transfer, driver and Python overhead) is
+paid more often, many gates per call amortize that cost but the data shows up later. The gates per block in
+hamamatsu.GATE_TIMES are a fixed guess of this trade-off, here the per-call cost is measured on the actual hardware and
+the gate count is chosen from a latency target.
+"""
+import time
+
+import numpy as np
+
+from .hamamatsu import GATE_TIMES, Hamamatsu
+
+# default display latency target (seconds)
+DEFAULT_LATENCY_TARGET = 0.1
+# upper limit for the number of gates per block (largest value used by the original settings)
+DEFAULT_MAX_GATES = 500
+# time spent measuring each configuration
+DEFAULT_MEASURE_TIME = 0.5
+
+# transfer modes as passed to Hamamatsu.setup()
+MODES = {'SINGLE_TRANSFER': 0, 'BLOCK_TRANSFER': 1}
+
+
+def measure(hardware: Hamamatsu, gates: int, mode: int = 1, measure_time: float = DEFAULT_MEASURE_TIME):
+    """
+    Reads blocks of 'gates' gates for about measure_time seconds (at least 3 blocks, at most 100).
+    Returns (median wall time per call, samples/s).
+    """
+    gate_time = hardware.get_gatetime_data()[2]
+    nblocks = int(np.clip(measure_time / (gates * gate_time), 3, 100))
+
+    hardware.setup(mode=mode, gates=gates)
+    hardware.count_start()
+    try:
+        calls = np.empty(nblocks)
+        t0 = time.perf_counter()
+        for i in range(nblocks):
+            t_call = time.perf_counter()
+            hardware.read_block().release()
+            calls[i] = time.perf_counter() - t_call
+        elapsed = time.perf_counter() - t0
+    finally:
+        hardware.count_stop()
+
+    return float(np.median(calls)), nblocks * gates / elapsed
+
+
+def measure_call_cost(hardware: Hamamatsu, mode: int = 1, measure_time: float = DEFAULT_MEASURE_TIME):
+    """
+    Fits the time per call as 'cost + gates * time_per_gate' from two block sizes and returns the fixed cost per call
+    (seconds, never negative).
+    """
+    base = GATE_TIMES[hardware.gate_time][1]
+    small = max(base // 10, 1)
+    large = max(base, small + 1)
+
+    t_small, _ = measure(hardware, small, mode, measure_time)
+    t_large, _ = measure(hardware, large, mode, measure_time)
+    per_gate = (t_large - t_small) / (large - small)
+    return max(t_small - small * per_gate, 0.0)
+
+
+def choose_gates(gate_time: float, call_cost: float, *, latency_target: float = DEFAULT_LATENCY_TARGET,
+                 max_gates: int = DEFAULT_MAX_GATES):
+    """
+    Largest number of gates whose block duration (plus call cost) fits in the latency target: the whole latency budget
+    is used to amortize the per-call cost.
+    Returns (gates, expected latency in seconds, share of time spent in per-call overhead).
+    """
+    if latency_target <= 0:
+        raise ValueError(f"Latency target must be positive, got {latency_target}")
+
+    gates = int(np.clip((latency_target - call_cost) // gate_time, 1, max_gates))
+    period = gates * gate_time + call_cost
+    return gates, period, call_cost / period
+
+
+def calibrate(hardware: Hamamatsu, gate_time: str, *, latency_target: float = DEFAULT_LATENCY_TARGET,
+              max_gates: int = DEFAULT_MAX_GATES, measure_time: float = DEFAULT_MEASURE_TIME):
+    """
+    Measures the per-call cost at 'gate_time', picks the number of gates and compares SINGLE_TRANSFER and
+    BLOCK_TRANSFER throughput with it. The hardware is left set up with the chosen settings.
+    Returns a dictionary with the chosen settings and the measurements.
+    """
+    hardware.gate_time = gate_time
+    seconds = GATE_TIMES[gate_time][2]
+
+    call_cost = measure_call_cost(hardware, 1, measure_time)
+    gates, latency, overhead = choose_gates(seconds, call_cost, latency_target=latency_target, max_gates=max_gates)
+
+    throughput = {name: measure(hardware, gates, mode, measure_time)[1] for name, mode in MODES.items()}
+    best = max(throughput, key=throughput.get)
+    hardware.setup(mode=MODES[best], gates=gates)
+
+    return {
+        'gate_time': gate_time,
+        'default_gates': GATE_TIMES[gate_time][1],
+        'call_cost_s': call_cost,
+        'gates': gates,
+        'mode': best,
+        'expected_latency_s': latency,
+        'overhead': overhead,
+        'throughput': throughput,
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Choose the gates per block for every gate time.')
+    parser.add_argument('--latency-target', type=float, default=DEFAULT_LATENCY_TARGET, help='seconds')
+    parser.add_argument('--gate-times', nargs='+', choices=list(GATE_TIMES.keys()), default=list(GATE_TIMES.keys()))
+    args = parser.parse_args()
+
+    hw = Hamamatsu.open()
+    try:
+        report = [calibrate(hw, gt, latency_target=args.latency_target) for gt in args.gate_times]
+    finally:
+        hw.close()
+    print(json.dumps(report, indent=2))
@@ -1,10 +1,24 @@
 import os
 import os.path
+import time
 from collections import deque
+from itertools import islice
 
 
 from threading import Lock
 
+import numpy as np
+
+DATAFOLDER = os.path.join(os.path.realpath('.'), 'Data')
+
+
+def build_date():
+    """
+    Current UTC date formatted for log file names.
+    """
+    tt = time.gmtime()
+    return f'{tt.tm_mday:02d}.{tt.tm_mon:02d}.{tt.tm_year - 2000:02d}_{tt.tm_hour:02d}.{tt.tm_min:02d}.{tt.tm_sec:02d}'
+
 
 class SimpleBuffer:
     """
@@ -28,8 +42,8 @@ class SimpleBuffer:
         self._size = size
         self._output_path = output_path
 
-        self.containers = [deque() for _ in keywords]
         self._keywords = keywords
+        self._init_storage()
         # keeps track of how many points we add so that we know when to save
         self._new_points = 0
         # used in iteration
@@ -59,6 +73,21 @@ class SimpleBuffer:
                     self._write_data()
                 self._new_points = 0
 
+    def push_block(self, *columns):
+        """
+        Pushes a whole block of points at once (one sequence per keyword, all of the same length). Equivalent to
+        calling push_back() for each point but takes the lock only once.
+        """
+        with self._lock:
+            self._push_block(columns)
+
+    def snapshot(self):
+        """
+        Returns a copy of the data (one list per keyword), safe to use while other threads keep pushing data.
+        """
+        with self._lock:
+            return [list(container) for container in self.containers]
+
     def is_saving(self):
         return self._save
 
@@ -67,8 +96,10 @@ class SimpleBuffer:
             self._save = status
 
     def close(self):
-        if self._save:
-            self._write_data()
+        with self._lock:
+            if self._save and self._new_points:
+                self._write_data()
+            self._new_points = 0
 
     @property
     def filepath(self):
@@ -92,15 +123,56 @@ class SimpleBuffer:
             raise ValueError(f"Buffer Size must be positive, got {value}")
 
         with self._lock:
+            if self._new_points >= value:
+                # the unsaved points would not fit any more: save them first
+                if self._save:
+                    self._write_data()
+                self._new_points = 0
             self._size = value
             # If necessary shrink the list (left side values go first)
-            while len(self.containers[0]) > self._size:
-                for container in self.containers:
-                    container.popleft()
+            self._trim()
 
     #############
     # INTERNALS #
     #############
+    def _push_block(self, columns):
+        # called with the lock held
+        if len(columns) != len(self._keywords):
+            raise ValueError(f"Not enough columns to push in buffer: got {len(columns)} "
+                             f"required {len(self._keywords)}")
+
+        npoints = len(columns[0])
+        if any(len(column) != npoints for column in columns):
+            raise ValueError("All columns must have the same length")
+
+        start = 0
+        while start < npoints:
+            # never add more points than the ones missing for the next save, or they would be lost from the file
+            # (at least one: the size setter keeps _new_points below _size)
+            stop = min(npoints, start + max(self._size - self._new_points, 1))
+            self._extend(columns, start, stop)
+            self._new_points += stop - start
+            start = stop
+            self._trim()
+
+            if self._new_points >= self._size:
+                if self._save:
+                    self._write_data()
+                self._new_points = 0
+
+    def _init_storage(self):
+        self.containers = [deque() for _ in self._keywords]
+
+    def _extend(self, columns, start, stop):
+        for container, column in zip(self.containers, columns):
+            container.extend(column[start:stop])
+
+    def _trim(self):
+        excess = len(self.containers[0]) - self._size
+        for container in self.containers:
+            for _ in range(excess):
+                container.popleft()
+
     def _write_header(self):
         with open(self._output_path, 'w+') as f_out:
             if self.header_extra:
@@ -112,8 +184,10 @@ class SimpleBuffer:
         if not os.path.isfile(self._output_path):
             self._write_header()
 
+        # only the points added since the last write
+        start = max(len(self.containers[0]) - self._new_points, 0)
         with open(self._output_path, 'a+') as f_out:
-            for data in zip(*self.containers):
+            for data in zip(*[islice(container, start, None) for container in self.containers]):
                 line = ','.join([str(val) for val in data]) + '\n'
                 f_out.write(line)
 
@@ -138,8 +212,196 @@ class SimpleBuffer:
         return ret
 
 
+class RingBuffer(SimpleBuffer):
+    """
+    Same interface (and saving behaviour) as SimpleBuffer, but the data is kept in one typed NumPy array per keyword
+    instead of deques of Python objects: a uint32 column takes 4 bytes per point instead of 30+.
+    Blocks are added with one vectorized copy per column. The valid data is always contiguous, so last() gives views on
+    the last N points without copies: each array has some slack space after the 'size' points, when it fills up the
+    last points are moved back to the beginning of the array (one bulk copy every 'slack' points).
+    Shrinking the buffer is O(1), growing it costs one copy (at the next push).
+    'log' (optional) is an object with write(*columns) and close() methods (e.g. storage.StorageWriter or
+    binlog.BinaryLogWriter), when given every block is handed to it as it comes (the log decides when to write to disk)
+    instead of being appended to the CSV file at output_path every 'size' points.
+    'live' (optional, e.g. livefile.LiveSessionWriter) also gets every block as it comes, saved or not, so that other
+    processes can follow the acquisition.
+    With 'timebase' the first keyword is a time axis that is not stored: the times of each pushed block must be evenly
+    spaced (as the gates of a readout block are), only its first time and step are kept and the times are computed when
+    read (last() then returns a new array for them). A buffer of uint32 counts takes 4 bytes per point (plus slack)
+    instead of 12.
+    """
+    def __init__(self, size: int, output_path: str, keywords: list, *, dtypes: list = None, save: bool = False,
+                 header: str = '', log=None, live=None, timebase: bool = False):
+        if dtypes is None:
+            dtypes = [np.float64] * len(keywords)
+        if len(dtypes) != len(keywords):
+            raise ValueError(f"One dtype per keyword is required: got {len(dtypes)} for {len(keywords)} keywords")
+        if timebase and len(keywords) < 2:
+            raise ValueError("A time base needs at least one keyword besides the time")
+        self._dtypes = [np.dtype(dt) for dt in dtypes]
+        # dtypes of the stored columns
+        self._column_dtypes = self._dtypes[1:] if timebase else self._dtypes
+        self._timebase = timebase
+        self.log = log
+        self.live = live
+
+        super(RingBuffer, self).__init__(size, output_path, keywords, save=save, header=header)
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def push_back(self, *args):
+        self.push_block(*[[val] for val in args])
+
+    def push_block(self, *columns):
+        # the log and the live file get the block under the lock: close() cannot close them in the middle of a write
+        with self._lock:
+            self._push_block(columns)
+            if self.log is not None and self._save:
+                self.log.write(*columns)
+            if self.live is not None:
+                self.live.write(*columns)
+
+    def last(self, npoints: int = None, *, copy: bool = False):
+        """
+        Returns the last 'npoints' points (all of them by default) as one array per keyword.
+        Without copy the arrays are views on the buffer: they are only valid until the next push, so use them from the
+        thread that pushes data (or ask for a copy). The times of a time base are always a new array.
+        """
+        with self._lock:
+            start = self._start if npoints is None else max(self._end - npoints, self._start)
+            views = self._views(start, self._end)
+            if copy:
+                return [view.copy() for view in views]
+            return views
+
+    def snapshot(self):
+        """
+        Returns a copy of the data (one array per keyword), safe to use while other threads keep pushing data.
+        """
+        return self.last(copy=True)
+
+    def close(self):
+        """
+        Saves what is left and closes the log and the live file (if any), which are then detached from the buffer. The
+        blocks pushed afterwards no longer reach them.
+        """
+        super(RingBuffer, self).close()
+        with self._lock:
+            log, self.log = self.log, None
+            live, self.live = self.live, None
+        # no write is in progress any more (see push_block), closing may take a while: not under the lock
+        if log is not None:
+            log.close()
+        if live is not None:
+            live.close()
+
+    @property
+    def containers(self):
+        return self._views(self._start, self._end)
+
+    @property
+    def nbytes(self):
+        """
+        Memory allocated for the data (slack space included, and the first time and step of each block of a time base).
+        """
+        return sum(column.nbytes for column in self._columns) + 3 * 8 * len(self._blocks)
+
+    #############
+    # INTERNALS #
+    #############
+    def _init_storage(self):
+        self._slack = max(self._size // 4, 1)
+        self._columns = [np.empty(self._size + self._slack, dtype=dt) for dt in self._column_dtypes]
+        # valid data is column[_start:_end]
+        self._start = 0
+        self._end = 0
+        # points pushed so far: column[_end - 1] is point number _pushed - 1
+        self._pushed = 0
+        # time base: (number of the first point, first time, step) of each block still (partly) in the buffer
+        self._blocks = deque()
+
+    def _extend(self, columns, start, stop):
+        npoints = stop - start
+        if self._end + npoints > self._columns[0].shape[0]:
+            self._make_room(npoints)
+        if self._timebase:
+            times, columns = columns[0], columns[1:]
+            # from the first and last times: the rounding errors of the times do not add up along the block
+            step = (times[stop - 1] - times[start]) / (npoints - 1) if npoints > 1 else 0.0
+            self._blocks.append((self._pushed, float(times[start]), float(step)))
+        for column, values in zip(self._columns, columns):
+            column[self._end:self._end + npoints] = values[start:stop]
+        self._end += npoints
+        self._pushed += npoints
+
+    def _make_room(self, npoints):
+        # points to keep (the new ones will push out the oldest)
+        keep = min(self._end - self._start, self._size - npoints)
+        if self._size + self._slack > self._columns[0].shape[0]:
+            # the buffer was enlarged: reallocate
+            self._slack = max(self._size // 4, 1)
+            new_columns = [np.empty(self._size + self._slack, dtype=dt) for dt in self._column_dtypes]
+            for new, column in zip(new_columns, self._columns):
+                new[:keep] = column[self._end - keep:self._end]
+            self._columns = new_columns
+        else:
+            for column in self._columns:
+                column[:keep] = column[self._end - keep:self._end]
+        self._start = 0
+        self._end = keep
+
+    def _trim(self):
+        self._start = max(self._start, self._end - self._size)
+        first = self._pushed - (self._end - self._start)
+        while len(self._blocks) > 1 and self._blocks[1][0] <= first:
+            self._blocks.popleft()
+
+    def _views(self, start, stop):
+        # one array per keyword for column[start:stop]
+        views = [column[start:stop] for column in self._columns]
+        if self._timebase:
+            views.insert(0, self._times(start, stop))
+        return views
+
+    def _times(self, start, stop):
+        if stop <= start:
+            return np.zeros(0)
+        index = self._pushed - (self._end - start) + np.arange(stop - start)
+        first, t_start, step = (np.array(values) for values in zip(*self._blocks))
+        block = np.searchsorted(first, index, side='right') - 1
+        return t_start[block] + (index - first[block]) * step[block]
+
+    def _write_data(self):
+        if self.log is not None:
+            # the log already got every block (see push_block)
+            return
+
+        if not os.path.isfile(self._output_path):
+            self._write_header()
+
+        # only the points added since the last write
+        start = max(self._end - self._new_points, self._start)
+        data = self._views(start, self._end)
+        fmt = ['%d' if dt.kind in 'iub' else '%.12g' for dt in self._dtypes]
+        with open(self._output_path, 'a+') as f_out:
+            np.savetxt(f_out, np.column_stack(data), fmt=fmt, delimiter=',')
+
+    def __str__(self):
+        return self.containers.__str__()
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [column[item] for column in self._views(self._start, self._end)]
+        # a single point: only its time is computed
+        pos = range(self._start, self._end)[item]
+        return [column[0] for column in self._views(pos, pos + 1)]
+
+
 if __name__ == '__main__':
-    import numpy as np
     # generate a container
     cc = SimpleBuffer(100, '', ['time', 'counts'])
 
@@ -158,3 +420,15 @@ if __name__ == '__main__':
     # generate some data
     for i in range(200):
         cc.push_back(i, np.random.rand())
+
+    # array backed version, whole blocks at once
+    rb = RingBuffer(100, './test_ring.out', ['time', 'counts'], dtypes=[np.float64, np.uint32], save=True)
+    for i in range(10):
+        rb.push_block(np.arange(i * 50, (i + 1) * 50) * 1e-3, np.random.poisson(20, 50))
+    print(len(rb), rb.last(5), f'{rb.nbytes / rb.size:.1f} bytes per point')
+
+    # only the counts are stored, the times come from the first time and step of each block
+    rb = RingBuffer(100, './test_ring.out', ['time', 'counts'], dtypes=[np.float64, np.uint32], timebase=True)
+    for i in range(10):
+        rb.push_block(np.arange(i * 50, (i + 1) * 50) * 1e-3, np.random.poisson(20, 50))
+    print(len(rb), rb.last(5), f'{rb.nbytes / rb.size:.1f} bytes per point')
@@ -0,0 +1,203 @@
+"""
+Headless acquisition (no Qt): connects to the counting unit, sets the gate time, powers the PMT on, acquires for a given
+duration (or number of samples) streaming the data to disk, then powers off. Meant for long unattended runs.
+
+    python -m PhotonCounter --gate-time 1MS --duration 3600
+    python -m PhotonCounter --gate-time 100US --samples 1000000 --output run.csv
+    python -m PhotonCounter --gate-time 50US --duration 3600 --format binary --compression zlib
+    python -m PhotonCounter --gate-time 1MS --duration 86400 --rotate-time 3600
+    python -m PhotonCounter --gate-time 1MS --duration 3600 --live
+    python -m PhotonCounter --replay Data/log_01.01.24_10.00.00.bpc --replay-speed 0 --samples 1000000
+"""
+import argparse
+import logging
+import os.path
+import sys
+import time
+
+import numpy as np
+
+from . import hamamatsu, replaylib
+from .hamamatsu import GATE_TIMES, Hamamatsu
+from .buffer import DATAFOLDER, RingBuffer, build_date
+from .binlog import CODECS, EXTENSION, BinaryLogWriter
+from .livefile import EXTENSION as LIVE_EXTENSION, LiveSessionWriter
+from .storage import (DEFAULT_FLUSH_INTERVAL, DEFAULT_FSYNC_INTERVAL, DURABILITY_LEVELS, MANIFEST_SUFFIX, CsvLogWriter,
+                      RotatingLog, StorageWriter)
+from .blocksize import calibrate
+
+# number of samples kept in memory between two writes to disk
+DEFAULT_FLUSH_SIZE = 10000
+# columns written to the log
+KEYWORDS = ['Time', 'Counts']
+DTYPES = [np.float64, np.uint32]
+
+
+def acquire(hardware: Hamamatsu, buffer: RingBuffer, *, duration: float = None, samples: int = None):
+    """
+    Reads blocks from a counting unit (already set up and powered) into 'buffer' until 'duration' seconds have elapsed
+    or 'samples' samples have been read (whichever comes first, at least one must be given). Ctrl-C stops the
+    acquisition cleanly. Returns the number of samples acquired.
+    """
+    if duration is None and samples is None:
+        raise ValueError("Either duration or samples must be given")
+
+    acquired = 0
+    hardware.count_start()
+    t_end = time.monotonic() + duration if duration is not None else None
+    try:
+        while True:
+            if t_end is not None and time.monotonic() >= t_end:
+                break
+            if samples is not None and acquired >= samples:
+                break
+
+            with hardware.read_block() as block:
+                # do not go past the requested number of samples
+                npoints = len(block) if samples is None else min(len(block), samples - acquired)
+                buffer.push_block(block.times[:npoints], block.data[:npoints])
+                acquired += npoints
+
+                if block.gap:
+                    logging.warning(f'Lost {block.gap} data block(s) before block {block.seq}')
+    except KeyboardInterrupt:
+        logging.info('Acquisition interrupted by user')
+    finally:
+        hardware.count_stop()
+    return acquired
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='BaLi Photon Counter - headless acquisition.')
+    parser.add_argument('--gate-time', choices=list(GATE_TIMES.keys()), default=None,
+                        help='hardware gate time (default: 100MS, or the recorded one with --replay)')
+    stop = parser.add_mutually_exclusive_group(required=True)
+    stop.add_argument('--duration', type=float, help='acquisition time in seconds')
+    stop.add_argument('--samples', type=int, help='number of samples to acquire')
+    parser.add_argument('--output', default='', help='output file (default: Data/log_<date>.csv or .bpc)')
+    parser.add_argument('--format', choices=['csv', 'binary'], default='csv',
+                        help='output format (binary: see PhotonCounter.binlog)')
+    parser.add_argument('--compression', choices=CODECS, default='none', help='chunk compression (binary format)')
+    parser.add_argument('--compression-level', type=int, default=None, help='lower is faster')
+    parser.add_argument('--flush-size', type=int, default=DEFAULT_FLUSH_SIZE,
+                        help='samples kept in memory between writes to disk')
+    parser.add_argument('--flush-bytes', type=int, default=None, help='also write to disk after this many bytes')
+    parser.add_argument('--flush-interval', type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help='also write to disk after this many seconds')
+    parser.add_argument('--durability', choices=DURABILITY_LEVELS, default='none',
+                        help='when the log is synced to disk: never explicitly, periodically or after every write')
+    parser.add_argument('--fsync-interval', type=float, default=DEFAULT_FSYNC_INTERVAL,
+                        help='seconds between syncs with --durability periodic')
+    parser.add_argument('--rotate-size', type=float, default=None,
+                        help='start a new log segment after this many MB (see PhotonCounter.storage.RotatingLog)')
+    parser.add_argument('--rotate-time', type=float, default=None,
+                        help='start a new log segment after this many seconds of data')
+    parser.add_argument('--live', nargs='?', const='', default=None,
+                        help='also publish the samples in a memory-mapped file other processes can follow '
+                             '(default: the output file with a .live extension, see PhotonCounter.livefile)')
+    parser.add_argument('--single-transfer', action='store_true', help='use SINGLE_TRANSFER instead of BLOCK_TRANSFER')
+    parser.add_argument('--latency-target', type=float, default=None,
+                        help='choose gates per block and transfer mode from this latency (seconds)')
+    parser.add_argument('--replay', default=None, help='read from a recorded session instead of the hardware')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='1: recorded pace, N: N times faster, 0: as fast as possible')
+    parser.add_argument('--log-level', default='INFO', help='logging level')
+    args = parser.parse_args(argv)
+    if args.compression != 'none' and args.format != 'binary':
+        parser.error('--compression requires --format binary')
+    return args
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    logging.basicConfig(format="[%(asctime)s] [%(levelname)s] %(message)s", level=args.log_level.upper())
+
+    if args.replay is not None:
+        try:
+            replaylib.configure(path=args.replay, speed=args.replay_speed)
+            recorded = replaylib.recorded_gate_time()
+        except (OSError, ValueError) as e:
+            logging.error(f'Cannot replay {args.replay}. Msg: {str(e)}')
+            return 1
+        hamamatsu.set_library(replaylib)
+        if args.gate_time is None:
+            args.gate_time = next((name for name, (_, _, seconds) in GATE_TIMES.items()
+                                   if np.isclose(seconds, recorded)), None)
+            if args.gate_time is None:
+                logging.error(f'{args.replay} was recorded with an unsupported gate time ({recorded}s)')
+                return 1
+    elif args.gate_time is None:
+        args.gate_time = '100MS'
+
+    extension = EXTENSION if args.format == 'binary' else '.csv'
+    output = args.output or os.path.join(DATAFOLDER, f'log_{build_date()}{extension}')
+
+    try:
+        hardware = Hamamatsu.open()
+    except ValueError as e:
+        logging.error(str(e))
+        return 1
+    logging.info(f'Detected hardware uid: {hardware.uid}.')
+
+    # disk writes happen on the storage writer thread, the acquisition loop only copies the data
+    gate_time = GATE_TIMES[args.gate_time][2]
+
+    def make_sink(path):
+        if args.format == 'binary':
+            return BinaryLogWriter(path, gate_time=gate_time, uid=hardware.uid, codec=args.compression,
+                                   level=args.compression_level)
+        return CsvLogWriter(path, KEYWORDS, dtypes=DTYPES, header=f"# GATE TIME {args.gate_time}.")
+
+    if args.rotate_size is not None or args.rotate_time is not None:
+        base, extension = os.path.splitext(output)
+        sink = RotatingLog(base, make_sink, extension=extension, gate_time=gate_time,
+                           max_bytes=int(1e6 * args.rotate_size) if args.rotate_size is not None else None,
+                           max_duration=args.rotate_time)
+        output = sink.manifest_path
+    else:
+        sink = make_sink(output)
+    log = StorageWriter(sink, dtypes=DTYPES, flush_samples=args.flush_size, flush_bytes=args.flush_bytes,
+                        flush_interval=args.flush_interval, durability=args.durability,
+                        fsync_interval=args.fsync_interval)
+    live = None
+    if args.live is not None:
+        live_path = args.live or os.path.splitext(output.replace(MANIFEST_SUFFIX, ''))[0] + LIVE_EXTENSION
+        live = LiveSessionWriter(live_path, KEYWORDS, dtypes=DTYPES, gate_time=gate_time, uid=hardware.uid)
+        logging.info(f'Publishing the samples in {live_path}.')
+    buffer = RingBuffer(args.flush_size, output, KEYWORDS, dtypes=DTYPES, save=True, log=log, live=live)
+
+    try:
+        hardware.gate_time = args.gate_time
+        if args.latency_target is not None:
+            settings = calibrate(hardware, args.gate_time, latency_target=args.latency_target)
+            logging.info(f"Using {settings['gates']} gates per block with {settings['mode']} "
+                         f"(call cost {1e3 * settings['call_cost_s']:.2f}ms, "
+                         f"expected latency {1e3 * settings['expected_latency_s']:.1f}ms).")
+        else:
+            hardware.setup(mode=0 if args.single_transfer else 1)
+        hardware.set_power(True)
+        logging.info(f'Acquiring with gate time {args.gate_time} into {output}.')
+
+        t0 = time.monotonic()
+        acquired = acquire(hardware, buffer, duration=args.duration, samples=args.samples)
+        elapsed = time.monotonic() - t0
+    except (RuntimeError, TimeoutError) as e:
+        logging.error(str(e))
+        return 1
+    finally:
+        buffer.close()
+        if hardware.is_powered:
+            hardware.set_power(False)
+        hardware.close()
+
+    logging.info(f'Acquired {acquired} samples in {elapsed:.1f}s ({hardware.blocks_lost} lost blocks, '
+                 f'{hardware.blocks_late} late blocks).')
+    stats = log.stats
+    logging.info(f"Storage: {stats['flushes']} writes, p99 write latency {stats['write_latency_p99_ms'] or 0.0:.1f}ms, "
+                 f"max backlog {stats['max_backlog_buffers']} buffer(s), {stats['samples_dropped']} samples dropped, "
+                 f"{stats['syncs']} syncs ({stats['sync_time_s']:.2f}s).")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
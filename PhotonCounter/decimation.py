@@ -0,0 +1,233 @@
+"""
+Module implements peak preserving (min/max) decimation of the displayed data: a long display window is reduced to about
+one bin per pixel of the plot, each bin drawn as a vertical segment from its minimum to its maximum, so that no spike
+disappears however many samples a pixel covers.
+
+minmax() decimates arrays in one pass (for windows of up to a few hundred thousand points). MinMaxPyramid is fed with
+the acquired blocks and maintains the bins incrementally at several resolutions: level 0 has one bin per 'base'
+samples, each level above groups 'factor' bins of the level below. Any window is then read from the finest level that
+has no more bins than requested, in a time independent of the number of samples it covers. Each level only keeps its
+most recent bins (the older ones are summarized by the levels above): the memory used grows with the number of levels
+(the logarithm of the number of samples), not with the number of samples.
+"""
+import threading as th
+
+import numpy as np
+
+# samples per bin of the finest level, bins of a level per bin of the next one
+DEFAULT_BASE = 64
+DEFAULT_FACTOR = 4
+# most recent bins kept per level (a window is read with at most this many bins from the finest level it fits in)
+DEFAULT_LEVEL_BINS = 1 << 15
+
+
+def minmax(x, y, nbins: int):
+    """
+    Splits the points in 'nbins' bins of consecutive points, returns the x of the first point, the minimum and the
+    maximum of each bin.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    size = -(-x.shape[0] // nbins)
+    nfull = x.shape[0] // size
+    t = x[::size]
+    ymin = np.empty(t.shape[0], dtype=y.dtype)
+    ymax = np.empty(t.shape[0], dtype=y.dtype)
+    ymin[:nfull] = y[:nfull * size].reshape(nfull, size).min(axis=1)
+    ymax[:nfull] = y[:nfull * size].reshape(nfull, size).max(axis=1)
+    if nfull < t.shape[0]:
+        ymin[-1] = y[nfull * size:].min()
+        ymax[-1] = y[nfull * size:].max()
+    return t, ymin, ymax
+
+
+def envelope(t, ymin, ymax):
+    """
+    Points to draw the bins as vertical segments (x repeated, y alternating between minimum and maximum).
+    """
+    return np.repeat(t, 2), np.column_stack((ymin, ymax)).ravel()
+
+
+class _Level:
+    """
+    Bins of one level: start time, minimum, maximum and sum of the samples (growable arrays of about 2 * max_bins bins:
+    the oldest bins are then dropped, down to max_bins).
+    """
+    def __init__(self, max_bins, capacity=1024):
+        self.max_bins = max_bins
+        self.columns = [np.empty(min(capacity, 2 * max_bins)) for _ in range(4)]
+        self.npoints = 0
+        # bins already grouped into the next level (only those can be dropped)
+        self.grouped = 0
+        # bins dropped so far
+        self.dropped = 0
+
+    def append(self, t, ymin, ymax, ysum):
+        npoints = t.shape[0]
+        if self.npoints + npoints > 2 * self.max_bins:
+            drop = min(self.npoints + npoints - self.max_bins, self.grouped)
+            for column in self.columns:
+                column[:self.npoints - drop] = column[drop:self.npoints]
+            self.npoints -= drop
+            self.grouped -= drop
+            self.dropped += drop
+        if self.npoints + npoints > self.columns[0].shape[0]:
+            capacity = max(min(2 * self.columns[0].shape[0], 2 * self.max_bins), self.npoints + npoints)
+            self.columns = [np.concatenate((column[:self.npoints], np.empty(capacity - self.npoints)))
+                            for column in self.columns]
+        for column, values in zip(self.columns, (t, ymin, ymax, ysum)):
+            column[self.npoints:self.npoints + npoints] = values
+        self.npoints += npoints
+
+    @property
+    def t(self):
+        return self.columns[0][:self.npoints]
+
+    def bins(self, start, stop):
+        return [column[start:stop] for column in self.columns]
+
+
+class MinMaxPyramid:
+    """
+    Min/max pyramid of a signal, fed block by block with push() (each sample is touched once per level it reaches:
+    O(1) amortized per sample), read with window() (O(number of bins returned)). push() and window() can be called
+    from different threads.
+    Memory: at most 64 * level_bins bytes per level (2MB with the defaults), one level per factor of 4 (the default)
+    samples beyond 'base': e.g. 13 levels for 24h at a 50us gate time.
+    """
+    def __init__(self, *, base: int = DEFAULT_BASE, factor: int = DEFAULT_FACTOR, level_bins: int = DEFAULT_LEVEL_BINS):
+        if base < 1 or factor < 2:
+            raise ValueError(f"Base must be at least 1 and factor at least 2, got {base} and {factor}")
+        if level_bins < factor:
+            raise ValueError(f"Each level must keep at least {factor} bins, got {level_bins}")
+        self.base = base
+        self.factor = factor
+        self.level_bins = level_bins
+        self._lock = th.Lock()
+        self.clear()
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def push(self, x, y):
+        """
+        Adds samples: 'x' (times, increasing) and 'y' sequences of the same length.
+        """
+        with self._lock:
+            self._samples += len(x)
+            x = np.concatenate((self._pending_x, np.asarray(x, dtype=float)))
+            y = np.concatenate((self._pending_y, np.asarray(y, dtype=float)))
+            nfull = x.shape[0] // self.base
+            if nfull:
+                xs = x[:nfull * self.base:self.base]
+                ys = y[:nfull * self.base].reshape(nfull, self.base)
+                self._append(0, xs, ys.min(axis=1), ys.max(axis=1), ys.sum(axis=1))
+            # copies: the pending samples must not keep the whole block alive
+            self._pending_x = x[nfull * self.base:].copy()
+            self._pending_y = y[nfull * self.base:].copy()
+
+    def window(self, t_start: float, t_stop: float = None, max_bins: int = 1000):
+        """
+        Bins of the samples with t_start <= time < t_stop (t_stop None: up to the last sample) from the finest level
+        with at most 'max_bins' bins in the window (bins straddling t_start included) that still has the bins of
+        t_start. Returns arrays of start times, minima, maxima and means of the bins (the last one may be partial),
+        empty arrays if there is no data.
+        """
+        with self._lock:
+            for k, level in enumerate(self._levels):
+                t = level.t
+                start = max(int(np.searchsorted(t, t_start, side='right')) - 1, 0)
+                stop = int(np.searchsorted(t, t_stop, side='left')) if t_stop is not None else level.npoints
+                # the last level keeps all its bins
+                covered = level.dropped == 0 or t[0] <= t_start
+                if covered and stop - start <= max_bins or k == len(self._levels) - 1:
+                    break
+            else:
+                # not even a full bin yet
+                k, start, stop = -1, 0, 0
+
+            if k >= 0:
+                t, ymin, ymax, ysum = [values.copy() for values in self._levels[k].bins(start, stop)]
+                mean = ysum / (self.base * self.factor ** k)
+            else:
+                t = ymin = ymax = mean = np.zeros(0)
+
+            # what is not in a bin of level k yet (if the window goes up to there)
+            tail = self._tail(k)
+            if tail is not None and (t_stop is None or tail[0] < t_stop) and (k < 0 or stop == self._levels[k].npoints):
+                t, ymin, ymax, mean = [np.append(values, value) for values, value in zip((t, ymin, ymax, mean), tail)]
+            return t, ymin, ymax, mean
+
+    def clear(self):
+        """
+        Drops all the samples, e.g. before a new acquisition restarts the time axis.
+        """
+        with self._lock:
+            self._levels = []
+            self._pending_x = np.zeros(0)
+            self._pending_y = np.zeros(0)
+            self._samples = 0
+
+    @property
+    def levels(self):
+        return len(self._levels)
+
+    def __len__(self):
+        return self._samples
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for level in self._levels for column in level.columns)
+
+    #############
+    # INTERNALS #
+    #############
+    def _append(self, k, t, ymin, ymax, ysum):
+        if k == len(self._levels):
+            self._levels.append(_Level(self.level_bins))
+        level = self._levels[k]
+        level.append(t, ymin, ymax, ysum)
+
+        # group the complete sets of 'factor' bins into the next level
+        ngroups = (level.npoints - level.grouped) // self.factor
+        if ngroups == 0:
+            return
+        t, ymin, ymax, ysum = level.bins(level.grouped, level.grouped + ngroups * self.factor)
+        level.grouped += ngroups * self.factor
+        self._append(k + 1,
+                     t[::self.factor],
+                     ymin.reshape(ngroups, self.factor).min(axis=1),
+                     ymax.reshape(ngroups, self.factor).max(axis=1),
+                     ysum.reshape(ngroups, self.factor).sum(axis=1))
+
+    def _tail(self, k):
+        # (start time, minimum, maximum, mean) of the samples not in a bin of level k, None if there are none
+        parts = [(self._pending_x[:1], self._pending_y.min(initial=np.inf), self._pending_y.max(initial=-np.inf),
+                  self._pending_y.sum(), self._pending_x.shape[0])] if self._pending_x.shape[0] else []
+        for j in range(k):
+            level = self._levels[j]
+            if level.grouped < level.npoints:
+                t, ymin, ymax, ysum = level.bins(level.grouped, level.npoints)
+                parts.append((t[:1], ymin.min(), ymax.max(), ysum.sum(), t.shape[0] * self.base * self.factor ** j))
+        if not parts:
+            return None
+        npoints = sum(part[4] for part in parts)
+        return (min(part[0][0] for part in parts), min(part[1] for part in parts), max(part[2] for part in parts),
+                sum(part[3] for part in parts) / npoints)
+
+
+if __name__ == '__main__':
+    import time
+
+    # one hour of a 50us gate time acquisition
+    pyramid = MinMaxPyramid()
+    t0 = time.perf_counter()
+    for i in range(3600):
+        pyramid.push(np.arange(i * 20000, (i + 1) * 20000) * 50e-6, np.random.poisson(20, 20000))
+    dt = time.perf_counter() - t0
+    print(f'{len(pyramid)} samples in {dt:.2f}s: {pyramid.levels} levels, {pyramid.nbytes / 2**20:.0f}MB')
+    for display_time in (1.0, 60.0, 3600.0):
+        t0 = time.perf_counter()
+        t, ymin, ymax, ymean = pyramid.window(3600.0 - display_time, None, 2000)
+        print(f'last {display_time:g}s: {len(t)} bins from {ymin.min():g} to {ymax.max():g} counts '
+              f'in {1e3 * (time.perf_counter() - t0):.2f}ms')
@@ -0,0 +1,302 @@
+"""
+Module implements multi-hardware support. A DeviceManager opens and configures several counting units, runs one readout
+thread per unit and merges the blocks coming from all units into a single multi-channel stream.
+"""
+from collections import deque
+import logging
+import threading as th
+
+import numpy as np
+
+from .hamamatsu import MAX_HANDLES, Hamamatsu, minit
+
+# number of blocks a unit may run ahead of the slowest one before the slow unit is skipped (its channel is marked as
+# not valid in the merged block) so that it cannot stall the others
+DEFAULT_MAX_LAG = 4
+# per-unit queue length, when full the oldest block is dropped
+DEFAULT_QUEUE_SIZE = 32
+
+
+class MergedBlock:
+    """
+    One time-aligned block of data from all counting units. 'counts' has shape (units, gates), row i holds the data of
+    the i-th unit (same order as DeviceManager.devices). 'valid[i]' is False if unit i did not deliver this block in
+    time (the corresponding row is zero).
+    Gate times are taken from the first valid unit (see hamamatsu.ReadoutBuffer).
+    """
+    def __init__(self, seq: int, counts, valid, t_start: float, gate_time: float):
+        self.seq = seq
+        self.counts = counts
+        self.valid = valid
+        self.t_start = t_start
+        self.gate_time = gate_time
+
+    @property
+    def times(self):
+        return self.t_start + np.arange(self.counts.shape[1]) * self.gate_time
+
+    def __len__(self):
+        return self.counts.shape[1]
+
+
+class _UnitWorker:
+    """
+    Readout thread for a single counting unit. Blocks are tagged with a per-unit block index and queued for the merger.
+    """
+    def __init__(self, index: int, device: Hamamatsu, manager):
+        self.index = index
+        self.device = device
+        self.queue = deque()
+        self.alive = False
+        self.blocks_read = 0
+        self.blocks_dropped = 0
+
+        self._manager = manager
+        self._thread = th.Thread(name=f'Data Reader {device.uid}', target=self._run, daemon=True)
+
+    def start(self):
+        self.alive = True
+        self._thread.start()
+
+    def join(self, timeout):
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    def _run(self):
+        seq = 0
+        halt = self._manager.halt_event
+        while not halt.is_set():
+            try:
+                block = self.device.read_block()
+            except (RuntimeError, TimeoutError) as e:
+                logging.error(f'Readout of unit {self.device.uid} failed. Msg: {str(e)}')
+                break
+
+            with self._manager.cond:
+                if len(self.queue) >= self._manager.queue_size:
+                    _, old = self.queue.popleft()
+                    old.release()
+                    self.blocks_dropped += 1
+                self.queue.append((seq, block))
+                self.blocks_read += 1
+                self._manager.cond.notify()
+            seq += 1
+
+        with self._manager.cond:
+            self.alive = False
+            self._manager.cond.notify()
+        logging.info(f'Readout of unit {self.device.uid} completed')
+
+
+class DeviceManager:
+    """
+    Drives N counting units as one acquisition. All units share the same gate time (and number of gates) so that block
+    k of every unit covers the same time interval, the k-th merged block is made of the k-th block of each unit.
+    Each unit is read by its own thread: a slow unit does not delay the reads of the others, and once it lags more than
+    'max_lag' blocks behind its blocks are skipped (flagged in MergedBlock.valid) instead of stalling the stream.
+    """
+    def __init__(self, devices: list, *, max_lag: int = DEFAULT_MAX_LAG, queue_size: int = DEFAULT_QUEUE_SIZE):
+        if not devices:
+            raise ValueError("At least 1 device must be given")
+        if max_lag <= 0:
+            raise ValueError(f"Max lag must be positive, got {max_lag}")
+        if queue_size <= max_lag:
+            raise ValueError(f"Queue size must be larger than max lag, got {queue_size}")
+
+        self.devices = devices
+        self.max_lag = max_lag
+        self.queue_size = queue_size
+
+        self.cond = th.Condition()
+        self.halt_event = th.Event()
+
+        self._workers = []
+        self._merger = None
+        self._callback = None
+        # merged stream state
+        self._next_seq = 0
+        self.blocks_merged = 0
+        self.blocks_skipped = 0
+        self.blocks_late = 0
+        # merged block slots dropped by every unit (queues full)
+        self.blocks_lost = 0
+
+    #######################
+    # CLIENT SIDE FACTORY #
+    #######################
+    @classmethod
+    def open(cls, max_units: int = MAX_HANDLES, **kwargs):
+        """
+        Opens every connected counting unit (up to max_units).
+        """
+        return cls(minit(max_units), **kwargs)
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def setup(self, gate_time: str, mode: int = 1):
+        for device in self.devices:
+            device.gate_time = gate_time
+            device.setup(mode=mode)
+
+    def set_power(self, status: bool):
+        for device in self.devices:
+            device.set_power(status)
+
+    def start(self, callback):
+        """
+        Starts counting on every unit and the readout threads. 'callback' is called (from the merger thread) with each
+        MergedBlock.
+        """
+        if self.is_running:
+            raise RuntimeError('Acquisition already running')
+
+        self._callback = callback
+        self._next_seq = 0
+        self.halt_event.clear()
+        self._workers = [_UnitWorker(i, device, self) for i, device in enumerate(self.devices)]
+
+        for device in self.devices:
+            device.count_start()
+        for worker in self._workers:
+            worker.start()
+
+        self._merger = th.Thread(name='Data Merger', target=self._merge, daemon=True)
+        self._merger.start()
+
+    def stop(self, timeout: float = 1.0):
+        """
+        Stops readout threads and counting. Returns False if some thread did not stop within timeout.
+        """
+        self.halt_event.set()
+        with self.cond:
+            self.cond.notify_all()
+
+        stopped = all([worker.join(timeout) for worker in self._workers])
+        if self._merger is not None:
+            self._merger.join(timeout)
+            stopped = stopped and not self._merger.is_alive()
+
+        for device in self.devices:
+            if device.is_counting:
+                device.count_stop()
+
+        # give back the buffers still in the queues
+        with self.cond:
+            for worker in self._workers:
+                while worker.queue:
+                    worker.queue.popleft()[1].release()
+        return stopped
+
+    def close(self):
+        for device in self.devices:
+            device.close()
+
+    @property
+    def is_running(self):
+        return self._merger is not None and self._merger.is_alive()
+
+    @property
+    def num_channels(self):
+        return len(self.devices)
+
+    @property
+    def stats(self):
+        with self.cond:
+            return {
+                'merged': self.blocks_merged,
+                'skipped': self.blocks_skipped,
+                'late': self.blocks_late,
+                'lost': self.blocks_lost,
+                'read': [w.blocks_read for w in self._workers],
+                'dropped': [w.blocks_dropped for w in self._workers],
+                'queued': [len(w.queue) for w in self._workers],
+            }
+
+    #############
+    # INTERNALS #
+    #############
+    def _merge(self):
+        while True:
+            with self.cond:
+                blocks = self._collect()
+                while blocks is None and not self.halt_event.is_set():
+                    self.cond.wait()
+                    blocks = self._collect()
+                if blocks is None:
+                    break
+
+            merged = self._build(blocks)
+            self._callback(merged)
+
+    def _collect(self):
+        """
+        Must be called with self.cond held. Pops the blocks making up the next merged block, returns None if it's not
+        ready yet.
+        """
+        workers = [w for w in self._workers if w.alive or w.queue]
+        if not workers:
+            return None
+
+        # discard blocks older than the next sequence number (arrived after their slot was skipped)
+        for w in workers:
+            while w.queue and w.queue[0][0] < self._next_seq:
+                w.queue.popleft()[1].release()
+                self.blocks_late += 1
+
+        # the blocks of the next slot were dropped (queue full) by every unit that had them: skip to the oldest queued
+        heads = [w.queue[0][0] for w in workers if w.queue]
+        if heads and min(heads) > self._next_seq:
+            lost = min(heads) - self._next_seq
+            self.blocks_lost += lost
+            logging.warning(f'Lost {lost} merged block(s) before block {min(heads)} (queues full)')
+            self._next_seq = min(heads)
+
+        ready = [bool(w.queue) and w.queue[0][0] == self._next_seq for w in self._workers]
+        if not any(ready):
+            return None
+
+        if not all(ready):
+            # wait for the slow units unless the others are too far ahead (or the slow ones are gone)
+            lag = max(len(w.queue) for w in self._workers)
+            waiting = [w for w, rr in zip(self._workers, ready) if not rr and w.alive]
+            if waiting and lag <= self.max_lag:
+                return None
+            self.blocks_skipped += len(waiting)
+
+        blocks = [w.queue.popleft()[1] if rr else None for w, rr in zip(self._workers, ready)]
+        self._next_seq += 1
+        self.blocks_merged += 1
+        return blocks
+
+    def _build(self, blocks):
+        gates = max(len(b) for b in blocks if b is not None)
+        counts = np.zeros((len(blocks), gates), dtype=np.uint32)
+        valid = np.zeros(len(blocks), dtype=bool)
+        reference = next(b for b in blocks if b is not None)
+        t_start, gate_time = reference.t_start, reference.gate_time
+        for i, block in enumerate(blocks):
+            if block is None:
+                continue
+            with block:
+                counts[i] = block.data
+            valid[i] = True
+
+        return MergedBlock(self._next_seq - 1, counts, valid, t_start, gate_time)
+
+
+if __name__ == '__main__':
+    import time
+
+    manager = DeviceManager.open()
+    print(f'Opened {manager.num_channels} units: {[d.uid for d in manager.devices]}')
+    manager.setup('100MS')
+    manager.set_power(True)
+
+    manager.start(lambda mb: print(mb.seq, mb.valid, mb.counts.sum(axis=1)))
+    time.sleep(2.0)
+    manager.stop()
+    print(manager.stats)
+
+    manager.set_power(False)
+    manager.close()
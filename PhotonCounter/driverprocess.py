@@ -0,0 +1,516 @@
+"""
+Module implements a process-isolated hardware driver. The counting unit is opened and read by a dedicated child process
+that writes each block into a shared-memory ring buffer, the parent (GUI) process maps the same memory and reads the
+blocks without copies. The readout no longer competes for the GIL with the plot rendering, and a driver call that hangs
+can be dealt with by killing the child process (see DriverProcess.kill() and restart()) without freezing the UI.
+
+DriverProcess has the same client interface as hamamatsu.Hamamatsu so it can be used in its place.
+"""
+from multiprocessing import shared_memory
+import logging
+import multiprocessing as mp
+import threading as th
+import time
+
+import numpy as np
+
+from .hamamatsu import GATE_TIMES, Hamamatsu
+
+# number of blocks held by the ring buffer: a consumer lagging more than this many blocks loses data
+DEFAULT_RING_BLOCKS = 256
+# seconds to wait for the child process to execute a command
+DEFAULT_CALL_TIMEOUT = 5.0
+
+_HEADER_DTYPE = np.dtype([
+    ('write_index', np.int64),   # number of blocks written so far (next block goes in slot write_index % capacity)
+    ('capacity', np.int64),
+    ('gates', np.int64),
+    ('heartbeat', np.float64),   # time.time() of the last successful read
+    ('pid', np.int64),
+])
+
+_SLOT_DTYPE = np.dtype([
+    ('index', np.int64),         # ring index of the block held by the slot (-1 if empty)
+    ('seq', np.int64),
+    ('t_recv', np.float64),
+    ('t_start', np.float64),
+    ('gate_time', np.float64),
+    ('gap', np.int64),
+    ('late', np.bool_),
+])
+
+
+class SharedRing:
+    """
+    Single producer / single consumer ring of data blocks in shared memory. Layout: header, one metadata record per
+    slot, then a (capacity, gates) uint32 data array. The producer fills a slot and then increments the write index,
+    so a consumer never sees a partially written block. A consumer holding a view on a slot for more than 'capacity'
+    blocks will see it overwritten: RingBlock.valid tells whether that happened.
+    """
+    def __init__(self, capacity: int, gates: int, *, name: str = None):
+        if capacity <= 0 or gates <= 0:
+            raise ValueError(f"Capacity and gates must be positive, got {capacity} and {gates}")
+
+        size = _HEADER_DTYPE.itemsize + capacity * (_SLOT_DTYPE.itemsize + 4 * gates)
+        self._owner = name is None
+        if self._owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        buf = self.shm.buf
+        offset = 0
+        self.header = np.ndarray((), dtype=_HEADER_DTYPE, buffer=buf, offset=offset)
+        offset += _HEADER_DTYPE.itemsize
+        self.slots = np.ndarray((capacity,), dtype=_SLOT_DTYPE, buffer=buf, offset=offset)
+        offset += capacity * _SLOT_DTYPE.itemsize
+        self.data = np.ndarray((capacity, gates), dtype=np.uint32, buffer=buf, offset=offset)
+
+        if self._owner:
+            self.header['write_index'] = 0
+            self.header['capacity'] = capacity
+            self.header['gates'] = gates
+            self.header['heartbeat'] = 0.0
+            self.slots['index'] = -1
+
+        self.capacity = capacity
+        self.gates = gates
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def write_index(self):
+        return int(self.header['write_index'])
+
+    @property
+    def heartbeat(self):
+        return float(self.header['heartbeat'])
+
+    def write(self, block):
+        """
+        Producer side: copies a hamamatsu.ReadoutBuffer (data and timing) in the next slot and publishes it.
+        """
+        index = int(self.header['write_index'])
+        slot = index % self.capacity
+        n = len(block)
+        self.data[slot, :n] = block.data
+        meta = self.slots[slot]
+        meta['seq'] = block.seq
+        meta['t_recv'] = block.t_recv
+        meta['t_start'] = block.t_start
+        meta['gate_time'] = block.gate_time
+        meta['gap'] = block.gap
+        meta['late'] = block.late
+        meta['index'] = index
+        # publish
+        self.header['heartbeat'] = time.time()
+        self.header['write_index'] = index + 1
+
+    def get(self, index: int):
+        """
+        Consumer side: zero-copy view of block 'index', None if it was already overwritten or not written yet.
+        """
+        slot = index % self.capacity
+        if int(self.slots[slot]['index']) != index:
+            return None
+        return RingBlock(self, index)
+
+    def close(self):
+        # drop the numpy views before closing the mapping
+        self.header = self.slots = self.data = None
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+class RingBlock:
+    """
+    View on a block held by a SharedRing. Mirrors the attributes of hamamatsu.ReadoutBuffer (data, times, seq, t_recv,
+    t_start, gate_time, gap, late) and its retain()/release() interface. Releasing does not protect the slot from the
+    producer: copy the data if it must outlive the ring capacity.
+    """
+    def __init__(self, ring: SharedRing, index: int):
+        self._ring = ring
+        self.index = index
+        slot = index % ring.capacity
+        meta = ring.slots[slot]
+        self.seq = int(meta['seq'])
+        self.t_recv = float(meta['t_recv'])
+        self.t_start = float(meta['t_start'])
+        self.gate_time = float(meta['gate_time'])
+        self.gap = int(meta['gap'])
+        self.late = bool(meta['late'])
+        self.data = ring.data[slot]
+        self._refs = 1
+
+    @property
+    def times(self):
+        return self.t_start + np.arange(self.data.shape[0]) * self.gate_time
+
+    @property
+    def valid(self):
+        """
+        False once the producer has reused the slot for a newer block.
+        """
+        return int(self._ring.slots[self.index % self._ring.capacity]['index']) == self.index
+
+    def retain(self):
+        self._refs += 1
+        return self
+
+    def release(self):
+        self._refs -= 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __len__(self):
+        return self.data.shape[0]
+
+
+def _driver_main(conn, data_ready):
+    """
+    Child process entry point: executes the commands received on 'conn' on a Hamamatsu object, while counting a reader
+    thread writes blocks into the shared ring.
+    """
+    hardware = None
+    ring = None
+    reader = None
+    halt = th.Event()
+
+    def readout():
+        while not halt.is_set():
+            try:
+                block = hardware.read_block()
+            except (RuntimeError, TimeoutError) as e:
+                logging.error(f'Driver process readout failed. Msg: {str(e)}')
+                break
+            with block:
+                ring.write(block)
+            data_ready.set()
+
+    while True:
+        try:
+            cmd, args = conn.recv()
+        except EOFError:
+            break
+
+        try:
+            value = None
+            if cmd == 'open':
+                hardware = Hamamatsu.open()
+                value = hardware.uid
+            elif cmd == 'setup':
+                gate_time, mode, gates, ring_name, capacity = args
+                hardware.gate_time = gate_time
+                hardware.setup(mode=mode, gates=gates)
+                if ring is not None:
+                    ring.close()
+                ring = SharedRing(capacity, gates, name=ring_name)
+                ring.header['pid'] = mp.current_process().pid
+            elif cmd == 'power':
+                hardware.set_power(args[0])
+            elif cmd == 'reset':
+                hardware.reset()
+            elif cmd == 'start':
+                hardware.count_start()
+                halt.clear()
+                reader = th.Thread(name='Driver Reader', target=readout, daemon=True)
+                reader.start()
+            elif cmd == 'stop':
+                halt.set()
+                if reader is not None:
+                    reader.join()
+                hardware.count_stop()
+            elif cmd == 'close':
+                hardware.close()
+                conn.send(('ok', None))
+                break
+            else:
+                raise ValueError(f"Unknown command {cmd}")
+        except Exception as e:
+            conn.send(('error', f'{type(e).__name__}: {str(e)}'))
+        else:
+            conn.send(('ok', value))
+
+    if ring is not None:
+        ring.close()
+
+
+class DriverProcess:
+    """
+    Runs a counting unit in a child process, see module documentation. Commands (setup, power, counting...) are
+    forwarded to the child and raise TimeoutError if it does not answer within 'timeout' seconds, data blocks are read
+    from the shared ring with read_block().
+    """
+    def __init__(self, *, timeout: float = DEFAULT_CALL_TIMEOUT, capacity: int = DEFAULT_RING_BLOCKS):
+        self.uid = -1
+        self.is_powered = False
+        self.is_counting = False
+        self.timeout = timeout
+        self.capacity = capacity
+
+        self._gate_time = ''
+        self.gates = -1
+        self._mode = 1
+
+        self.ring = None
+        self._read_index = 0
+        self.blocks_read = 0
+        self.blocks_lost = 0
+        self.blocks_late = 0
+        self.restarts = 0
+        # gate times restart from zero in a new child process: blocks written from ring index _offset_from on are
+        # shifted by _t_offset (older ones by _prev_offset) to keep the time axis continuous
+        self._t_offset = 0.0
+        self._prev_offset = 0.0
+        self._offset_from = 0
+
+        self._process = None
+        self._conn = None
+        self._data_ready = None
+        self._lock = th.Lock()
+        # incremented by kill(): pending read_block() calls give up
+        self._epoch = 0
+
+    #######################
+    # CLIENT SIDE FACTORY #
+    #######################
+    @classmethod
+    def open(cls, **kwargs):
+        """
+        Spawns the driver process and opens the counting unit in it.
+        """
+        obj = cls(**kwargs)
+        obj._spawn()
+        obj.uid = obj._call('open')
+        return obj
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def close(self):
+        try:
+            self._call('close')
+        finally:
+            self._join()
+            if self.ring is not None:
+                self.ring.close()
+                self.ring = None
+
+    def reset(self):
+        self._call('reset')
+
+    def count_start(self):
+        self._read_index = self.ring.write_index
+        self._t_offset = self._prev_offset = 0.0
+        self._offset_from = self._read_index
+        self.blocks_read = 0
+        self.blocks_lost = 0
+        self.blocks_late = 0
+        self._call('start')
+        self.is_counting = True
+
+    def count_stop(self):
+        self._call('stop')
+        self.is_counting = False
+
+    def setup(self, mode: int, gates: int = None):
+        if gates is not None:
+            self.gates = gates
+        self._mode = mode
+        # a new ring sized for the number of gates, the child attaches to it
+        if self.ring is None or self.ring.gates != self.gates:
+            if self.ring is not None:
+                self.ring.close()
+            self.ring = SharedRing(self.capacity, self.gates)
+        self._call('setup', self._gate_time, mode, self.gates, self.ring.name, self.capacity)
+
+    def set_power(self, status: bool):
+        self._call('power', status)
+        self.is_powered = status
+
+    def read_block(self, timeout: float = None):
+        """
+        Returns the next block from the ring (zero-copy RingBlock). Raises TimeoutError if no block arrives within
+        'timeout' seconds (default: 10 block durations, at least 1 second).
+        """
+        if timeout is None:
+            _, _, gate_time = self.get_gatetime_data()
+            timeout = max(10 * self.gates * gate_time, 1.0)
+
+        epoch = self._epoch
+        deadline = time.monotonic() + timeout
+        while self.ring.write_index <= self._read_index:
+            if epoch != self._epoch:
+                raise RuntimeError(f'Driver process (uid {self.uid}) was killed while waiting for data')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.is_alive:
+                raise TimeoutError(f'No data from driver process (uid {self.uid}) within {timeout:.1f}s')
+            self._data_ready.wait(min(remaining, 0.1))
+            self._data_ready.clear()
+
+        # skip what was overwritten while we were not looking
+        oldest = self.ring.write_index - self.capacity + 1
+        skipped = max(oldest - self._read_index, 0)
+        self._read_index += skipped
+
+        block = self.ring.get(self._read_index)
+        while block is None:
+            # overwritten right now, move to the next one
+            self._read_index += 1
+            skipped += 1
+            block = self.ring.get(self._read_index)
+        self._read_index += 1
+
+        if skipped:
+            logging.warning(f'Driver ring overrun, {skipped} block(s) lost')
+            block.gap += skipped
+        block.t_start += self._t_offset if block.index >= self._offset_from else self._prev_offset
+        self.blocks_read += 1
+        self.blocks_lost += block.gap
+        self.blocks_late += block.late
+        return block
+
+    def read_data(self):
+        with self.read_block() as block:
+            return block.data.tolist()
+
+    def read_id(self):
+        return self.uid
+
+    def kill(self):
+        """
+        Terminates the child process (e.g. stuck in a driver call). The unit must be reopened with restart().
+        """
+        self._epoch += 1
+        if self._process is not None and self._process.is_alive():
+            self._process.kill()
+        self._join()
+
+    def restart(self):
+        """
+        Kills the child process and starts a new one, restoring gate time, power and counting state.
+        Returns the time (seconds) between the last block written by the old process and the new counting start, that
+        is the data lost to the restart (0 if the unit was not counting).
+        """
+        powered, counting = self.is_powered, self.is_counting
+        self.kill()
+        self.is_counting = False
+        self.restarts += 1
+
+        self._spawn()
+        self.uid = self._call('open')
+        if self._gate_time:
+            self._call('setup', self._gate_time, self._mode, self.gates, self.ring.name, self.capacity)
+        if powered:
+            self.set_power(True)
+
+        lost = 0.0
+        if counting:
+            # the new process continues the ring, its gate times start from the last block of the old one
+            last = self.ring.write_index - 1
+            t_restart = time.time()
+            if last >= self._offset_from:
+                meta = self.ring.slots[last % self.capacity]
+                t_end = float(meta['t_start']) + self.gates * float(meta['gate_time']) + self._t_offset
+                lost = t_restart - float(meta['t_recv'])
+            else:
+                # nothing written by the old process
+                t_end = self._t_offset
+                lost = 0.0
+            self._prev_offset = self._t_offset
+            self._t_offset = t_end + lost
+            self._offset_from = last + 1
+
+            self._call('start')
+            self.is_counting = True
+        return lost
+
+    @property
+    def is_alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    @property
+    def heartbeat(self):
+        """
+        Host time of the last block written by the child process.
+        """
+        return self.ring.heartbeat if self.ring is not None else 0.0
+
+    @property
+    def gate_time(self):
+        return self._gate_time
+
+    @gate_time.setter
+    def gate_time(self, value: str):
+        self._gate_time = value
+        self.gates = GATE_TIMES[value][1]
+
+    def get_gatetime_data(self):
+        return GATE_TIMES[self._gate_time]
+
+    #############
+    # INTERNALS #
+    #############
+    def _spawn(self):
+        ctx = mp.get_context('spawn')
+        self._conn, child_conn = ctx.Pipe()
+        self._data_ready = ctx.Event()
+        self._process = ctx.Process(name='Driver Process', target=_driver_main, args=(child_conn, self._data_ready),
+                                    daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def _join(self):
+        if self._process is not None:
+            self._process.join(self.timeout)
+            if self._process.is_alive():
+                self._process.kill()
+                self._process.join()
+        if self._conn is not None:
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def _call(self, cmd, *args):
+        if self._conn is None:
+            raise RuntimeError('Driver process is not running')
+        with self._lock:
+            try:
+                self._conn.send((cmd, args))
+                if not self._conn.poll(self.timeout):
+                    raise TimeoutError(f'Driver process did not answer to {cmd} within {self.timeout}s')
+                status, value = self._conn.recv()
+            except (EOFError, OSError) as e:
+                raise RuntimeError(f'Lost connection with driver process during {cmd}. Msg: {str(e)}')
+        if status == 'error':
+            raise RuntimeError(f'Driver process failed to {cmd}: {value}')
+        return value
+
+
+if __name__ == '__main__':
+    drv = DriverProcess.open()
+    print(f'Driver process opened unit {drv.uid}')
+    drv.gate_time = '1MS'
+    drv.setup(mode=1)
+    drv.set_power(True)
+    drv.count_start()
+    for _ in range(5):
+        with drv.read_block() as bb:
+            print(bb.seq, bb.t_start, bb.data[:5])
+
+    drv.restart()
+    print(f'Restarted ({drv.restarts}), counting = {drv.is_counting}')
+    for _ in range(3):
+        with drv.read_block() as bb:
+            print(bb.seq, bb.t_start, bb.data[:5])
+
+    drv.count_stop()
+    drv.set_power(False)
+    drv.close()
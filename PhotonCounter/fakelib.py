@@ -1,13 +1,47 @@
 """
 Module implements fake wrappers for the hardware driver. I used this under linux to simulate the hardware and test the
 software.
+Each handle is backed by a Simulator that honours the gate time and gate number given to C8855Setup and generates
+whole blocks of Poisson distributed counts at once (from a seeded random generator, so runs are reproducible).
+The simulator runs either in real time (C8855ReadData returns when the block would be complete on the hardware) or
+unthrottled (as fast as possible, to stress the acquisition pipeline).
 DEBUG ONLY.
 """
 
+from ctypes import c_uint8, c_uint16, c_uint32, cast, POINTER
 from functools import wraps
 import logging
+import time
+
 import numpy as np
 
+# number of counting units simulated, C8855Open() hands out handles 1..NUM_DEVICES
+NUM_DEVICES = 4
+
+# hardware gate time code -> seconds (see hamamatsu.GATE_TIMES)
+GATE_CODES = {
+    2: 50e-6, 3: 100e-6, 4: 200e-6, 5: 500e-6,
+    6: 1e-3, 7: 2e-3, 8: 5e-3, 9: 10e-3, 10: 20e-3,
+    11: 50e-3, 12: 100e-3, 13: 200e-3, 14: 500e-3,
+    15: 1.0, 16: 2.0, 17: 5.0, 18: 10.0,
+}
+
+# default simulation parameters, change them with configure()
+DEFAULT_CONFIG = {
+    'rate': 2e5,            # mean count rate (counts/s)
+    'modulation': 0.5,      # relative amplitude of the sinusoidal modulation of the rate
+    'mod_freq': 1.0,        # modulation frequency (Hz)
+    'drift': 0.0,           # relative change of the rate per second
+    'burst_prob': 1e-4,     # probability for a gate to be hit by a burst
+    'burst_factor': 20.0,   # rate multiplier during a burst
+    'seed': 0,              # random generator seed (each handle uses seed + handle)
+    'realtime': True,       # False: generate blocks as fast as possible
+}
+
+_config = dict(DEFAULT_CONFIG)
+_open_handles = set()
+_simulators = {}
+
 
 def debug(f):
     @wraps(f)
@@ -17,13 +51,94 @@ def debug(f):
     return wrapper
 
 
+def configure(**kwargs):
+    """
+    Changes the simulation parameters (see DEFAULT_CONFIG). Applies to the units opened afterwards.
+    """
+    for key in kwargs:
+        if key not in DEFAULT_CONFIG:
+            raise ValueError(f"Unknown simulation parameter {key}")
+    _config.update(kwargs)
+
+
+def reset_config():
+    _config.clear()
+    _config.update(DEFAULT_CONFIG)
+
+
+class Simulator:
+    """
+    Simulates a single counting unit. Time is counted in gates since the last count start, so the generated signal
+    depends only on the seed and the settings, not on how fast blocks are read.
+    """
+    def __init__(self, handle: int, *, rate, modulation, mod_freq, drift, burst_prob, burst_factor, seed, realtime):
+        self.handle = handle
+        self.rate = rate
+        self.modulation = modulation
+        self.mod_freq = mod_freq
+        self.drift = drift
+        self.burst_prob = burst_prob
+        self.burst_factor = burst_factor
+        self.seed = seed
+        self.realtime = realtime
+
+        self.gate_time = 100e-3
+        self.gates = 5
+
+        self._rng = np.random.default_rng(seed + handle)
+        self._gate_index = 0
+        self._t_start = time.monotonic()
+
+    def setup(self, gate_time: float, gates: int):
+        self.gate_time = gate_time
+        self.gates = gates
+
+    def start(self):
+        self._gate_index = 0
+        self._t_start = time.monotonic()
+
+    def generate(self, n: int):
+        """
+        Returns the counts of the next n gates.
+        """
+        t = (self._gate_index + np.arange(n)) * self.gate_time
+        rate = self.rate * (1.0 + self.drift * t)
+        if self.modulation:
+            rate *= 1.0 + self.modulation * np.sin(2 * np.pi * self.mod_freq * t)
+        if self.burst_prob:
+            rate = np.where(self._rng.random(n) < self.burst_prob, rate * self.burst_factor, rate)
+        counts = self._rng.poisson(np.clip(rate, 0.0, None) * self.gate_time)
+
+        self._gate_index += n
+        return counts
+
+    def read(self, out):
+        """
+        Fills 'out' (NumPy array) with the next block, in real time mode waits until the block is complete.
+        """
+        n = out.shape[0]
+        out[:] = self.generate(n)
+        if self.realtime:
+            delay = self._t_start + self._gate_index * self.gate_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+
 @debug
 def C8855Open():
-    return 1
+    for handle in range(1, NUM_DEVICES + 1):
+        if handle not in _open_handles:
+            _open_handles.add(handle)
+            _simulators[handle] = Simulator(handle, **_config)
+            return handle
+    # no free unit
+    return 0
 
 
 @debug
 def C8855Close(handle):
+    _open_handles.discard(handle)
+    _simulators.pop(handle, None)
     return 1
 
 
@@ -34,6 +149,7 @@ def C8855Reset(hhandle):
 
 @debug
 def C8855CountStart(hhandle, trig):
+    _simulators[hhandle].start()
     return 1
 
 
@@ -44,6 +160,10 @@ def C8855CountStop(hhandle):
 
 @debug
 def C8855Setup(hhandle, times, mode_c, n_gates_c):
+    gate_time = GATE_CODES.get(times.value)
+    if gate_time is None:
+        return 0
+    _simulators[hhandle].setup(gate_time, n_gates_c.value)
     return 1
 
 
@@ -52,22 +172,37 @@ def C8855SetPmtPower(hhandle, pow_mode):
     return 1
 
 
-@debug
+# not decorated with @debug: logging every readout would dominate the cost at short gate times
 def C8855ReadData(hhandle, data, result):
-    from ctypes import c_uint32, cast, POINTER
-
+    sim = _simulators.get(hhandle)
+    if sim is None:
+        return 0
     pnt = cast(data, POINTER(c_uint32))
-
-    for i in range(5):
-        # this loop (N=5 with delay 100msec) is set to work for the 100ms gate time setting.
-        #pnt[i] = c_uint32(np.random.randint(30, 50))
-        import time
-        from math import sin, pi
-        pnt[i] = c_uint32(int(10000*sin(time.time() * 2 * pi * 1000) + 10000))
-        time.sleep(100e-3)
+    sim.read(np.ctypeslib.as_array(pnt, shape=(sim.gates,)))
     return 1
 
 
 @debug
 def C8855ReadId(hhandle, uid):
-    return 1
\ No newline at end of file
+    # use the handle as unique ID
+    cast(uid, POINTER(c_uint8))[0] = c_uint8(hhandle)
+    return 1
+
+
+if __name__ == '__main__':
+    from ctypes import byref
+
+    configure(realtime=False)
+    hh = C8855Open()
+    # 50us gate time, block transfer, 500 gates
+    C8855Setup(hh, c_uint8(2), c_uint8(2), c_uint16(500))
+
+    buf = (c_uint32 * 500)()
+    res = c_uint8()
+    C8855CountStart(hh, c_uint8(0))
+    t0 = time.perf_counter()
+    nblocks = 2000
+    for _ in range(nblocks):
+        C8855ReadData(hh, byref(buf), byref(res))
+    dt = time.perf_counter() - t0
+    print(f'{nblocks * 500 / dt:.3g} samples/s (unthrottled), last block mean = {np.mean(buf[:]):.2f}')
@@ -3,10 +3,16 @@ Module implements a wrapper class for the hardware library. Errors from c-style
 exceptions, similarly c-style variables are converted to Python variables as needed.
 """
 from ctypes import byref, c_uint32, c_uint16, c_uint8
+from collections import deque
+from threading import Lock
+import logging
 import os.path
+import time
 
 import platform
 
+import numpy as np
+
 # I wrote the software mostly under Linux, but the hardware library only works on Windows. So i made a 'fakelib' module
 # that simulates the hardware for debugging purposes.
 OS = platform.system()
@@ -19,6 +25,18 @@ elif OS == 'Windows':
 else:
     raise RuntimeError(f"Wrong OS, got {OS}")
 
+
+def set_library(library):
+    """
+    Replaces the hardware library (before opening any unit): any module or object with the C8855* functions (the DLL,
+    fakelib, or replaylib to replay a recorded session). A library that does not deliver the blocks in real time may
+    also have a clock_speed() function: pace of the blocks relative to the gate time (0: unthrottled), used to tell
+    late blocks.
+    """
+    global libhandle
+    libhandle = library
+
+
 USB_TIMEOUT = 2
 
 # Hamamatsu gate times
@@ -57,6 +75,16 @@ PMT_POWER_ON = c_uint8(1)
 PMT_POWER_CHECK = c_uint8(2)
 
 MAX_HANDLES = 16
+# number of gates is passed to the hardware as an unsigned 16 bit integer
+MAX_GATES = 65535
+
+# number of readout buffers preallocated by a BufferPool. Consumers hold on to a buffer until they release it, so this
+# should cover the blocks 'in flight' between the readout thread and the slowest consumer.
+DEFAULT_POOL_SIZE = 8
+
+# a block is flagged as 'late' (readout overrun) when it arrives more than LATE_TOLERANCE block-durations after its
+# expected time. The unit buffers its data first-in first-out: a late read delays the data, it does not lose any.
+LATE_TOLERANCE = 0.5
 
 
 def _is_good_handle(handle):
@@ -69,18 +97,143 @@ def _is_good_handle(handle):
     return True
 
 
-# def minit(handles):
-#     """
-#     Attempts to open a list of handles and returns multiple Hamamatsu objects. used for multi-hardware support
-#     (NOT IMPLEMENTED)
-#     """
-#     objs = []
-#     for hh in handles:
-#         obj = Hamamatsu(hh)
-#         obj.read_id()
-#         print(f'Detected hardware with uid = {obj.uid}')
-#         objs.append(obj)
-#     return objs
+def minit(max_units: int = MAX_HANDLES):
+    """
+    Opens every connected counting unit (up to max_units) and returns a list of Hamamatsu objects, one per unit. Used
+    for multi-hardware support (see devicemanager.DeviceManager).
+    """
+    if not 0 < max_units <= MAX_HANDLES:
+        raise ValueError(f"Number of units must be within 1 and {MAX_HANDLES}, got {max_units}")
+
+    objs = []
+    while len(objs) < max_units:
+        try:
+            handle = _open()
+        except ValueError:
+            # no more hardware to open
+            break
+        obj = Hamamatsu(handle=handle)
+        obj.read_id()
+        logging.info(f'Detected hardware with uid = {obj.uid}')
+        objs.append(obj)
+
+    if not objs:
+        raise ValueError("No Hardware detected.")
+    return objs
+
+
+class ReadoutBuffer:
+    """
+    A single preallocated ctypes array (the memory the driver writes into) together with a uint32 NumPy view of the
+    same memory. Buffers are handed out by a BufferPool and go back to it once every owner has called release().
+    Use retain() before passing the buffer to an additional consumer, each consumer then releases it once.
+    The 'data' view must not be used after the last release(): the memory is reused by the next readout.
+
+    After a readout the buffer also carries the block timing information:
+        seq      monotonic block number (since count_start)
+        t_recv   host time (time.time()) at which the block was received
+        t_start  time of the first gate in seconds since count_start, computed from the gates read
+        gap      number of blocks lost right before this one (only reported where blocks are dropped, e.g. by the ring
+                 of driverprocess.DriverProcess: the unit itself does not drop data)
+        late     True if the block arrived later than expected (readout overrun: the host is behind the unit)
+    """
+    def __init__(self, pool, gates: int):
+        self._pool = pool
+        self.raw = (c_uint32 * gates)()
+        # zero-copy view on the ctypes array
+        self.data = np.frombuffer(self.raw, dtype=np.uint32)
+        self._refs = 0
+
+        self.seq = -1
+        self.t_recv = 0.0
+        self.t_start = 0.0
+        self.gate_time = 0.0
+        self.gap = 0
+        self.late = False
+
+    @property
+    def times(self):
+        """
+        Time of each gate in seconds since count_start.
+        """
+        return self.t_start + np.arange(self.data.shape[0]) * self.gate_time
+
+    def retain(self):
+        with self._pool.lock:
+            if self._refs <= 0:
+                raise RuntimeError('Cannot retain a buffer that was already released')
+            self._refs += 1
+        return self
+
+    def release(self):
+        with self._pool.lock:
+            if self._refs <= 0:
+                raise RuntimeError('Buffer released more times than it was retained')
+            self._refs -= 1
+            if self._refs == 0:
+                self._pool.put_back(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __len__(self):
+        return self.data.shape[0]
+
+
+class BufferPool:
+    """
+    Fixed set of ReadoutBuffer objects of 'gates' elements each. Avoids allocating a new ctypes array (and boxing
+    every count into a Python int) on each call to C8855ReadData. If all buffers are in use the pool grows by one
+    buffer, this is logged since it means consumers are not releasing buffers fast enough.
+    """
+    def __init__(self, gates: int, size: int = DEFAULT_POOL_SIZE):
+        if gates <= 0:
+            raise ValueError(f"Number of gates must be positive, got {gates}")
+        if size <= 0:
+            raise ValueError(f"Pool size must be positive, got {size}")
+
+        self.gates = gates
+        self.lock = Lock()
+        self._free = deque(ReadoutBuffer(self, gates) for _ in range(size))
+        self._size = size
+        # number of buffers allocated after construction (pool exhausted)
+        self.misses = 0
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def acquire(self):
+        """
+        Returns a free buffer owned by the caller (reference count = 1).
+        """
+        with self.lock:
+            if self._free:
+                buf = self._free.popleft()
+            else:
+                buf = ReadoutBuffer(self, self.gates)
+                self._size += 1
+                self.misses += 1
+                # warn once, the pool keeps growing as long as consumers hold on to the buffers
+                level = logging.WARNING if self.misses == 1 else logging.DEBUG
+                logging.log(level, f'Buffer pool exhausted, growing to {self._size} buffers')
+            buf._refs = 1
+        return buf
+
+    def put_back(self, buf):
+        # called by ReadoutBuffer.release() with self.lock held
+        self._free.append(buf)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def available(self):
+        with self.lock:
+            return len(self._free)
 
 
 def _open():
@@ -107,6 +260,19 @@ class Hamamatsu:
         self._gate_time = ''
         self.gates = -1
 
+        # preallocated readout buffers used by read_block(), (re)built when the number of gates changes
+        self._pool = None
+
+        # block timing, reset by count_start()
+        self.start_time = 0.0
+        self.blocks_read = 0
+        self.blocks_lost = 0
+        self.blocks_late = 0
+        self._t_mono = 0.0
+        self._latency = None
+        self._next_gate = 0
+        self._clock_speed = 1.0
+
     #######################
     # CLIENT SIDE FACTORY #
     #######################
@@ -116,7 +282,7 @@ class Hamamatsu:
         Factory method for initializing a single counting unit.
         :return: Hamamatsu object
         """
-        # todo: as long as multiple hardware support is not in place, this should behave as a singleton.
+        # opens the first free unit, use minit() (or devicemanager.DeviceManager) to open several of them.
         handle = _open()
         obj = cls(handle=handle)
         obj.read_id()
@@ -138,12 +304,26 @@ class Hamamatsu:
             raise RuntimeError(f'Could not start count process for handle {self.hhandle}')
         self.is_counting = True
 
+        self.start_time = time.time()
+        self.blocks_read = 0
+        self.blocks_lost = 0
+        self.blocks_late = 0
+        self._t_mono = time.monotonic()
+        self._latency = None
+        self._next_gate = 0
+        self._clock_speed = libhandle.clock_speed() if hasattr(libhandle, 'clock_speed') else 1.0
+
     def count_stop(self):
         if libhandle.C8855CountStop(self.hhandle) == 0:
             raise RuntimeError(f'Could not stop count process for handle {self.hhandle}')
         self.is_counting = False
 
-    def setup(self, mode: int):
+    def setup(self, mode: int, gates: int = None):
+        # the number of gates defaults to the one in GATE_TIMES (set together with gate_time), 'gates' overrides it
+        if gates is not None:
+            if not 0 < gates <= MAX_GATES:
+                raise ValueError(f"Number of gates must be within 1 and {MAX_GATES}, got {gates}")
+            self.gates = gates
         # transfer mode (generally we use BLOCK_TRASFER)
         mode_c = SINGLE_TRANSFER if mode == 0 else BLOCK_TRANSFER
         # gate number using ctype
@@ -163,11 +343,7 @@ class Hamamatsu:
     def read_data(self):
         data_type = c_uint32 * self.gates
         data = data_type()
-        result = c_uint8()
-        if libhandle.C8855ReadData(self.hhandle, byref(data), byref(result)) == 0:
-            raise RuntimeError(f'Could not read data from handle {self.hhandle}')
-        if result.value < 0:
-            raise RuntimeError(f'Error during data readout (handle {self.hhandle})')
+        self._read_into(data)
         # the 'data' array contains the counts per gate (each represents photon counts after 'gate time' seconds)
         # return the whole array and plot it
 
@@ -175,6 +351,25 @@ class Hamamatsu:
         # it. Since this array it's going to be overridden next data acquisition.
         return data[:]
 
+    def read_block(self):
+        """
+        Zero-copy version of read_data(). The driver writes directly in a preallocated buffer taken from the pool, the
+        returned ReadoutBuffer exposes it as a uint32 NumPy array ('.data') together with the block sequence number and
+        per-gate times (see ReadoutBuffer).
+        The caller owns the buffer and MUST release() it (or use it as a context manager) once done with it.
+        """
+        if self._pool is None or self._pool.gates != self.gates:
+            self._pool = BufferPool(self.gates)
+
+        buf = self._pool.acquire()
+        try:
+            self._read_into(buf.raw)
+        except Exception:
+            buf.release()
+            raise
+        self._stamp(buf)
+        return buf
+
     def read_id(self):
         uid = c_uint8()
         if not libhandle.C8855ReadId(self.hhandle, byref(uid)):
@@ -190,12 +385,58 @@ class Hamamatsu:
         self._gate_time = value
         self.gates = GATE_TIMES[value][1]
 
+    @property
+    def pool(self):
+        return self._pool
+
     #############
     # INTERNALS #
     #############
     def get_gatetime_data(self):
         return GATE_TIMES[self._gate_time]
 
+    def _stamp(self, buf):
+        """
+        Assigns sequence number and gate times to a freshly read block. The time axis only follows the gates read (the
+        unit delivers them in order, without holes); the host clock only tells whether the block is late, i.e. the
+        readout is behind the unit (GIL, garbage collection, slow consumer), which is counted in blocks_late.
+        """
+        gate_time = GATE_TIMES[self._gate_time][2]
+        ngates = len(buf)
+
+        buf.t_recv = time.time()
+        if self._clock_speed:
+            # host time taken by a block
+            block_time = ngates * gate_time / self._clock_speed
+            elapsed = time.monotonic() - self._t_mono
+            if self._latency is None:
+                # first block: whatever exceeds the block duration is the (constant) transfer latency
+                self._latency = max(elapsed - block_time, 0.0)
+
+            # blocks behind the unit
+            delay = (elapsed - self._latency) / block_time - (self._next_gate + ngates) / ngates
+            buf.late = delay > LATE_TOLERANCE
+        else:
+            # unthrottled: the blocks are never late
+            buf.late = False
+        if buf.late:
+            self.blocks_late += 1
+
+        buf.seq = self.blocks_read
+        buf.gap = 0
+        buf.gate_time = gate_time
+        buf.t_start = self._next_gate * gate_time
+
+        self.blocks_read += 1
+        self._next_gate += ngates
+
+    def _read_into(self, data):
+        result = c_uint8()
+        if libhandle.C8855ReadData(self.hhandle, byref(data), byref(result)) == 0:
+            raise RuntimeError(f'Could not read data from handle {self.hhandle}')
+        if result.value < 0:
+            raise RuntimeError(f'Error during data readout (handle {self.hhandle})')
+
     # def _compute_iterations(self):
     #     gates = TRANS[self.gate_time]
     #     gates = min(gates, DEFAULT_MEASUREMENT_POINTS)
@@ -0,0 +1,222 @@
+"""
+Module implements a tiered history of the acquired samples, for the display: the most recent samples are kept in RAM
+(hot tier), the older ones are spilled in chunks to a scratch file on disk (cold tier, a livefile memory-mapped file),
+so that the whole acquisition can be read back (scrolled or zoomed over hours) with a fixed memory budget in bytes
+instead of a number of points.
+
+When the hot tier is full its oldest SPILL_FRACTION is appended to the scratch file in one write, and the rest is moved
+to the front: each sample is copied to disk once, whatever the block size. Reads combine both tiers transparently: the
+cold part is read through the maps of the scratch file writer (no other map of the file is kept, and the file grows by
+adding segments, never by resizing a mapped file: see livefile module), i.e. through the page cache (the OS keeps the
+recently read parts in memory as long as there is room for them, outside of the budget).
+"""
+import logging
+import os
+import tempfile
+import threading as th
+
+import numpy as np
+
+from .livefile import EXTENSION, LiveSessionWriter, remove
+
+# RAM used by the hot tier (bytes)
+DEFAULT_MEMORY_BUDGET = 64 * 2**20
+# fraction of the hot tier moved to disk when it is full
+SPILL_FRACTION = 0.5
+
+
+class TieredHistory:
+    """
+    History of samples (one column per keyword, the first one is the time: increasing, see clear()) kept in RAM up to
+    'memory_budget' bytes, the older samples are spilled to 'spill_path' (default: a temporary file, deleted by
+    clear() and close()).
+    push_block() is called by the acquisition side, last() and read() return copies: both can be called from different
+    threads.
+    """
+    def __init__(self, keywords: list, *, dtypes: list = None, memory_budget: int = DEFAULT_MEMORY_BUDGET,
+                 spill_path: str = None):
+        if dtypes is None:
+            dtypes = [np.float64] * len(keywords)
+        if len(dtypes) != len(keywords):
+            raise ValueError(f"One dtype per keyword is required: got {len(dtypes)} for {len(keywords)} keywords")
+
+        self.keywords = keywords
+        self._dtypes = [np.dtype(dt) for dt in dtypes]
+        self._capacity = int(memory_budget // sum(dt.itemsize for dt in self._dtypes))
+        if self._capacity < 2:
+            raise ValueError(f"Memory budget of {memory_budget} bytes is too small")
+        self.memory_budget = memory_budget
+        self.spill_path = spill_path
+
+        # hot tier: column[:_end]
+        self._columns = [np.empty(self._capacity, dtype=dt) for dt in self._dtypes]
+        self._end = 0
+        # cold tier: samples 0.._cold_samples-1 of the scratch file
+        self._cold_path = None
+        self._cold_writer = None
+        self._cold_samples = 0
+
+        self._lock = th.Lock()
+        self.spills = 0
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def push_block(self, *columns):
+        if len(columns) != len(self._columns):
+            raise ValueError(f"Expected {len(self._columns)} columns, got {len(columns)}")
+
+        npoints = len(columns[0])
+        with self._lock:
+            start = 0
+            while start < npoints:
+                if self._end == self._capacity:
+                    self._spill()
+                stop = min(npoints, start + self._capacity - self._end)
+                for column, values in zip(self._columns, columns):
+                    column[self._end:self._end + stop - start] = values[start:stop]
+                self._end += stop - start
+                start = stop
+
+    def last(self, npoints: int = None):
+        """
+        Returns the last 'npoints' samples (all of them by default) as one array per keyword.
+        """
+        with self._lock:
+            total = self._cold_samples + self._end
+            start = 0 if npoints is None else max(total - npoints, 0)
+            return self._gather(start, total)
+
+    def since(self, index: int):
+        """
+        Returns the samples from the index-th one (counted from the last clear()) to the last one, as one array per
+        keyword, and the index following the last one (to pass at the next call).
+        """
+        with self._lock:
+            total = self._cold_samples + self._end
+            return self._gather(min(max(index, 0), total), total), total
+
+    def read(self, t_start: float = None, t_stop: float = None):
+        """
+        Returns the samples with t_start <= time < t_stop (open ended when None) as one array per keyword.
+        """
+        with self._lock:
+            start = self._search(t_start) if t_start is not None else 0
+            stop = self._search(t_stop) if t_stop is not None else self._cold_samples + self._end
+            return self._gather(start, max(start, stop))
+
+    def clear(self):
+        """
+        Drops all the samples (and the scratch file), e.g. before a new acquisition restarts the time axis.
+        """
+        with self._lock:
+            self._end = 0
+            self._close_cold()
+
+    def close(self):
+        self.clear()
+
+    @property
+    def t_start(self):
+        with self._lock:
+            if self._cold_samples:
+                return float(self._cold_writer.columns(0, 1)[0][0])
+            return float(self._columns[0][0]) if self._end else None
+
+    @property
+    def t_stop(self):
+        """
+        Time of the last sample.
+        """
+        with self._lock:
+            return float(self._columns[0][self._end - 1]) if self._end else None
+
+    @property
+    def hot_samples(self):
+        return self._end
+
+    @property
+    def cold_samples(self):
+        return self._cold_samples
+
+    @property
+    def nbytes(self):
+        """
+        RAM allocated for the samples.
+        """
+        return sum(column.nbytes for column in self._columns)
+
+    @property
+    def disk_bytes(self):
+        return self._cold_writer.bytes_written if self._cold_writer is not None else 0
+
+    def __len__(self):
+        return self._cold_samples + self._end
+
+    #############
+    # INTERNALS #
+    #############
+    def _spill(self):
+        npoints = max(int(self._capacity * SPILL_FRACTION), 1)
+        if self._cold_writer is None:
+            self._open_cold()
+        self._cold_writer.write(*[column[:npoints] for column in self._columns])
+        for column in self._columns:
+            column[:self._end - npoints] = column[npoints:self._end]
+        self._end -= npoints
+        self._cold_samples += npoints
+        self.spills += 1
+
+    def _open_cold(self):
+        path = self.spill_path
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix='history_', suffix=EXTENSION)
+            os.close(handle)
+        self._cold_writer = LiveSessionWriter(path, self.keywords, dtypes=self._dtypes,
+                                              capacity=max(self._capacity, 1024))
+        self._cold_path = path
+
+    def _close_cold(self):
+        if self._cold_writer is None:
+            return
+        self._cold_writer.close()
+        try:
+            remove(self._cold_path)
+        except OSError as e:
+            logging.warning(f'Could not remove the history scratch file {self._cold_path}. Msg: {str(e)}')
+        self._cold_writer = self._cold_path = None
+        self._cold_samples = 0
+
+    def _search(self, t):
+        # index of the first sample at or after t, cold samples all come before the hot ones
+        index = 0
+        for times, *_ in self._cold_writer.chunks(0, self._cold_samples) if self._cold_samples else []:
+            if times[-1] >= t:
+                return index + int(np.searchsorted(times, t))
+            index += len(times)
+        return self._cold_samples + int(np.searchsorted(self._columns[0][:self._end], t))
+
+    def _gather(self, start, stop):
+        hot = [column[max(start - self._cold_samples, 0):max(stop - self._cold_samples, 0)]
+               for column in self._columns]
+        if start >= self._cold_samples:
+            return [values.copy() for values in hot]
+        cold = self._cold_writer.columns(start, min(stop, self._cold_samples))
+        return [np.concatenate((cold_values, hot_values)) for cold_values, hot_values in zip(cold, hot)]
+
+
+if __name__ == '__main__':
+    import time
+
+    # one hour of a 1ms gate time acquisition in a 16MB budget
+    history = TieredHistory(['time', 'counts'], dtypes=[np.float64, np.uint32], memory_budget=16 * 2**20)
+    t0 = time.perf_counter()
+    for i in range(3600):
+        history.push_block(np.arange(i * 1000, (i + 1) * 1000) * 1e-3, np.random.poisson(20, 1000))
+    dt = time.perf_counter() - t0
+    print(f'{len(history)} samples in {dt:.2f}s: {history.hot_samples} in RAM ({history.nbytes / 2**20:.0f}MB), '
+          f'{history.cold_samples} on disk ({history.disk_bytes / 2**20:.0f}MB, {history.spills} spills)')
+    t0 = time.perf_counter()
+    times, counts = history.read(600.0, 660.0)
+    print(f'{len(times)} samples from {times[0]:.3f}s to {times[-1]:.3f}s read in {1e3 * (time.perf_counter() - t0):.1f}ms')
+    history.close()
@@ -0,0 +1,456 @@
+"""
+Module implements a live session file: the acquired samples are appended to a memory-mapped file whose header publishes
+the number of valid samples (the write index), so that other processes (a Jupyter kernel, an analysis script) can map
+it read-only and follow the acquisition while it runs, without copies, IPC or waiting for the log to be flushed.
+
+File layout (little endian):
+    preamble   magic b'BPCLIVE\\0', format version (uint32), header size in bytes (uint32, offset of the first record),
+               record size (uint32), flags (uint32, FLAG_CLOSED once the writer is done), capacity in records (uint64),
+               write index (uint64)
+    header     JSON text: column names, NumPy description of a record (names, formats, offsets, itemsize), records of
+               the first segment, gate time, device uid and start time, padded with spaces up to a multiple of
+               HEADER_ALIGN bytes
+    records    one record per sample (by default time float64 and counts uint32, aligned: 16 bytes), only the first
+               'write index' are valid
+
+The records are stored in segments: the first one ('segment_records' records) follows the header, segment k (records
+only) is the file path.k (see segment_path()) and holds twice as many records as segment k - 1. The writer copies the
+samples first and publishes the new write index after: the records below the write index never change, a reader only
+has to read the write index to know what it can use. When a segment is full the next one is created at its final size
+(the new space is not written, so it takes no disk space where the file system supports sparse files) and readers map
+it when the write index goes past the segments they have. A mapped file is never resized while the acquisition runs:
+Windows does not allow it. When the writer is closed the last segment is cut to the valid records (skipped on Windows
+while a reader maps it) and FLAG_CLOSED is set. Appending to a closed file extends its last segment again, which on
+Windows requires that no reader maps it.
+
+    # in the acquisition (see the 'live' argument of buffer.RingBuffer)
+    live = LiveSessionWriter('Data/log_01.01.24_10.00.00.live', ['Time', 'Counts'], dtypes=[np.float64, np.uint32])
+    live.write(times, counts)
+
+    # in another process
+    live = LiveSessionReader('Data/log_01.01.24_10.00.00.live')
+    times, counts = live.columns()      # up to the current write index (views on the file within one segment)
+    while live.wait(timeout=1.0):
+        times, counts = live.read_new()     # the samples added since the last call
+
+    python -m PhotonCounter.livefile Data/log_01.01.24_10.00.00.live
+"""
+import json
+import mmap
+import os
+import os.path
+import time
+
+import numpy as np
+
+MAGIC = b'BPCLIVE\x00'
+FORMAT_VERSION = 2
+EXTENSION = '.live'
+# records start at a multiple of this (page size), so that they stay aligned in memory
+HEADER_ALIGN = 4096
+# records of the first segment (each new segment is twice as large as the previous one)
+DEFAULT_CAPACITY = 1 << 20
+# polling period of LiveSessionReader.wait() in seconds
+DEFAULT_POLL = 0.01
+
+FLAG_CLOSED = 1
+
+_PREAMBLE_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('header_size', '<u4'),
+    ('record_size', '<u4'),
+    ('flags', '<u4'),
+    ('capacity', '<u8'),
+    ('write_index', '<u8'),
+])
+
+
+def record_dtype(keywords: list, dtypes: list = None):
+    """
+    Record of one sample: one field per keyword (little endian), aligned like a C struct.
+    """
+    if dtypes is None:
+        dtypes = [np.float64] * len(keywords)
+    if len(dtypes) != len(keywords):
+        raise ValueError(f"One dtype per keyword is required: got {len(dtypes)} for {len(keywords)} keywords")
+    return np.dtype([(str(kw), np.dtype(dt).newbyteorder('<')) for kw, dt in zip(keywords, dtypes)], align=True)
+
+
+def _describe(dtype):
+    # JSON friendly description of a record, np.dtype(description) gives the dtype back
+    return {
+        'names': list(dtype.names),
+        'formats': [dtype.fields[name][0].str for name in dtype.names],
+        'offsets': [dtype.fields[name][1] for name in dtype.names],
+        'itemsize': dtype.itemsize,
+    }
+
+
+def segment_path(path: str, k: int):
+    """
+    File of the k-th segment of a live session file.
+    """
+    return path if k == 0 else f'{path}.{k}'
+
+
+def remove(path: str):
+    """
+    Deletes a live session file and its segments.
+    """
+    k = 0
+    while os.path.isfile(segment_path(path, k)):
+        os.remove(segment_path(path, k))
+        k += 1
+
+
+def _segment_start(first: int, k: int):
+    # index of the first record of segment k (segment k holds first * 2^k records)
+    return first * ((1 << k) - 1)
+
+
+def _segment_of(first: int, index: int):
+    # segment holding record 'index'
+    return (index // first + 1).bit_length() - 1
+
+
+class _Segments:
+    """
+    Read access to the mapped segments: _segments[k] is the record array of segment k (possibly shorter than its
+    capacity), _first the number of records of segment 0, _available() the number of valid records.
+    """
+    def chunks(self, start: int = 0, stop: int = None):
+        """
+        Samples start:stop (all the samples available by default) as one list of arrays (one per keyword) per segment
+        they span: views on the file, no copy.
+        """
+        start, stop, _ = slice(start, stop).indices(self._available())
+        chunks = []
+        while start < stop:
+            k = _segment_of(self._first, start)
+            offset = _segment_start(self._first, k)
+            records = self._segments[k][start - offset:stop - offset]
+            chunks.append([records[name] for name in self.dtype.names])
+            start += records.shape[0]
+        return chunks
+
+    def columns(self, start: int = 0, stop: int = None):
+        """
+        Samples start:stop (all the samples available by default) as one array per keyword: views on the file when they
+        are in one segment, copies otherwise.
+        """
+        chunks = self.chunks(start, stop)
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            return [np.zeros(0, dtype=self.dtype.fields[name][0]) for name in self.dtype.names]
+        return [np.concatenate(parts) for parts in zip(*chunks)]
+
+
+class LiveSessionWriter(_Segments):
+    """
+    Sink (write(*columns), flush(), close(): see storage module) appending the samples to a live session file. Writes
+    are plain memory copies, cheap enough to be done from the acquisition thread. An existing live file with the same
+    columns is appended to. chunks() and columns() read back what was written (from the writer's own maps).
+    """
+    def __init__(self, path: str, keywords: list, *, dtypes: list = None, gate_time: float = None, uid: int = None,
+                 start_time: float = None, capacity: int = DEFAULT_CAPACITY):
+        if capacity <= 0:
+            raise ValueError(f"Capacity must be positive, got {capacity}")
+
+        folder = os.path.dirname(path)
+        if len(folder) != 0 and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.path = path
+        self.keywords = [str(kw) for kw in keywords]
+        self.dtype = record_dtype(keywords, dtypes)
+        # one file, map and record array per segment
+        self._files = []
+        self._maps = []
+        self._segments = []
+        self._preamble = None
+
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            self.header, self._offset = read_header(path)
+            if np.dtype(self.header['record_dtype']) != self.dtype:
+                raise ValueError(f"{path} holds other columns ({self.header['keywords']}), cannot append to it")
+            if 'segment_records' not in self.header:
+                raise ValueError(f"{path} was written by an older version, cannot append to it")
+            self._first = self.header['segment_records']
+            with open(path, 'rb') as f_in:
+                preamble = np.frombuffer(f_in.read(_PREAMBLE_DTYPE.itemsize), dtype=_PREAMBLE_DTYPE)[0]
+            self._index = int(preamble['write_index'])
+            # the segments holding records (the last one is extended again if the file was closed)
+            for k in range(_segment_of(self._first, self._index - 1) + 1 if self._index else 1):
+                self._open_segment(k)
+        else:
+            self.header = {
+                'keywords': self.keywords,
+                'record_dtype': _describe(self.dtype),
+                'segment_records': capacity,
+                'gate_time': gate_time,
+                'uid': uid,
+                'start_time': time.time() if start_time is None else start_time,
+            }
+            text = json.dumps(self.header).encode('utf-8')
+            self._offset = -(-(_PREAMBLE_DTYPE.itemsize + len(text)) // HEADER_ALIGN) * HEADER_ALIGN
+            text += b' ' * (self._offset - _PREAMBLE_DTYPE.itemsize - len(text))
+            preamble = np.array((MAGIC, FORMAT_VERSION, self._offset, self.dtype.itemsize, 0, capacity, 0),
+                                dtype=_PREAMBLE_DTYPE)
+            with open(path, 'w+b') as f_out:
+                f_out.write(preamble.tobytes() + text)
+            self._first = capacity
+            self._index = 0
+            self._open_segment(0)
+
+        self._preamble['flags'] = 0
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def write(self, *columns):
+        npoints = len(columns[0])
+        start = 0
+        while start < npoints:
+            if self._index == self._capacity:
+                self._open_segment(len(self._segments))
+            offset = _segment_start(self._first, len(self._segments) - 1)
+            stop = min(npoints, start + self._capacity - self._index)
+            # data first, write index last: readers never see a record being written
+            records = self._segments[-1][self._index - offset:self._index - offset + stop - start]
+            for name, column in zip(self.dtype.names, columns):
+                records[name] = column[start:stop]
+            self._index += stop - start
+            start = stop
+        self._preamble['write_index'] = self._index
+
+    def flush(self):
+        """
+        Writes the mapped pages to disk (other processes see the data as soon as it is written in memory).
+        """
+        for map_ in self._maps:
+            map_.flush()
+
+    def sync(self):
+        self.flush()
+
+    def close(self):
+        """
+        Cuts the last segment to the valid records and marks the file closed.
+        """
+        if not self._maps:
+            return
+        self._preamble['capacity'] = self._index
+        self._preamble['flags'] = FLAG_CLOSED
+        self.flush()
+        k = len(self._segments) - 1
+        size = (self._offset if k == 0 else 0) + (self._index - _segment_start(self._first, k)) * self.dtype.itemsize
+        # the arrays must be released before the maps can be closed
+        self._preamble = None
+        self._segments = []
+        for map_ in self._maps:
+            map_.close()
+        self._maps = []
+        try:
+            self._files[-1].truncate(size)
+        except OSError:
+            # a reader still maps the file (Windows does not allow to shrink it)
+            pass
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    @property
+    def samples(self):
+        return self._index
+
+    @property
+    def bytes_written(self):
+        return self._offset + self._index * self.dtype.itemsize
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    #############
+    # INTERNALS #
+    #############
+    def _available(self):
+        return self._index
+
+    def _open_segment(self, k):
+        # opens (creates) segment k at its full size and maps it
+        path = segment_path(self.path, k)
+        offset = self._offset if k == 0 else 0
+        size = offset + (self._first << k) * self.dtype.itemsize
+        f = open(path, 'r+b' if os.path.isfile(path) else 'w+b')
+        if os.fstat(f.fileno()).st_size < size:
+            # not mapped by this writer, new (or cut when the file was closed)
+            f.truncate(size)
+        map_ = mmap.mmap(f.fileno(), size)
+        self._files.append(f)
+        self._maps.append(map_)
+        self._segments.append(np.ndarray((self._first << k,), dtype=self.dtype, buffer=map_, offset=offset))
+        if k == 0:
+            self._preamble = np.ndarray((), dtype=_PREAMBLE_DTYPE, buffer=map_)
+        self._capacity = _segment_start(self._first, k + 1)
+        self._preamble['capacity'] = self._capacity
+
+
+class LiveSessionReader(_Segments):
+    """
+    Read-only view of a live session file, safe to use from any process while the writer keeps appending samples.
+    The arrays returned by chunks() (and by columns() within one segment) are views on the file: they stay valid (and
+    unchanged) after the reader is refreshed or closed, as long as they are referenced.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.header, self._offset = read_header(path)
+        self.dtype = np.dtype(self.header['record_dtype'])
+        self.keywords = self.header['keywords']
+
+        self._segments = []
+        self._preamble = None
+        self._map_segment(0)
+        # format version 1: a single file
+        self._first = self.header.get('segment_records', self._segments[0].shape[0])
+        self._seen = 0
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def refresh(self):
+        """
+        Reads the write index (mapping the new segments if needed), returns the number of samples available.
+        """
+        index = int(self._preamble['write_index'])
+        while True:
+            k = len(self._segments) - 1
+            end = _segment_start(self._first, k) + self._segments[k].shape[0]
+            if end >= index:
+                return index
+            if self._segments[k].shape[0] < self._first << k:
+                # mapped when the file was closed (cut), extended since: map it again
+                self._map_segment(k)
+                if self._segments[k].shape[0] == end - _segment_start(self._first, k):
+                    return end
+            else:
+                self._map_segment(k + 1)
+
+    def read_new(self):
+        """
+        Samples added since the last call (all of them at the first call), as one array per keyword.
+        """
+        index = self.refresh()
+        columns = self.columns(self._seen, index)
+        self._seen = index
+        return columns
+
+    def wait(self, timeout: float = None, poll: float = DEFAULT_POLL):
+        """
+        Waits until samples are added after those returned by read_new(). Returns False on timeout or if the writer
+        was closed with nothing left to read.
+        """
+        t_end = time.monotonic() + timeout if timeout is not None else None
+        while self.refresh() <= self._seen:
+            if self.closed or t_end is not None and time.monotonic() >= t_end:
+                return False
+            time.sleep(poll)
+        return True
+
+    @property
+    def records(self):
+        """
+        All the samples available as a structured array (one field per keyword), view on the file if they are in one
+        segment.
+        """
+        index = self.refresh()
+        parts = [self._segments[k][:index - _segment_start(self._first, k)]
+                 for k in range(_segment_of(self._first, index - 1) + 1)] if index else [self._segments[0][:0]]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    @property
+    def closed(self):
+        """
+        True once the writer is done: no more samples will be added.
+        """
+        return bool(int(self._preamble['flags']) & FLAG_CLOSED)
+
+    @property
+    def gate_time(self):
+        return self.header['gate_time']
+
+    @property
+    def uid(self):
+        return self.header['uid']
+
+    def close(self):
+        # the maps themselves are closed when the last view on them is released
+        self._preamble = None
+        self._segments = [np.zeros(0, dtype=self.dtype)]
+
+    def __len__(self):
+        return self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    #############
+    # INTERNALS #
+    #############
+    def _available(self):
+        return self.refresh()
+
+    def _map_segment(self, k):
+        # segment k as it is now (replaces a previous map of it), the views handed out keep the previous map alive
+        offset = self._offset if k == 0 else 0
+        with open(segment_path(self.path, k), 'rb') as f_in:
+            map_ = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+        records = np.ndarray(((len(map_) - offset) // self.dtype.itemsize,), dtype=self.dtype, buffer=map_,
+                             offset=offset)
+        if k < len(self._segments):
+            self._segments[k] = records
+        else:
+            self._segments.append(records)
+        if k == 0:
+            self._preamble = np.ndarray((), dtype=_PREAMBLE_DTYPE, buffer=map_)
+
+
+def read_header(path: str):
+    """
+    Returns the header (dictionary) of a live session file and the offset of its first record.
+    """
+    with open(path, 'rb') as f_in:
+        raw = f_in.read(_PREAMBLE_DTYPE.itemsize)
+        if len(raw) < _PREAMBLE_DTYPE.itemsize:
+            raise ValueError(f"{path} is not a live session file (too short)")
+        preamble = np.frombuffer(raw, dtype=_PREAMBLE_DTYPE)[0]
+        if raw[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a live session file (bad magic)")
+        if int(preamble['version']) > FORMAT_VERSION:
+            raise ValueError(f"{path} has an unsupported format version {int(preamble['version'])}")
+        offset = int(preamble['header_size'])
+        header = json.loads(f_in.read(offset - _PREAMBLE_DTYPE.itemsize).decode('utf-8'))
+    return header, offset
+
+
+if __name__ == '__main__':
+    import sys
+
+    # follow a live session until its writer is closed (or Ctrl-C)
+    with LiveSessionReader(sys.argv[1]) as reader:
+        print(f"{reader.path}: {reader.keywords}, gate time {reader.gate_time}s, {len(reader)} samples")
+        try:
+            while reader.wait(timeout=5.0) or not reader.closed:
+                columns = reader.read_new()
+                if len(columns[0]):
+                    print(f"+{len(columns[0])} samples, last: {[column[-1] for column in columns]}")
+        except KeyboardInterrupt:
+            pass
+        print(f"{len(reader)} samples, {'closed' if reader.closed else 'still open'}")
@@ -1,31 +1,42 @@
 import logging
 import time
-import threading as th
 import os.path
 
 import numpy as np
 
-from PyQt5.QtCore import QSettings, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import QSettings, pyqtSlot
 from PyQt5.QtWidgets import QMainWindow
 
 from .Gui.mainwin import Ui_MainWindow
+from .Gui.framescheduler import DEFAULT_MAX_FPS, FrameScheduler
 from .hamamatsu import GATE_TIMES, Hamamatsu
-from .buffer import SimpleBuffer
+from .buffer import DATAFOLDER, RingBuffer, build_date
+from .storage import CsvLogWriter, StorageWriter
+from .livefile import EXTENSION as LIVE_EXTENSION, LiveSessionWriter, remove as remove_live_session
+from .history import DEFAULT_MEMORY_BUDGET, TieredHistory
+from .decimation import MinMaxPyramid, envelope, minmax
+from .runningstats import StreamingStats
+from .pipeline import KEEP_ALL, AcquisitionPipeline
+from .driverprocess import DriverProcess
+from .supervisor import EVENT_FAILED, EVENT_RESTART, ReadoutSupervisor
 from .fourieranalysis_gui import FourierGui
 
-DATAFOLDER = os.path.join(os.path.realpath('.'), 'Data')
-
 DEFAULT_DISPLAY_TIME = 10.0
 DEFAULT_BUFFER_SIZE = 1000
+# longest display time (seconds), the plotted data comes from the tiered history
+MAX_DISPLAY_TIME = 24 * 3600.0
+# the plot is decimated when the display window has more than this many points per pixel
+DECIMATION_THRESHOLD = 2
+# longest scroll back (seconds before the last point), older data comes from the disk tier of the history
+MAX_SCROLL_BACK = 7 * 24 * 3600.0
+# the FFT is computed on at most this many samples (the most recent ones of the display window)
+FFT_MAX_POINTS = 2**20
+# seconds to wait for the previous acquisition to be processed before starting a new one
+DRAIN_TIMEOUT = 5.0
 
 TIMINGS = [str(key) for key in GATE_TIMES.keys()]
 
 
-def _build_date():
-    tt = time.gmtime()
-    return f'{tt.tm_mday:02d}.{tt.tm_mon:02d}.{tt.tm_year - 2000:02d}_{tt.tm_hour:02d}.{tt.tm_min:02d}.{tt.tm_sec:02d}'
-
-
 # todo: instead of printing 'e' we should add some extra info like: 'failed to start readout - msg: {str(e)}'
 # todo: all messages being written by dbg_console should end with a dot
 # todo: all Exception messages should not end with a dot (it should be added when writing to dbg_console)
@@ -33,9 +44,9 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
     """
     Implements GUI and logic for main window
     """
-    sig_update_plot = pyqtSignal()
-
-    def __init__(self):
+    def __init__(self, *, isolated_driver: bool = False, live_session: bool = False,
+                 history_budget: int = DEFAULT_MEMORY_BUDGET, incremental_plot: bool = False,
+                 max_fps: float = DEFAULT_MAX_FPS):
         super(PhotonCounterGui, self).__init__()
 
         # setup the UI code
@@ -45,25 +56,50 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
         # data
         # hardware is initialized to Hamamatsu() just to have type checking from PyCharm
         self._hardware = Hamamatsu()
-        # create a data readout thread
-        self._readout_thread = self._regenerate_read_thread()
-        self._readout_halt_event = th.Event()
-
-        # points buffer
-        self._data_buffer = SimpleBuffer(
+        # run the driver in a separate process (see driverprocess module)
+        self._isolated_driver = isolated_driver
+        # publish the samples in a memory-mapped file next to the log (see livefile module)
+        self._live_session = live_session
+        # only add the new samples to the plot at each update instead of redrawing the display window
+        self._incremental_plot = incremental_plot
+        # samples of the history already plotted (incremental mode)
+        self._plotted = 0
+        # the last update added the new samples to the plot (incremental mode)
+        self._appending = False
+        # data readout (created when the acquisition starts)
+        self._readout = None
+        # pipeline counters at the start of the acquisition
+        self._pipeline_start = {}
+
+        # points buffer (only the counts are stored, the times come from the start time and gate time of each block)
+        self._data_buffer = RingBuffer(
             DEFAULT_BUFFER_SIZE,
-            os.path.join(DATAFOLDER, f'log_{_build_date()}.csv'),
-            ['Counts'],
-            save=True
+            os.path.join(DATAFOLDER, f'log_{build_date()}.csv'),
+            ['Time', 'Counts'],
+            dtypes=[np.float64, np.uint32],
+            save=True,
+            timebase=True
         )
+        # everything acquired since the start of the acquisition, for the plot: recent points in RAM (up to
+        # history_budget bytes), older ones on disk
+        self._history = TieredHistory(['Time', 'Counts'], dtypes=[np.float64, np.uint32], memory_budget=history_budget)
+        # min/max of the counts at decreasing resolutions, to plot long display windows with one point per pixel
+        self._pyramid = MinMaxPyramid()
+        # moving average (and other running statistics) of the counts, computed once per block
+        self._stats = StreamingStats(int(self.mvavg_spinbox.value()))
+
+        # the readout thread only queues blocks in the pipeline, the consumers (running on their own threads) fill the
+        # buffer (and the log file) and trigger plot updates, each in batches.
+        self._pipeline = AcquisitionPipeline()
+        # only the display may drop blocks, every block goes to the log
+        self._pipeline.add_consumer('storage', self._store_blocks, policy=KEEP_ALL)
+        self._pipeline.add_consumer('display', self._display_blocks)
+        self._pipeline.start()
 
         # FFT analyser GUI
         self.fft_analysis = FourierGui()
 
         # todo: organize better how these values are stored ... don't leave them randomly around like this
-        # these are used for plotting the absolute min/max of moving average
-        self._mvavg_min = np.inf
-        self._mvavg_max = -np.inf
         self._start_time = 0.0
         self._measurement_time = 0.0
         self._measured_points = 0
@@ -75,11 +111,14 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
         # setup parameters widgets
         self.param_gate_time.addItems(TIMINGS)
         self.param_gate_time.setCurrentIndex(TIMINGS.index('100MS'))
+        self.display_time_box.setMaximum(MAX_DISPLAY_TIME)
         self.display_time_box.setValue(DEFAULT_DISPLAY_TIME)
+        self.scroll_back_box.setMaximum(MAX_SCROLL_BACK)
         self.buffer_size_box.setValue(DEFAULT_BUFFER_SIZE)
 
         # connect QtSignals to proper callback functions
         self.display_time_box.valueChanged.connect(self._on_display_time_change)
+        self.scroll_back_box.valueChanged.connect(self._on_scroll_back_change)
         self.buffer_size_box.valueChanged.connect(self._on_buffer_size_change)
         self.clearplot_bttn.pressed.connect(self._on_clear_plot_click)
         #
@@ -94,62 +133,111 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
         self.param_toggle_acquisition.setDisabled(True)
         self.param_toggle_acquisition.pressed.connect(self._on_toggle_acquisition)
         #
+        self.mvavg_spinbox.valueChanged.connect(self._on_mvavg_change)
         self.mvavg_minmax_checkbox.toggled.connect(self._on_mvavg_minmax_toggle)
         #
         self.fft_push_bttn.clicked.connect(self._on_fft_bttn_click)
 
-        # internal plot update signal
-        self.sig_update_plot.connect(self._update_plot)
+        # plot updates: at most max_fps per second, whatever the rate of the blocks (see _display_blocks), while the
+        # acquisition runs
+        self._frames = FrameScheduler(self._update_plot, max_fps=max_fps, parent=self)
 
     ####################
     # CLIENT INTERFACE #
     ####################
-    def add_data(self, values):
+    def add_data(self, block):
         """
-        Called by data readout thread when new data is available
+        Called by data readout thread when new data is available. 'block' is a ReadoutBuffer: counts and the time of
+        each gate (seconds since the start of the acquisition). The block is only queued, the pipeline consumers do the
+        actual work.
         """
-        # add to buffer
-        for val in values:
-            self._data_buffer.push_back(val)
+        self._pipeline.put(block)
+
+    @property
+    def pipeline_stats(self):
+        return self._pipeline.stats
 
-        self._measured_points += len(values)
-        self._measurement_time = time.time()
-        # signal for plot update (this should happen across threads)
-        # allows the data readout thread to push new data in buffer
-        # but keeps the Plot update in the main Thread (this is mandatory)
-        self.sig_update_plot.emit()
+    @property
+    def render_stats(self):
+        return self._frames.stats
 
     #############
     # INTERNALS #
     #############
-    @pyqtSlot()
+    def _store_blocks(self, blocks):
+        """
+        'storage' pipeline consumer: adds a batch of blocks to the buffer (which writes them to disk), to the statistics
+        and to the history. The statistics get them first: they have all the samples the plot reads from the history.
+        """
+        for block in blocks:
+            self._data_buffer.push_block(block.times, block.data)
+            self._stats.push(block.data)
+            self._history.push_block(block.times, block.data)
+            self._pyramid.push(block.times, block.data)
+
+    def _display_blocks(self, blocks):
+        """
+        'display' pipeline consumer: signals the new blocks to the frame scheduler, which updates the plot in the main
+        thread (this is mandatory) at its own pace, once for all the blocks received since the previous frame.
+        """
+        for block in blocks:
+            if block.gap:
+                self.dbg_console.write(f'Lost {block.gap} data block(s) before block {block.seq}.',
+                                       log=True,
+                                       level=logging.WARNING)
+            self._measured_points += len(block)
+        self._measurement_time = blocks[-1].t_recv
+        self._frames.notify(len(blocks))
+
     def _update_plot(self):
-        # compute amount of points to display
         gate_time = self._hardware.get_gatetime_data()[2]
         npoints = int((self.scroll_plot.display_time // gate_time) + 1)
-        # if the buffer is too small we need to limit the number of points to what we have
-        npoints = min(npoints, len(self._data_buffer.containers[0]))
+        decimated = min(npoints, len(self._history)) > DECIMATION_THRESHOLD * self.scroll_plot.pixel_width
+        scrolled = self.scroll_back_box.value() > 0
+        # only the live window is plotted incrementally
+        appending = self._incremental_plot and not decimated and not scrolled
+        if appending != self._appending and self._incremental_plot:
+            # the incremental and redrawn plots use different curves
+            self.scroll_plot.erase()
+            self._plotted = 0
+        self._appending = appending
+
+        if scrolled:
+            self._scrolled_plot(npoints)
+        elif decimated:
+            self._decimated_plot(npoints)
+        elif appending:
+            self._append_plot()
+        else:
+            self._redraw_plot()
 
-        xdata = (np.mgrid[0:npoints] - npoints) * gate_time
+        # update the elapsed time and num points
+        self.spinbox_elapsed_time.setValue(self._measurement_time - self._start_time)
+        self.spinbox_num_points.setValue(self._measured_points)
+
+    def _redraw_plot(self):
+        # compute amount of points to display
+        gate_time = self._hardware.get_gatetime_data()[2]
+        npoints = int((self.scroll_plot.display_time // gate_time) + 1)
+        # only copy the displayed window (at the beginning of the acquisition: what we have)
+        (times, ydata), end = self._history.since(len(self._history) - npoints)
+        if len(times) == 0:
+            return
 
-        # is this cast to list necessary?
-        ydata_full = list(self._data_buffer.containers[0])
-        ydata = ydata_full[-npoints:]
+        # time axis comes with the data (gaps included), shown relative to the last point
+        xdata = times - times[-1]
 
-        # moving average computation
+        # moving average, computed when the samples arrived
         ydata_avg = None
         if self.mvavg_checkbox.isChecked():
-            ydata_avg = self._get_moving_avg(ydata_full)[-npoints:]
-
-            self._mvavg_max = max(self._mvavg_max, np.max(ydata_avg))
-            self._mvavg_min = min(self._mvavg_min, np.min(ydata_avg))
+            ydata_avg = self._moving_avg(end - len(times), end)
 
         # moving average absolute min and max lines
         ydata_avg_min = None
         ydata_avg_max = None
         if self.mvavg_minmax_checkbox.isChecked():
-            ydata_avg_min = np.ones_like(xdata) * self._mvavg_min
-            ydata_avg_max = np.ones_like(xdata) * self._mvavg_max
+            ydata_avg_min = np.full(len(xdata), self._stats.mean_min)
+            ydata_avg_max = np.full(len(xdata), self._stats.mean_max)
 
         # update plot
         self.scroll_plot.plot(
@@ -160,21 +248,184 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
             ydata_avg_max
         )
 
-        # update the elapsed time and num points
-        self.spinbox_elapsed_time.setValue(self._measurement_time - self._start_time)
-        self.spinbox_num_points.setValue(self._measured_points)
-
         # update fft view if enabled:
         if self.fft_analysis.isActiveWindow():
             self.fft_analysis.process(xdata, ydata)
 
+    def _append_plot(self):
+        """
+        Incremental mode: only the samples acquired since the last update are added to the plot (time axis in seconds
+        since the start of the acquisition), the min/max lines show the extremes of the moving average so far.
+        """
+        gate_time = self._hardware.get_gatetime_data()[2]
+        npoints = int((self.scroll_plot.display_time // gate_time) + 1)
+        # nothing older than the display window (after a pause or a change of display time)
+        start = max(self._plotted, len(self._history) - npoints)
+        (xdata, ydata), self._plotted = self._history.since(start)
+        if len(xdata) == 0:
+            return
+
+        ydata_avg = None
+        if self.mvavg_checkbox.isChecked():
+            ydata_avg = self._moving_avg(self._plotted - len(xdata), self._plotted)
+
+        ydata_avg_min = None
+        ydata_avg_max = None
+        if self.mvavg_minmax_checkbox.isChecked():
+            ydata_avg_min = np.full(len(xdata), self._stats.mean_min)
+            ydata_avg_max = np.full(len(xdata), self._stats.mean_max)
+
+        self.scroll_plot.append(
+            xdata,
+            ydata,
+            ydata_avg,
+            ydata_avg_min,
+            ydata_avg_max
+        )
+
+        # the FFT needs the samples of the displayed window, not only the new ones
+        self._update_fft(npoints)
+
+    def _decimated_plot(self, npoints):
+        """
+        Display window with more points than pixels: each pixel column shows the minimum and maximum of the counts it
+        covers, so that no spike is lost. Up to pyramid.base points per pixel the bins are computed from the samples
+        (moving average decimated the same way, as long as the streaming stats still keep it for every sample), above
+        that they are read from the pyramid whatever the display time (the moving average is then the mean of each bin,
+        which spans more samples than any sensible moving average).
+        """
+        nbins = self.scroll_plot.pixel_width
+        ydata_avg = None
+        # the stats keep at least 'capacity' samples, half of it leaves room for the blocks pushed since the history
+        # was read
+        if npoints < min(self._pyramid.base * nbins, self._stats.capacity // 2):
+            (times, counts), end = self._history.since(len(self._history) - npoints)
+            if len(times) == 0:
+                return
+            t_stop = times[-1]
+            t, ymin, ymax = minmax(times, counts, nbins)
+            if self.mvavg_checkbox.isChecked():
+                _, ydata_avg = envelope(*minmax(times, self._moving_avg(end - len(times), end), nbins))
+        else:
+            t_stop = self._history.t_stop
+            if t_stop is None:
+                return
+            t_start = t_stop - self.scroll_plot.display_time
+            t, ymin, ymax, ymean = self._pyramid.window(t_start, None, 2 * nbins)
+            if len(t) == 0:
+                return
+            # the first bin may start before the window
+            t[0] = max(t[0], t_start)
+            if self.mvavg_checkbox.isChecked():
+                ydata_avg = np.repeat(ymean, 2)
+
+        xdata, ydata = envelope(t - t_stop, ymin, ymax)
+
+        ydata_avg_min = None
+        ydata_avg_max = None
+        if self.mvavg_minmax_checkbox.isChecked():
+            ydata_avg_min = np.full(len(xdata), self._stats.mean_min)
+            ydata_avg_max = np.full(len(xdata), self._stats.mean_max)
+
+        self.scroll_plot.plot(
+            xdata,
+            ydata,
+            ydata_avg,
+            ydata_avg_min,
+            ydata_avg_max
+        )
+
+        # the FFT needs the samples, not the bins
+        self._update_fft(npoints)
+
+    def _scrolled_plot(self, npoints):
+        """
+        Display window ending scroll_back seconds before the last point (time axis relative to the last point), read
+        from the history by time (cold tier included) or from the pyramid: only what is displayed is read, decimated as
+        the live window would be.
+        """
+        t_last = self._history.t_stop
+        if t_last is None:
+            return
+        t_stop = t_last - self.scroll_back_box.value()
+        t_start = t_stop - self.scroll_plot.display_time
+        nbins = self.scroll_plot.pixel_width
+        ydata_avg = None
+        if npoints < self._pyramid.base * nbins:
+            times, counts = self._history.read(t_start, t_stop)
+            if len(times) == 0:
+                return
+            if self.mvavg_checkbox.isChecked():
+                # the streaming stats only keep the recent samples
+                ydata_avg = self._moving_avg_of(counts)
+            if npoints > DECIMATION_THRESHOLD * nbins:
+                t, ymin, ymax = minmax(times, counts, nbins)
+                xdata, ydata = envelope(t - t_last, ymin, ymax)
+                if ydata_avg is not None:
+                    _, ydata_avg = envelope(*minmax(times, ydata_avg, nbins))
+            else:
+                xdata, ydata = times - t_last, counts
+        else:
+            t, ymin, ymax, ymean = self._pyramid.window(t_start, t_stop, 2 * nbins)
+            if len(t) == 0:
+                return
+            t[0] = max(t[0], t_start)
+            xdata, ydata = envelope(t - t_last, ymin, ymax)
+            if self.mvavg_checkbox.isChecked():
+                ydata_avg = np.repeat(ymean, 2)
+
+        ydata_avg_min = None
+        ydata_avg_max = None
+        if self.mvavg_minmax_checkbox.isChecked():
+            ydata_avg_min = np.full(len(xdata), self._stats.mean_min)
+            ydata_avg_max = np.full(len(xdata), self._stats.mean_max)
+
+        self.scroll_plot.plot(
+            xdata,
+            ydata,
+            ydata_avg,
+            ydata_avg_min,
+            ydata_avg_max
+        )
+
+        self._update_fft(npoints, t_stop)
+
+    def _update_fft(self, npoints, t_stop=None):
+        """
+        Sends the last 'npoints' samples before t_stop (up to the last one when None) to the FFT window, if it is open.
+        At most FFT_MAX_POINTS samples are read: a long display window would otherwise be copied from the history
+        (disk tier included) at every frame.
+        """
+        if not self.fft_analysis.isActiveWindow():
+            return
+        npoints = min(npoints, FFT_MAX_POINTS)
+        if t_stop is None:
+            times, ydata = self._history.last(npoints)
+        else:
+            gate_time = self._hardware.get_gatetime_data()[2]
+            times, ydata = self._history.read(t_stop - npoints * gate_time, t_stop)
+        if len(times):
+            self.fft_analysis.process(times - times[-1], ydata)
+
     #############################
     # CALLBACK FOR USER ACTIONS #
     #############################
     @pyqtSlot()
     def _on_display_time_change(self):
         self.scroll_plot.display_time = self.display_time_box.value()
+        if self._incremental_plot:
+            # plot the new display window again at the next update
+            self.scroll_plot.erase()
+            self._plotted = 0
         self.fft_analysis.set_display_time(self.display_time_box.value())
+        # the new window is shown at once, even if the acquisition is stopped
+        if len(self._history):
+            self._update_plot()
+
+    @pyqtSlot()
+    def _on_scroll_back_change(self):
+        if len(self._history):
+            self._update_plot()
 
     @pyqtSlot()
     def _on_buffer_size_change(self):
@@ -184,11 +435,19 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
     def _on_clear_plot_click(self):
         self.scroll_plot.erase()
 
+    @pyqtSlot()
+    def _on_mvavg_change(self):
+        # the statistics are computed again once, not at each plot update
+        self._stats.window = self.mvavg_spinbox.value()
+        if self._incremental_plot:
+            # plot the new moving average at the next update
+            self.scroll_plot.erase()
+            self._plotted = 0
+
     @pyqtSlot(bool)
     def _on_mvavg_minmax_toggle(self, checked):
         if not checked:
-            self._mvavg_max = -np.inf
-            self._mvavg_min = np.inf
+            self._stats.reset_extremes()
 
     @pyqtSlot(bool)
     def _on_fft_bttn_click(self, checked):
@@ -198,7 +457,10 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
     @pyqtSlot()
     def _on_connect(self):
         try:
-            self._hardware = Hamamatsu.open()
+            if self._isolated_driver:
+                self._hardware = DriverProcess.open()
+            else:
+                self._hardware = Hamamatsu.open()
         except ValueError as e:
             self.dbg_console.write(e, log=True, level=logging.WARNING)
         except (TimeoutError, RuntimeError) as e:
@@ -246,21 +508,58 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
     @pyqtSlot()
     def _on_toggle_acquisition(self):
         if not self._hardware.is_counting:
+            # the blocks of the previous acquisition still in the pipeline go to its log, then it is closed
+            if not self._pipeline.drain(timeout=DRAIN_TIMEOUT):
+                self.dbg_console.write('The previous acquisition is still being processed, try again.',
+                                       log=True,
+                                       level=logging.WARNING)
+                return
+            self._data_buffer.close()
+
+            # new log file (written by the storage thread) and empty plot data: all in place before the first block
+            fname = f'log_{build_date()}.csv'
+            path = os.path.join(DATAFOLDER, fname)
+            live_path = os.path.splitext(path)[0] + LIVE_EXTENSION
+            self._data_buffer.filepath = path
+            # the time axis starts again from zero
+            self._history.clear()
+            self._stats.clear()
+            self._pyramid.clear()
+            self._plotted = 0
+            if self._incremental_plot:
+                self.scroll_plot.erase()
+            self._data_buffer.log = StorageWriter(
+                CsvLogWriter(path, ['Time', 'Counts'], dtypes=[np.float64, np.uint32],
+                             header=f"# GATE TIME {self._hardware.gate_time}."),
+                dtypes=[np.float64, np.uint32],
+                # a crash loses at most the last few seconds of data
+                durability='periodic'
+            )
+            if self._live_session:
+                self._data_buffer.live = LiveSessionWriter(live_path, ['Time', 'Counts'],
+                                                           dtypes=[np.float64, np.uint32],
+                                                           gate_time=self._hardware.get_gatetime_data()[2],
+                                                           uid=self._hardware.uid)
+            self._start_time = time.time()
+            self._pipeline_start = self._pipeline.stats
+
+            # the supervisor starts the counting and restarts the readout if the driver stalls
+            self._readout = ReadoutSupervisor(self._hardware, self.add_data, on_event=self._on_readout_event)
             try:
-                self._hardware.count_start()
+                self._readout.start()
             except (RuntimeError, TimeoutError) as e:
                 self.dbg_console.write(f'Could not start counting. Msg: {str(e)}.', log=True, level=logging.ERROR)
+                # nothing was acquired: drop the new (empty) log files
+                self._data_buffer.close()
+                if os.path.isfile(path):
+                    os.remove(path)
+                if self._live_session:
+                    remove_live_session(live_path)
             else:
-                # save start time
-                self._start_time = time.time()
-                # setup the buffer filepath and header information
-                fname = f'log_{_build_date()}.csv'
-                path = os.path.join(DATAFOLDER, fname)
-                self._data_buffer.filepath = path
-                self._data_buffer.header_extra = f"# GATE TIME {self._hardware.gate_time}."
-
+                if self._live_session:
+                    self.dbg_console.write(f'Publishing live data in {live_path}.', log=True, level=logging.INFO)
                 self.dbg_console.write('Starting data readout.', log=True, level=logging.INFO)
-                self._readout_thread.start()
+                self._frames.start()
 
                 self.param_toggle_acquisition.setText('Stop Acquisition')
                 # disable connect, power and gate time buttons
@@ -268,26 +567,34 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
                 self.param_set_gatetime.setEnabled(False)
                 self.param_toggle_power.setEnabled(False)
         else:
-            # stop readout thread
-            self._readout_halt_event.set()
-            # todo: this timeout time should not be hardcoded
-            self._readout_thread.join(1.0)
-            # I've noticed that most of the time the Hardware library fucks up and the data Thread does not
-            # rejoin the main thread. So check if that happened:
-            if self._readout_thread.is_alive():
-                self.dbg_console.write('Failed to stop data readout thread correctly.',
-                                       log=True,
-                                       level=logging.WARNING)
-            # Even if readout thread didn't stop correctly we can hope that the Garbage collector will take care of it.
-            # So just generate a new thread and the old one should have zero references left.
-            self._readout_thread = self._regenerate_read_thread()
-            # Attempt to stop Hardware from counting photons
+            # stop readout worker and Hardware counting
             try:
-                self._hardware.count_stop()
+                stopped = self._readout.stop()
             except (RuntimeError, TimeoutError) as e:
                 self.dbg_console.write(f'Could not stop counting unit. Msg: {str(e)}.', log=True, level=logging.ERROR)
             else:
+                if not stopped:
+                    self.dbg_console.write(f'Failed to stop data readout correctly '
+                                           f'({self._readout.stray_workers} stray worker(s)).',
+                                           log=True,
+                                           level=logging.WARNING)
+                stats = self._readout.stats
+                if stats['restarts']:
+                    self.dbg_console.write(f"Readout was restarted {stats['restarts']} time(s), "
+                                           f"{stats['lost_samples']} samples lost.",
+                                           log=True,
+                                           level=logging.WARNING)
                 self.dbg_console.write('Data readout stopped.', log=True, level=logging.INFO)
+                # the last blocks are shown, then the plot is only updated by the user actions
+                self._pipeline['display'].drain(DRAIN_TIMEOUT)
+                self._frames.stop()
+                self._report_pipeline()
+                render = self._frames.stats
+                self.dbg_console.write(f"Display: {render['frames_rendered']} frames rendered ({render['fps']:.1f} fps), "
+                                       f"{render['frames_skipped']} skipped, frame time p99 "
+                                       f"{render['frame_time_p99_ms'] or 0.0:.1f}ms.",
+                                       log=True,
+                                       level=logging.INFO)
                 self.param_toggle_acquisition.setText('Start Acquisition')
                 # enable connect, power and gate time buttons
                 self.param_connect.setEnabled(True)
@@ -297,41 +604,54 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
     #############
     # INTERNALS #
     #############
-    def _regenerate_read_thread(self):
-        self.dbg_console.write('Initialized new data-readout thread.', log=True, level=logging.INFO)
-        return th.Thread(name='Data Reader', target=self._data_readout, daemon=True)
-
-    def _data_readout(self):
-        self.dbg_console.write('Starting data readout.', log=True, level=logging.INFO)
-        # compute delay between calls
-        # todo: do we really need this? shouldn't the hardware take care of the delay between calls?
-        _, num_gates, gate_time = self._hardware.get_gatetime_data()
-        delay = num_gates * gate_time * 0.9
-
-        while True:
-            # check if the 'Halt event' is set, if yes break from the loop.
-            if self._readout_halt_event.is_set():
-                self._readout_halt_event.clear()
-                self.dbg_console.write('Data readout thread received halt signal.', log=True, level=logging.INFO)
-                break
-
-            try:
-                data = self._hardware.read_data()
-            except (RuntimeError, TimeoutError) as e:
-                self.dbg_console.write(e, log=True, level=logging.ERROR)
-                break
-            else:
-                self.add_data(data)
-            #time.sleep(delay)
+    def _on_readout_event(self, kind, info):
+        """
+        Called by the readout supervisor (watchdog thread).
+        """
+        if kind == EVENT_RESTART:
+            self.dbg_console.write(f"Readout restarted ({info['reason']}), {info['lost_samples']} samples lost.",
+                                   log=True,
+                                   level=logging.WARNING)
+        elif kind == EVENT_FAILED:
+            self.dbg_console.write(f"Readout failed after {info['restarts']} restarts, stop the acquisition.",
+                                   log=True,
+                                   level=logging.ERROR)
+
+    def _report_pipeline(self):
+        """
+        Writes the blocks dropped (or queued beyond the queue size) by the pipeline consumers during the acquisition.
+        """
+        for name, stats in self._pipeline.stats.items():
+            start = self._pipeline_start.get(name, {})
+            dropped = stats['dropped'] - start.get('dropped', 0)
+            overflows = stats['overflows'] - start.get('overflows', 0)
+            if dropped:
+                # the display skips blocks when it cannot keep up, anything else loses data
+                self.dbg_console.write(f'Pipeline: the {name} consumer dropped {dropped} block(s).',
+                                       log=True,
+                                       level=logging.INFO if name == 'display' else logging.ERROR)
+            if overflows:
+                self.dbg_console.write(f"Pipeline: the {name} consumer fell behind by up to {stats['max_depth']} "
+                                       f"block(s), none dropped.",
+                                       log=True,
+                                       level=logging.WARNING)
 
-        self.dbg_console.write('Data readout completed.', log=True, level=logging.INFO)
+    def _moving_avg(self, start, stop):
+        """
+        Moving average of the samples start..stop-1 of the history (indices since the start of the acquisition).
+        """
+        return self._stats.read(start, stop, ['mean'])[0]
 
-    def _get_moving_avg(self, data):
-        n = int(self.mvavg_spinbox.value())
-        if len(data) < n:
-            return data
-        avg = np.convolve(data, np.ones(n), 'valid') / n
-        return np.concatenate((data[:n-1], avg))
+    def _moving_avg_of(self, counts):
+        """
+        Moving average of 'counts' computed on the spot, for samples older than what the streaming stats keep (the first
+        window - 1 values average the samples available).
+        """
+        window = self.mvavg_spinbox.value()
+        csum = np.cumsum(counts, dtype=np.float64)
+        total = csum.copy()
+        total[window:] -= csum[:-window]
+        return total / np.minimum(np.arange(1, len(counts) + 1), window)
 
     ########################
     # SETTINGS AND CLOSING #
@@ -363,9 +683,13 @@ class PhotonCounterGui(QMainWindow, Ui_MainWindow):
         self.fft_analysis.close()
 
         # try to put hardware in safe condition
-        if self._hardware.is_counting:
-            self._readout_halt_event.set()
-            self._hardware.count_stop()
+        if self._readout is not None and self._hardware.is_counting:
+            self._readout.stop()
+        # let the consumers process what's left in the queues, then write it to disk
+        self._pipeline.stop()
+        self._frames.stop()
+        self._data_buffer.close()
+        self._history.close()
 
         self._hardware.set_power(False)
         self._hardware.close()
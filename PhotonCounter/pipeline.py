@@ -0,0 +1,250 @@
+"""
+Module implements the acquisition pipeline: the readout thread hands whole data blocks to the pipeline, which fans them
+out to independent consumers (storage, display, analysis...). Each consumer owns a queue and drains it in batches from
+its own thread, a slow consumer never blocks the readout or the other consumers: it drops blocks from its own queue
+(display, analysis), or lets its queue grow beyond its size and warns (KEEP_ALL, for the storage: no data is lost as long
+as memory lasts).
+"""
+from collections import deque
+import logging
+import threading as th
+import time
+
+# default length of each consumer queue (in blocks)
+DEFAULT_QUEUE_SIZE = 64
+# default maximum number of blocks handed to a consumer callback at once
+DEFAULT_BATCH_SIZE = 32
+
+# what to do when a consumer queue is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+KEEP_ALL = 'keep_all'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, KEEP_ALL)
+
+
+class Consumer:
+    """
+    A pipeline stage. 'callback' is called from the consumer thread with a list of blocks (at most batch_size, in
+    arrival order). Blocks are released once the callback returns, so the callback must copy whatever it needs to keep.
+    A queue counts as congested (backpressure) when it is filled above 3/4 of its size. With the KEEP_ALL policy the
+    queue grows beyond its size instead of dropping blocks, a warning is logged each time it doubles ('overflows'
+    counts the blocks queued beyond the size).
+    """
+    def __init__(self, name: str, callback, *, maxsize: int = DEFAULT_QUEUE_SIZE,
+                 batch_size: int = DEFAULT_BATCH_SIZE, policy: str = DROP_OLDEST):
+        if maxsize <= 0:
+            raise ValueError(f"Queue size must be positive, got {maxsize}")
+        if batch_size <= 0:
+            raise ValueError(f"Batch size must be positive, got {batch_size}")
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, use one of {POLICIES}")
+
+        self.name = name
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.policy = policy
+
+        self._callback = callback
+        self._queue = deque()
+        self._cond = th.Condition()
+        self._halt = False
+        self._busy = False
+        self._thread = None
+
+        # counters
+        self.received = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.congested = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.busy_time = 0.0
+        # next depth to warn about (KEEP_ALL)
+        self._high_water = 2 * maxsize
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def put(self, block):
+        """
+        Queues a block (the consumer takes its own reference on it). Never blocks.
+        """
+        with self._cond:
+            self.received += 1
+            if len(self._queue) >= self.maxsize:
+                if self.policy == KEEP_ALL:
+                    self.overflows += 1
+                    if len(self._queue) >= self._high_water:
+                        logging.warning(f'Consumer {self.name} is {len(self._queue)} blocks behind')
+                        self._high_water *= 2
+                elif self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                else:
+                    self.dropped += 1
+                    self._queue.popleft().release()
+            elif len(self._queue) < self.maxsize // 2:
+                self._high_water = 2 * self.maxsize
+
+            self._queue.append(block.retain())
+            depth = len(self._queue)
+            self.max_depth = max(self.max_depth, depth)
+            if 4 * depth > 3 * self.maxsize:
+                self.congested += 1
+            # drain() may be waiting on the same condition
+            self._cond.notify_all()
+
+    def start(self):
+        self._halt = False
+        self._thread = th.Thread(name=f'Consumer {self.name}', target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 1.0):
+        with self._cond:
+            self._halt = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logging.warning(f'Consumer {self.name} did not stop within {timeout}s')
+        # release whatever is left
+        with self._cond:
+            while self._queue:
+                self._queue.popleft().release()
+
+    def drain(self, timeout: float = None):
+        """
+        Waits until every block queued so far has been processed. Returns False on timeout.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._busy or self._thread is None
+                                       or not self._thread.is_alive(), timeout)
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    @property
+    def stats(self):
+        with self._cond:
+            return {
+                'depth': len(self._queue),
+                'max_depth': self.max_depth,
+                'received': self.received,
+                'dropped': self.dropped,
+                'overflows': self.overflows,
+                'congested': self.congested,
+                'batches': self.batches,
+                'busy_time': self.busy_time,
+            }
+
+    #############
+    # INTERNALS #
+    #############
+    def _next_batch(self):
+        with self._cond:
+            while not self._queue and not self._halt:
+                self._cond.wait()
+            # on halt whatever is still queued is processed first
+            if not self._queue:
+                return None
+            nblocks = min(len(self._queue), self.batch_size)
+            self._busy = True
+            return [self._queue.popleft() for _ in range(nblocks)]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+
+            t0 = time.perf_counter()
+            try:
+                self._callback(batch)
+            except Exception as e:
+                logging.error(f'Consumer {self.name} failed to process a batch. Msg: {str(e)}')
+            finally:
+                for block in batch:
+                    block.release()
+            with self._cond:
+                self.busy_time += time.perf_counter() - t0
+                self.batches += 1
+                self._busy = False
+                self._cond.notify_all()
+
+
+class AcquisitionPipeline:
+    """
+    Fans out data blocks (hamamatsu.ReadoutBuffer, or anything with retain()/release()) from the readout thread to the
+    registered consumers. put() only takes a reference per consumer and returns: the readout thread is never blocked
+    by disk or GUI work.
+    """
+    def __init__(self):
+        self._consumers = {}
+        self._running = False
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def add_consumer(self, name: str, callback, **kwargs):
+        """
+        Registers a new consumer, see Consumer for the keyword arguments.
+        """
+        if name in self._consumers:
+            raise ValueError(f"Consumer {name} already registered")
+        consumer = Consumer(name, callback, **kwargs)
+        self._consumers[name] = consumer
+        if self._running:
+            consumer.start()
+        return consumer
+
+    def put(self, block):
+        for consumer in self._consumers.values():
+            consumer.put(block)
+
+    def start(self):
+        for consumer in self._consumers.values():
+            consumer.start()
+        self._running = True
+
+    def stop(self, timeout: float = 1.0):
+        for consumer in self._consumers.values():
+            consumer.stop(timeout)
+        self._running = False
+
+    def drain(self, timeout: float = None):
+        """
+        Waits until every consumer has processed the blocks queued so far (e.g. before switching to a new log).
+        Returns False if some consumer did not within timeout (each one gets the full timeout).
+        """
+        return all([consumer.drain(timeout) for consumer in self._consumers.values()])
+
+    @property
+    def stats(self):
+        return {name: consumer.stats for name, consumer in self._consumers.items()}
+
+    def __getitem__(self, name):
+        return self._consumers[name]
+
+
+if __name__ == '__main__':
+    from .hamamatsu import Hamamatsu
+
+    hw = Hamamatsu.open()
+    hw.gate_time = '100MS'
+    hw.setup(mode=1)
+
+    pipe = AcquisitionPipeline()
+    pipe.add_consumer('print', lambda blocks: print([b.seq for b in blocks]))
+    pipe.add_consumer('slow', lambda blocks: time.sleep(1.0), maxsize=2)
+    pipe.start()
+
+    hw.count_start()
+    for _ in range(8):
+        bb = hw.read_block()
+        pipe.put(bb)
+        bb.release()
+    hw.count_stop()
+
+    pipe.stop()
+    print(pipe.stats)
@@ -0,0 +1,261 @@
+"""
+Module implements a replay 'driver': the same functions as the hardware library (see fakelib), but the blocks returned
+by C8855ReadData come from a recorded session (CSV or binary log, or the manifest of a segmented session) instead of a
+counting unit. It lets the whole acquisition chain (buffer, moving average, FFT window, filters) run again on data
+captured in the field, to reproduce issues or to profile the processing stages on real workloads.
+
+    from PhotonCounter import hamamatsu, replaylib
+    replaylib.configure(path='Data/log_01.01.24_10.00.00.bpc', speed=10.0)
+    hamamatsu.set_library(replaylib)
+
+The session is replayed at its recorded pace (speed 1), N times faster (speed N), slower (speed < 1) or as fast as
+possible (speed 0), clock_speed() tells the readout so that it does not take the pace for late blocks. Gaps in the
+recording are not reproduced: the samples are served back to back, the samples left at the end that do not fill a
+whole block are dropped (and logged). The unit only accepts the recorded gate
+time in C8855Setup. At the end of the session (without 'loop') C8855ReadData fails like an unplugged unit, restarting
+the count does not rewind the session (so a supervised readout gives up instead of looping): set the unit up again to
+replay from the beginning.
+"""
+from ctypes import c_uint8, c_uint32, cast, POINTER
+from functools import wraps
+import logging
+import time
+
+import numpy as np
+
+from .fakelib import GATE_CODES
+from .session import open_session
+
+# a recorded session is one counting unit
+NUM_DEVICES = 1
+
+# default replay parameters, change them with configure()
+DEFAULT_CONFIG = {
+    'path': None,           # session to replay (log file or segmented session manifest)
+    'speed': 1.0,           # 1: recorded pace, N: N times faster, 0: unthrottled
+    'loop': False,          # start again from the beginning at the end of the session
+    't_start': None,        # replay only t_start <= time < t_stop (seconds in the session)
+    't_stop': None,
+}
+
+_config = dict(DEFAULT_CONFIG)
+_players = {}
+
+
+def debug(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        logging.debug(f"Function {f.__name__} was called")
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def configure(**kwargs):
+    """
+    Changes the replay parameters (see DEFAULT_CONFIG). Applies to the units opened afterwards.
+    """
+    for key in kwargs:
+        if key not in DEFAULT_CONFIG:
+            raise ValueError(f"Unknown replay parameter {key}")
+    if kwargs.get('speed') is not None and kwargs['speed'] < 0:
+        raise ValueError(f"Replay speed must be positive (or 0 for unthrottled), got {kwargs['speed']}")
+    _config.update(kwargs)
+
+
+def reset_config():
+    _config.clear()
+    _config.update(DEFAULT_CONFIG)
+
+
+def clock_speed():
+    """
+    Pace of the blocks relative to the gate time (see hamamatsu.set_library): the replay speed, 0 if unthrottled.
+    """
+    return _config['speed']
+
+
+def recorded_gate_time(path: str = None):
+    """
+    Gate time (seconds) of the session to replay.
+    """
+    with open_session(path or _config['path']) as session:
+        return _session_gate_time(session)
+
+
+def _session_gate_time(session):
+    if session.gate_time is not None:
+        return session.gate_time
+    # not recorded: use the spacing of the first samples
+    for times, _ in session.iter_chunks(chunk_size=1000):
+        if len(times) > 1:
+            return float(np.median(np.diff(times)))
+    raise ValueError(f"Cannot tell the gate time of {session.path}")
+
+
+class Player:
+    """
+    Serves the samples of a recorded session block after block, paced like the hardware (scaled by 'speed').
+    """
+    def __init__(self, handle: int, *, path, speed, loop, t_start, t_stop):
+        if path is None:
+            raise ValueError("No session to replay, call replaylib.configure(path=...) first")
+
+        self.handle = handle
+        self.speed = speed
+        self.loop = loop
+        self.t_start = t_start
+        self.t_stop = t_stop
+
+        self.session = open_session(path)
+        self.recorded_gate_time = _session_gate_time(self.session)
+        self.gate_time = self.recorded_gate_time
+        self.gates = 5
+        self.finished = False
+
+        self._chunks = None
+        self._pending = np.zeros(0, dtype=np.uint32)
+        self._gate_index = 0
+        self._t0 = time.monotonic()
+
+    def setup(self, gate_time: float, gates: int):
+        if not np.isclose(gate_time, self.recorded_gate_time):
+            logging.error(f'Replay: the session was recorded with a gate time of {self.recorded_gate_time}s, '
+                          f'got {gate_time}s')
+            return False
+        self.gates = gates
+        self.finished = False
+        return True
+
+    def start(self):
+        if self.finished:
+            return
+        self._chunks = self.session.iter_chunks(self.t_start, self.t_stop)
+        self._pending = np.zeros(0, dtype=np.uint32)
+        self._gate_index = 0
+        self._t0 = time.monotonic()
+
+    def read(self, out):
+        """
+        Fills 'out' (NumPy array) with the next block, False at the end of the session.
+        """
+        n = out.shape[0]
+        while len(self._pending) < n:
+            chunk = next(self._chunks, None) if self._chunks is not None else None
+            if chunk is None:
+                if not self.loop or self._gate_index == 0 and not len(self._pending):
+                    if not self.finished:
+                        if len(self._pending):
+                            logging.warning(f'Replay: dropped the last {len(self._pending)} samples of '
+                                            f'{self.session.path} (less than a block of {n} gates)')
+                        logging.info(f'Replay of {self.session.path} finished after {self._gate_index} gates')
+                    self.finished = True
+                    return False
+                self._chunks = self.session.iter_chunks(self.t_start, self.t_stop)
+                continue
+            self._pending = np.concatenate((self._pending, chunk[1]))
+
+        out[:] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self._gate_index += n
+        if self.speed:
+            delay = self._t0 + self._gate_index * self.gate_time / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return True
+
+    def close(self):
+        self.session.close()
+
+
+@debug
+def C8855Open():
+    for handle in range(1, NUM_DEVICES + 1):
+        if handle not in _players:
+            try:
+                _players[handle] = Player(handle, **_config)
+            except (OSError, ValueError) as e:
+                logging.error(f'Replay: cannot open the session. Msg: {str(e)}')
+                return 0
+            return handle
+    # no free unit
+    return 0
+
+
+@debug
+def C8855Close(handle):
+    player = _players.pop(handle, None)
+    if player is not None:
+        player.close()
+    return 1
+
+
+@debug
+def C8855Reset(hhandle):
+    return 1
+
+
+@debug
+def C8855CountStart(hhandle, trig):
+    _players[hhandle].start()
+    return 1
+
+
+@debug
+def C8855CountStop(hhandle):
+    return 1
+
+
+@debug
+def C8855Setup(hhandle, times, mode_c, n_gates_c):
+    gate_time = GATE_CODES.get(times.value)
+    if gate_time is None:
+        return 0
+    return int(_players[hhandle].setup(gate_time, n_gates_c.value))
+
+
+@debug
+def C8855SetPmtPower(hhandle, pow_mode):
+    return 1
+
+
+# not decorated with @debug: logging every readout would dominate the cost at short gate times
+def C8855ReadData(hhandle, data, result):
+    player = _players.get(hhandle)
+    if player is None:
+        return 0
+    pnt = cast(data, POINTER(c_uint32))
+    return int(player.read(np.ctypeslib.as_array(pnt, shape=(player.gates,))))
+
+
+@debug
+def C8855ReadId(hhandle, uid):
+    # use the handle as unique ID
+    cast(uid, POINTER(c_uint8))[0] = c_uint8(hhandle)
+    return 1
+
+
+if __name__ == '__main__':
+    import sys
+
+    from . import hamamatsu
+
+    configure(path=sys.argv[1], speed=float(sys.argv[2]) if len(sys.argv) > 2 else 0.0)
+    hamamatsu.set_library(sys.modules[__name__])
+
+    hw = hamamatsu.Hamamatsu.open()
+    names = [name for name, (_, _, seconds) in hamamatsu.GATE_TIMES.items() if np.isclose(seconds, recorded_gate_time())]
+    hw.gate_time = names[0]
+    hw.setup(mode=1)
+    hw.count_start()
+    nsamples, total = 0, 0
+    t0 = time.perf_counter()
+    try:
+        while True:
+            with hw.read_block() as block:
+                nsamples += len(block)
+                total += int(block.data.sum())
+    except RuntimeError:
+        pass
+    dt = time.perf_counter() - t0
+    hw.close()
+    print(f'{nsamples} samples replayed in {dt:.2f}s ({nsamples / dt:.3g} samples/s), {total} counts')
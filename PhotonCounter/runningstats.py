@@ -0,0 +1,255 @@
+"""
+Module implements streaming statistics of the acquired counts, computed once when each block arrives instead of over
+the whole display window at every plot update:
+    - mean: moving average over the last 'window' samples (running sums)
+    - ema: exponential moving average (smoothing factor 'alpha', default 2 / (window + 1))
+    - var: variance over the last 'window' samples (running sums of squares)
+    - min, max: extremes over the last 'window' samples (van Herk/Gil-Werman: 3 comparisons per sample, whatever the
+      window)
+Each block is processed with NumPy in O(1) per sample: only the last window - 1 samples before it are read again. The
+first samples of the stream use the samples available so far (shorter windows).
+
+The results of the last 'capacity' samples are kept as arrays, ready to plot. Changing the window recomputes them once
+from the samples kept, not at every read.
+"""
+import threading as th
+
+import numpy as np
+
+STATS = ('mean', 'ema', 'var', 'min', 'max')
+DEFAULT_WINDOW = 10
+# samples (and results) kept
+DEFAULT_CAPACITY = 2**18
+# largest power of 1 / (1 - alpha) used by the exponential moving average (see _ema)
+_EMA_MAX_SCALE = 1e150
+
+
+def _sliding(values, n, ufunc):
+    """
+    ufunc (np.minimum, np.maximum) reduction of each run of 'n' consecutive values: len(values) - n + 1 results.
+    """
+    npoints = values.shape[0] - n + 1
+    nblocks = -(-values.shape[0] // n)
+    padded = np.empty(nblocks * n)
+    padded[:values.shape[0]] = values
+    padded[values.shape[0]:] = values[-1]
+    blocks = padded.reshape(nblocks, n)
+    # reduction from the start of its block to each value, and from each value to the end of its block
+    prefix = ufunc.accumulate(blocks, axis=1).ravel()
+    suffix = ufunc.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    return ufunc(suffix[:npoints], prefix[n - 1:n - 1 + npoints])
+
+
+def _ema(values, alpha, previous):
+    """
+    Exponential moving average of 'values' following 'previous' (None: starts at the first value), in closed form:
+    ema[i] = d^(i+1) * (previous + alpha * sum(values[j] / d^(j+1), j <= i)), with d = 1 - alpha, computed in chunks
+    short enough for the powers of d to stay within the float range.
+    """
+    decay = 1.0 - alpha
+    if decay == 0.0 or values.shape[0] == 0:
+        return values.astype(float)
+    if previous is None:
+        previous = float(values[0])
+    chunk = max(int(np.log(_EMA_MAX_SCALE) / -np.log(decay)), 1)
+    out = np.empty(values.shape[0])
+    for start in range(0, values.shape[0], chunk):
+        powers = decay ** np.arange(1, min(chunk, values.shape[0] - start) + 1)
+        out[start:start + powers.shape[0]] = powers * (previous + alpha * np.cumsum(
+            values[start:start + powers.shape[0]] / powers))
+        previous = out[start + powers.shape[0] - 1]
+    return out
+
+
+class StreamingStats:
+    """
+    Streaming statistics of a signal (see STATS), fed block by block with push(). The results are read by sample index
+    (counted from the last clear()) with read() or last(). push() and the reads can be called from different threads.
+    mean_min and mean_max are the extremes of the moving average since the last reset_extremes().
+    """
+    def __init__(self, window: int = DEFAULT_WINDOW, *, alpha: float = None, capacity: int = DEFAULT_CAPACITY):
+        if capacity < 1:
+            raise ValueError(f"Capacity must be at least 1 sample, got {capacity}")
+        self._check(window, alpha)
+        self._window = window
+        self._alpha = alpha
+        self.capacity = capacity
+
+        # samples then results (one column per name in STATS): column[:_end], sample _total - 1 is the last one
+        self._columns = [np.empty(2 * capacity) for _ in range(1 + len(STATS))]
+        self._end = 0
+        self._total = 0
+        self._lock = th.Lock()
+        self.reset_extremes()
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def push(self, values):
+        values = np.asarray(values, dtype=float)
+        if values.shape[0] == 0:
+            return
+        with self._lock:
+            history = self._columns[0][max(self._end - self._window + 1, 0):self._end]
+            previous = self._columns[1 + STATS.index('ema')][self._end - 1] if self._end else None
+            results = self._compute(np.concatenate((history, values)), history.shape[0], previous)
+            self._append(values, results)
+            self._update_extremes(results[STATS.index('mean')])
+
+    def read(self, start: int, stop: int = None, names=STATS):
+        """
+        Returns the results for the samples start..stop-1 (stop None: up to the last one, both clipped to the samples
+        pushed), one array per name. The samples no longer kept (more than 'capacity' samples ago) are NaN.
+        """
+        with self._lock:
+            stop = self._total if stop is None else min(stop, self._total)
+            start = min(max(start, 0), stop)
+            first = self._total - self._end
+            # indices in the columns
+            begin, end = max(start - first, 0), max(stop - first, 0)
+            missing = min(max(first - start, 0), stop - start)
+            out = []
+            for name in names:
+                values = np.empty(stop - start)
+                values[:missing] = np.nan
+                values[missing:] = self._columns[1 + STATS.index(name)][begin:end]
+                out.append(values)
+            return out
+
+    def last(self, npoints: int, names=STATS):
+        """
+        Returns the results for the last 'npoints' samples (fewer if fewer were pushed), one array per name.
+        """
+        with self._lock:
+            total = self._total
+        return self.read(total - npoints, total, names)
+
+    def clear(self):
+        """
+        Drops all the samples, e.g. before a new acquisition.
+        """
+        with self._lock:
+            self._end = 0
+            self._total = 0
+        self.reset_extremes()
+
+    def reset_extremes(self):
+        self.mean_min = np.inf
+        self.mean_max = -np.inf
+
+    @property
+    def window(self):
+        return self._window
+
+    @window.setter
+    def window(self, value: int):
+        """
+        Changes the window, the results of the samples kept are computed again (once).
+        """
+        self._check(value, self._alpha)
+        with self._lock:
+            self._window = value
+            self._recompute()
+
+    @property
+    def alpha(self):
+        """
+        Smoothing factor of the exponential moving average.
+        """
+        return self._alpha if self._alpha is not None else 2.0 / (self._window + 1)
+
+    @alpha.setter
+    def alpha(self, value: float):
+        self._check(self._window, value)
+        with self._lock:
+            self._alpha = value
+            self._recompute()
+
+    def __len__(self):
+        return self._total
+
+    #############
+    # INTERNALS #
+    #############
+    @staticmethod
+    def _check(window, alpha):
+        if window < 1:
+            raise ValueError(f"Window must be at least 1 sample, got {window}")
+        if alpha is not None and not 0 < alpha <= 1:
+            raise ValueError(f"Smoothing factor must be in (0, 1], got {alpha}")
+
+    def _compute(self, values, nhistory, previous):
+        # results (in STATS order) for values[nhistory:], values[:nhistory] are the samples before them
+        n = self._window
+        npoints = values.shape[0] - nhistory
+        # sample i uses values[lo[i]:hi[i]]
+        hi = np.arange(nhistory + 1, values.shape[0] + 1)
+        lo = np.maximum(hi - n, 0)
+        count = hi - lo
+        # shifted by the first value: the sums of squares keep their precision
+        shifted = values - values[0]
+        sums = np.concatenate(([0.0], np.cumsum(shifted)))
+        squares = np.concatenate(([0.0], np.cumsum(shifted ** 2)))
+        mean = (sums[hi] - sums[lo]) / count
+        var = np.maximum((squares[hi] - squares[lo]) / count - mean ** 2, 0.0)
+        mean += values[0]
+
+        # the missing samples of the first windows are replaced by the first one (no effect on the extremes)
+        missing = n - 1 - nhistory
+        padded = np.concatenate((np.full(max(missing, 0), values[0]), values[max(-missing, 0):]))
+        return [
+            mean,
+            _ema(values[nhistory:], self.alpha, previous),
+            var,
+            _sliding(padded, n, np.minimum)[-npoints:],
+            _sliding(padded, n, np.maximum)[-npoints:],
+        ]
+
+    def _append(self, values, results):
+        npoints = values.shape[0]
+        if npoints >= self.capacity:
+            # nothing else is kept
+            values = values[-self.capacity:]
+            results = [column[-self.capacity:] for column in results]
+            self._end = 0
+        elif self._end + npoints > 2 * self.capacity:
+            # keep the last capacity - len(values) samples at the front
+            keep = self.capacity - values.shape[0]
+            for column in self._columns:
+                column[:keep] = column[self._end - keep:self._end]
+            self._end = keep
+        for column, new in zip(self._columns, [values] + results):
+            column[self._end:self._end + values.shape[0]] = new
+        self._end += values.shape[0]
+        self._total += npoints
+
+    def _recompute(self):
+        if self._end == 0:
+            return
+        results = self._compute(self._columns[0][:self._end], 0, None)
+        for column, new in zip(self._columns[1:], results):
+            column[:self._end] = new
+        self.reset_extremes()
+        self._update_extremes(results[STATS.index('mean')])
+
+    def _update_extremes(self, mean):
+        self.mean_min = min(self.mean_min, float(mean.min()))
+        self.mean_max = max(self.mean_max, float(mean.max()))
+
+
+if __name__ == '__main__':
+    import time
+
+    # one minute of a 50us gate time acquisition, 1000 samples per block
+    stats = StreamingStats(100)
+    blocks = [np.random.poisson(20, 1000) for _ in range(1200)]
+    t0 = time.perf_counter()
+    for block in blocks:
+        stats.push(block)
+    dt = time.perf_counter() - t0
+    print(f'{len(stats)} samples in {dt:.2f}s ({1e6 * dt / len(stats):.3f}us per sample)')
+    mean, ema, var, ymin, ymax = stats.last(5)
+    print(f'last mean {mean}, ema {ema}, var {var}, min {ymin}, max {ymax}')
+    t0 = time.perf_counter()
+    stats.window = 10
+    print(f'window changed in {1e3 * (time.perf_counter() - t0):.1f}ms')
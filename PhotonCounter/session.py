@@ -0,0 +1,431 @@
+"""
+Module implements a lazy reader for recorded sessions (CSV logs written by buffer/storage and binary logs written by
+binlog, and the older CSV logs with a count per row but no time column: the time of row i is then i times the gate
+time of the '# GATE TIME' header line). Opening a session reads nothing but the header and a sidecar index mapping time to file offset (one entry
+every INDEX_STRIDE samples for CSV, one per chunk for binary logs), built on the first open and saved next to the log
+as '<log>.idx.npz'. The index is extended, not rebuilt, when the log has grown since (e.g. a session still running).
+
+Time-range queries only read the part of the file they need and iter_chunks() walks a session in fixed-size NumPy
+chunks, so memory use does not depend on the file size.
+
+    with SessionReader('Data/log_01.01.24_10.00.00.csv') as session:
+        times, counts = session.read(3600.0, 3660.0)
+        for times, counts in session.iter_chunks():
+            ...
+
+Sessions split in segments by storage.RotatingLog are opened from their manifest with SegmentedSession, which has the
+same interface and only opens the segments overlapping the requested time range.
+"""
+from itertools import islice
+import json
+import os.path
+
+import numpy as np
+
+from . import binlog
+from .hamamatsu import GATE_TIMES
+from .storage import MANIFEST_SUFFIX
+
+# CSV rows between two index entries
+INDEX_STRIDE = 4096
+# samples per chunk returned by iter_chunks()
+DEFAULT_CHUNK_SIZE = 65536
+INDEX_SUFFIX = '.idx.npz'
+
+INDEX_DTYPE = np.dtype([
+    ('time', np.float64),    # time of the first sample of the entry
+    ('offset', np.int64),    # byte offset in the log
+    ('row', np.int64),       # index of the first sample of the entry
+])
+
+
+class SessionReader:
+    """
+    Read-only, lazy access to a recorded session. 'header' holds what is known about the session (at least the
+    gate time in seconds if it was recorded, under 'gate_time'). Times are in seconds since the start of the acquisition.
+    """
+    def __init__(self, path: str, *, save_index: bool = True):
+        if not os.path.isfile(path):
+            raise ValueError(f"No such session file: {path}")
+
+        self.path = path
+        self.save_index = save_index
+        with open(path, 'rb') as f_in:
+            self.binary = f_in.read(len(binlog.MAGIC)) == binlog.MAGIC
+
+        self._chunks = None
+        if self.binary:
+            self.header, self._data_offset = binlog.read_header(path)
+            self.compressed = binlog.is_compressed(self.header)
+            if not self.compressed:
+                _, self._chunks = binlog.open_chunks(path)
+        else:
+            self.header, self._data_offset = _read_csv_header(path)
+            self.compressed = False
+            if self.header['counts_only'] and self.header['gate_time'] is None:
+                raise ValueError(f"{path} has no time column and no gate time")
+        self._file = open(path, 'rb')
+
+        self._index = np.zeros(0, dtype=INDEX_DTYPE)
+        # bytes of the log covered by the index and number of samples in them
+        self._indexed_bytes = 0
+        self._rows = 0
+        self._t_last = None
+        self.refresh()
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def refresh(self):
+        """
+        Brings the index up to date with the file (only the new part of a growing file is scanned).
+        """
+        size = os.path.getsize(self.path)
+        if self._indexed_bytes == 0:
+            self._load_index(size)
+        if size > self._indexed_bytes:
+            self._extend_index()
+            if self.save_index:
+                self._save_index()
+
+    def read(self, t_start: float = None, t_stop: float = None):
+        """
+        Returns (times, counts) for the samples with t_start <= time < t_stop (the whole session by default).
+        """
+        chunks = list(self.iter_chunks(t_start, t_stop))
+        if not chunks:
+            return np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.uint32)
+        return np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks])
+
+    def iter_chunks(self, t_start: float = None, t_stop: float = None, *, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        Yields (times, counts) arrays of at most chunk_size samples covering t_start <= time < t_stop.
+        """
+        if chunk_size <= 0:
+            raise ValueError(f"Chunk size must be positive, got {chunk_size}")
+        if len(self._index) == 0:
+            return
+
+        first = 0
+        if t_start is not None:
+            first = max(int(np.searchsorted(self._index['time'], t_start, side='right')) - 1, 0)
+        pieces = self._iter_binary(first) if self.binary else self._iter_csv(first)
+
+        pending_t, pending_c, npending = [], [], 0
+        for times, counts in pieces:
+            if t_start is not None and times[0] < t_start:
+                keep = times >= t_start
+                times, counts = times[keep], counts[keep]
+            if t_stop is not None and len(times) and times[-1] >= t_stop:
+                keep = times < t_stop
+                times, counts = times[keep], counts[keep]
+                done = True
+            else:
+                done = False
+
+            pending_t.append(times)
+            pending_c.append(counts)
+            npending += len(times)
+            while npending >= chunk_size:
+                times, counts = np.concatenate(pending_t), np.concatenate(pending_c)
+                yield times[:chunk_size], counts[:chunk_size]
+                pending_t, pending_c, npending = [times[chunk_size:]], [counts[chunk_size:]], len(times) - chunk_size
+            if done:
+                break
+
+        if npending:
+            yield np.concatenate(pending_t), np.concatenate(pending_c)
+
+    @property
+    def t_start(self):
+        return float(self._index['time'][0]) if len(self._index) else None
+
+    @property
+    def t_stop(self):
+        """
+        Time of the last sample.
+        """
+        return self._t_last
+
+    @property
+    def gate_time(self):
+        return self.header.get('gate_time')
+
+    @property
+    def index(self):
+        return self._index
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self):
+        return self._rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    #############
+    # INTERNALS #
+    #############
+    @property
+    def _index_path(self):
+        return self.path + INDEX_SUFFIX
+
+    def _load_index(self, size):
+        try:
+            saved = np.load(self._index_path)
+            index, indexed_bytes = saved['index'], int(saved['indexed_bytes'])
+            rows, t_last = int(saved['rows']), float(saved['t_last'])
+        except (OSError, KeyError, ValueError):
+            return
+        # a log smaller than what was indexed has been replaced: start over
+        if indexed_bytes > size or index.dtype != INDEX_DTYPE:
+            return
+        self._index, self._indexed_bytes, self._rows = index, indexed_bytes, rows
+        self._t_last = None if np.isnan(t_last) else t_last
+
+    def _save_index(self):
+        try:
+            with open(self._index_path, 'wb') as f_out:
+                np.savez(f_out, index=self._index, indexed_bytes=self._indexed_bytes, rows=self._rows,
+                         t_last=self._t_last if self._t_last is not None else np.nan)
+        except OSError:
+            # read-only location: the index is kept in memory only
+            self.save_index = False
+
+    def _extend_index(self):
+        if self.compressed:
+            self._extend_record_index()
+        elif self.binary:
+            _, self._chunks = binlog.open_chunks(self.path)
+            self._extend_binary_index()
+        else:
+            self._extend_csv_index()
+
+    def _extend_binary_index(self):
+        _, offset = binlog.read_header(self.path)
+        first = len(self._index)
+        chunks = self._chunks[first:]
+        if len(chunks) == 0:
+            return
+        npoints = chunks['npoints'].astype(np.int64)
+        entries = np.zeros(len(chunks), dtype=INDEX_DTYPE)
+        entries['time'] = chunks['t_start']
+        entries['offset'] = offset + (first + np.arange(len(chunks))) * self._chunks.dtype.itemsize
+        entries['row'] = self._rows + np.concatenate(([0], np.cumsum(npoints)[:-1]))
+        self._index = np.concatenate((self._index, entries))
+        self._rows += int(npoints.sum())
+        last = chunks[-1]
+        self._t_last = float(last['t_start'] + (int(last['npoints']) - 1) * last['gate_time'])
+        self._indexed_bytes = int(entries['offset'][-1]) + self._chunks.dtype.itemsize
+
+    def _extend_record_index(self):
+        # compressed records have variable sizes: walk the record headers
+        entries = []
+        position = max(self._indexed_bytes, self._data_offset)
+        for position, record in binlog.scan_records(self._file, position):
+            entries.append((record['t_start'], position, self._rows))
+            self._rows += int(record['npoints'])
+            self._t_last = float(record['t_start'] + (int(record['npoints']) - 1) * record['gate_time'])
+            self._indexed_bytes = position + binlog.RECORD_DTYPE.itemsize + int(record['nbytes'])
+        if entries:
+            self._index = np.concatenate((self._index, np.array(entries, dtype=INDEX_DTYPE)))
+
+    def _extend_csv_index(self):
+        position = max(self._indexed_bytes, self._data_offset)
+        entries = []
+        rows = self._rows
+        last_line = None
+        self._file.seek(position)
+        for line in self._file:
+            if not line.endswith(b'\n'):
+                # partially written row: indexed on the next refresh
+                break
+            if rows % INDEX_STRIDE == 0:
+                entries.append((self._csv_time(line, rows), position, rows))
+            position += len(line)
+            rows += 1
+            last_line = line
+
+        if entries:
+            self._index = np.concatenate((self._index, np.array(entries, dtype=INDEX_DTYPE)))
+        if last_line is not None:
+            self._t_last = self._csv_time(last_line, rows - 1)
+        self._rows = rows
+        self._indexed_bytes = position
+
+    def _iter_binary(self, first):
+        # index entries and chunks match one to one
+        nchunks = len(self._index)
+        step = max(DEFAULT_CHUNK_SIZE // self.header['chunk_size'], 1)
+        if not self.compressed:
+            for start in range(first, nchunks, step):
+                yield binlog.unpack(self._chunks[start:min(start + step, nchunks)])
+            return
+
+        records = []
+        remaining = nchunks - first
+        for record in binlog.read_records(self._file, self.header, int(self._index['offset'][first])):
+            records.append(record)
+            remaining -= 1
+            if len(records) == step or remaining == 0:
+                yield binlog.unpack_records(records)
+                records = []
+            if remaining == 0:
+                break
+        if records:
+            yield binlog.unpack_records(records)
+
+    def _csv_time(self, line, row):
+        if self.header['counts_only']:
+            return row * self.header['gate_time']
+        return float(line.split(b',', 1)[0])
+
+    def _iter_csv(self, first):
+        self._file.seek(int(self._index['offset'][first]))
+        row = int(self._index['row'][first])
+        while row < self._rows:
+            lines = list(islice(self._file, min(INDEX_STRIDE * 4, self._rows - row)))
+            if not lines:
+                break
+            rows = np.loadtxt([line.decode() for line in lines], delimiter=',', ndmin=2)
+            if self.header['counts_only']:
+                yield (row + np.arange(len(lines))) * self.header['gate_time'], rows[:, 0].astype(np.uint32)
+            else:
+                yield rows[:, 0], rows[:, 1].astype(np.uint32)
+            row += len(lines)
+
+
+class SegmentedSession:
+    """
+    Read-only access to a session split in segments (see storage.RotatingLog), from its manifest. Segments are opened
+    (as SessionReader) only when a query needs them and closed right after.
+    """
+    def __init__(self, manifest_path: str, *, save_index: bool = True):
+        with open(manifest_path, 'r') as f_in:
+            self.manifest = json.load(f_in)
+        self.path = manifest_path
+        self.save_index = save_index
+        folder = os.path.dirname(manifest_path)
+        self.segments = [dict(segment, path=os.path.join(folder, segment['file']))
+                         for segment in self.manifest['segments']]
+
+        # an unclosed segment (interrupted session) is measured from the file itself
+        for segment in self.segments:
+            if not segment['closed'] and os.path.isfile(segment['path']):
+                with SessionReader(segment['path'], save_index=save_index) as reader:
+                    segment['samples'] = len(reader)
+                    segment['t_stop'] = reader.t_stop
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def select(self, t_start: float = None, t_stop: float = None):
+        """
+        Segments holding data in t_start <= time < t_stop.
+        """
+        selected = []
+        for segment in self.segments:
+            if segment['samples'] == 0 or not os.path.isfile(segment['path']):
+                continue
+            if t_start is not None and segment['t_stop'] is not None and segment['t_stop'] < t_start:
+                continue
+            if t_stop is not None and segment['t_start'] >= t_stop:
+                continue
+            selected.append(segment)
+        return selected
+
+    def read(self, t_start: float = None, t_stop: float = None):
+        """
+        Returns (times, counts) for the samples with t_start <= time < t_stop (the whole session by default).
+        """
+        chunks = list(self.iter_chunks(t_start, t_stop))
+        if not chunks:
+            return np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.uint32)
+        return np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks])
+
+    def iter_chunks(self, t_start: float = None, t_stop: float = None, *, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        Yields (times, counts) arrays of at most chunk_size samples covering t_start <= time < t_stop (chunks do not
+        span segments).
+        """
+        for segment in self.select(t_start, t_stop):
+            with SessionReader(segment['path'], save_index=self.save_index) as reader:
+                yield from reader.iter_chunks(t_start, t_stop, chunk_size=chunk_size)
+
+    @property
+    def t_start(self):
+        selected = self.select()
+        return selected[0]['t_start'] if selected else None
+
+    @property
+    def t_stop(self):
+        selected = self.select()
+        return selected[-1]['t_stop'] if selected else None
+
+    @property
+    def gate_time(self):
+        return self.manifest.get('gate_time')
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        return sum(segment['samples'] for segment in self.select())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def open_session(path: str, **kwargs):
+    """
+    SegmentedSession for a manifest, SessionReader for a single log file.
+    """
+    if path.endswith(MANIFEST_SUFFIX):
+        return SegmentedSession(path, **kwargs)
+    return SessionReader(path, **kwargs)
+
+
+def _read_csv_header(path):
+    """
+    Reads the comment lines of a CSV log. Returns (header dictionary, byte offset of the first data row). 'counts_only'
+    is True for the logs without a time column.
+    """
+    header = {'columns': None, 'gate_time': None, 'gate_time_name': None}
+    offset = 0
+    with open(path, 'rb') as f_in:
+        for line in f_in:
+            if not line.startswith(b'#'):
+                break
+            offset += len(line)
+            text = line.decode().strip()
+            if text.startswith('# GATE TIME'):
+                name = text[len('# GATE TIME'):].strip().rstrip('.')
+                header['gate_time_name'] = name
+                if name in GATE_TIMES:
+                    header['gate_time'] = GATE_TIMES[name][2]
+            else:
+                header['columns'] = text.lstrip('#').split(',')
+    header['counts_only'] = header['columns'] is not None and len(header['columns']) == 1
+    return header, offset
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    t0 = time.perf_counter()
+    with open_session(sys.argv[1]) as session:
+        print(f'{session.path}: {len(session)} samples from {session.t_start}s to {session.t_stop}s, '
+              f'gate time {session.gate_time}s (opened in {time.perf_counter() - t0:.3f}s)')
+        if len(session):
+            middle = (session.t_start + session.t_stop) / 2
+            t0 = time.perf_counter()
+            times, counts = session.read(middle, middle + 1.0)
+            print(f'1s around the middle: {len(times)} samples in {1e3 * (time.perf_counter() - t0):.1f}ms')
@@ -0,0 +1,617 @@
+"""
+Module implements the background storage of the acquired data. The acquisition side only copies each block into a
+staging buffer, a dedicated writer thread does the formatting and the disk I/O. Staging buffers are swapped (at least
+double buffering: one is filled while the other is written) when the flush policy is met: a number of samples, a number
+of bytes or a time since the first unsaved sample, whichever comes first.
+
+The writer hands the staged columns to a sink: CsvLogWriter (the CSV layout written by buffer.SimpleBuffer) or
+binlog.BinaryLogWriter, anything with write(*columns), flush() and close() methods will do. RotatingLog splits a
+session into segments (by size or duration) of one of those and keeps a manifest of them.
+
+Durability (what survives a crash or a power loss) is set per StorageWriter:
+    none       the OS writes the data when it sees fit (fastest)
+    periodic   the sink is synced (fsync) every 'fsync_interval' seconds while data is written, and once the
+               interval is over after the last write
+    chunk      the sink is synced after every write, when the writer has caught up: when several staging buffers are
+               waiting they are all written before one sync (batched fsync)
+After a crash recover() drops the incomplete data at the end of a log, the writers do it when they append to a log.
+"""
+from collections import deque
+import json
+import logging
+import os
+import os.path
+import threading as th
+import time
+
+import numpy as np
+
+from . import binlog
+
+# default flush policy
+DEFAULT_FLUSH_SAMPLES = 10000
+DEFAULT_FLUSH_INTERVAL = 1.0
+# staging buffers allocated up front (more are allocated if the writer falls behind, up to the maximum)
+DEFAULT_STAGING_BUFFERS = 3
+DEFAULT_MAX_STAGING_BUFFERS = 16
+# number of write latencies kept for the statistics
+LATENCY_HISTORY = 1000
+
+MANIFEST_SUFFIX = '.manifest.json'
+MANIFEST_VERSION = 1
+
+DURABILITY_LEVELS = ('none', 'periodic', 'chunk')
+DEFAULT_FSYNC_INTERVAL = 5.0
+
+# requests handed to the writer thread besides the staging buffers
+_FLUSH = 'flush'
+_SYNC = 'sync'
+
+
+class CsvLogWriter:
+    """
+    Sink writing the columns as CSV rows: optional header line, '#keyword1,keyword2...' then one row per sample
+    (integers with %d, floats with %.12g). An existing file is appended to (after dropping an incomplete last row).
+    """
+    def __init__(self, path: str, keywords: list, *, dtypes: list = None, header: str = ''):
+        folder = os.path.dirname(path)
+        if len(folder) != 0 and not os.path.exists(folder):
+            os.makedirs(folder)
+        if dtypes is None:
+            dtypes = [np.float64] * len(keywords)
+
+        self.path = path
+        self.keywords = keywords
+        self._fmt = ['%d' if np.dtype(dt).kind in 'iub' else '%.12g' for dt in dtypes]
+
+        new_file = not os.path.isfile(path)
+        if not new_file:
+            dropped = recover_csv(path)
+            if dropped:
+                logging.warning(f'Dropped {dropped} bytes of incomplete data at the end of {path}')
+        self._file = open(path, 'a')
+        if new_file:
+            if header:
+                self._file.write(header + '\n')
+            self._file.write('#' + ','.join(str(kw) for kw in keywords) + '\n')
+
+    def write(self, *columns):
+        np.savetxt(self._file, np.column_stack(columns), fmt=self._fmt, delimiter=',')
+
+    def flush(self):
+        self._file.flush()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    @property
+    def bytes_written(self):
+        return self._file.tell() if not self._file.closed else os.path.getsize(self.path)
+
+
+class RotatingLog:
+    """
+    Sink splitting a session into numbered segments '<base_path>_0001<extension>', '<base_path>_0002<extension>'...
+    'make_sink(path)' creates the sink of a segment (CsvLogWriter, binlog.BinaryLogWriter...). A new segment is started
+    once the current one holds 'max_bytes' bytes or 'max_duration' seconds of data (first column: times in seconds),
+    whichever comes first. Segments are split exactly at the duration boundary, by size after the block that crossed it.
+
+    '<base_path>.manifest.json' lists the segments with their file name, time span, number of samples, size and gate
+    time. It is rewritten (atomically) whenever a segment is opened or closed: after a crash only the last segment is
+    left unclosed ('closed': false, its span and sample count are those known when it was opened). An existing
+    manifest is continued: the incomplete data at the end of its unclosed segments is dropped (see recover(), they stay
+    unclosed: session.SegmentedSession reads their actual span), new segments come after.
+    """
+    def __init__(self, base_path: str, make_sink, *, extension: str, gate_time: float = None, max_bytes: int = None,
+                 max_duration: float = None):
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError(f"Maximum segment size must be positive, got {max_bytes}")
+        if max_duration is not None and max_duration <= 0:
+            raise ValueError(f"Maximum segment duration must be positive, got {max_duration}")
+
+        folder = os.path.dirname(base_path)
+        if len(folder) != 0 and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.base_path = base_path
+        self.make_sink = make_sink
+        self.extension = extension
+        self.gate_time = gate_time
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+
+        self.segments = []
+        self._sink = None
+        self._created = time.time()
+        # closed segments not synced yet
+        self._unsynced = []
+
+        if os.path.isfile(self.manifest_path):
+            self._resume()
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def write(self, *columns):
+        times = np.asarray(columns[0])
+        start = 0
+        while start < len(times):
+            if self._sink is None:
+                self._open_segment(float(times[start]))
+            segment = self.segments[-1]
+
+            stop = len(times)
+            if self.max_duration is not None:
+                stop = start + int(np.searchsorted(times[start:], segment['t_start'] + self.max_duration))
+            if stop > start:
+                self._sink.write(*[column[start:stop] for column in columns])
+                segment['samples'] += stop - start
+                segment['t_stop'] = float(times[stop - 1])
+            start = stop
+
+            if start < len(times) or (self.max_bytes is not None and self._sink.bytes_written >= self.max_bytes):
+                self._close_segment()
+
+    def flush(self):
+        if self._sink is not None:
+            self._sink.flush()
+
+    def sync(self):
+        """
+        Makes the segments closed since the last call and the current one durable (fsync).
+        """
+        for path in self._unsynced:
+            with open(path, 'rb') as f_in:
+                os.fsync(f_in.fileno())
+        self._unsynced = []
+        if self._sink is not None:
+            if hasattr(self._sink, 'sync'):
+                self._sink.sync()
+            else:
+                self._sink.flush()
+
+    def close(self):
+        if self._sink is not None:
+            self._close_segment()
+        elif not self.segments:
+            self._write_manifest()
+
+    @property
+    def manifest_path(self):
+        return self.base_path + MANIFEST_SUFFIX
+
+    @property
+    def bytes_written(self):
+        closed = sum(segment['bytes'] for segment in self.segments if segment['closed'])
+        return closed + (self._sink.bytes_written if self._sink is not None else 0)
+
+    #############
+    # INTERNALS #
+    #############
+    def _open_segment(self, t_start):
+        path = f'{self.base_path}_{len(self.segments) + 1:04d}{self.extension}'
+        self._sink = self.make_sink(path)
+        self.segments.append({
+            'file': os.path.basename(path),
+            't_start': t_start,
+            't_stop': None,
+            'samples': 0,
+            'bytes': 0,
+            'gate_time': self.gate_time,
+            'closed': False,
+        })
+        self._write_manifest()
+
+    def _resume(self):
+        with open(self.manifest_path) as f_in:
+            manifest = json.load(f_in)
+        self.segments = manifest['segments']
+        self._created = manifest.get('created', self._created)
+        for segment in self.segments:
+            path = os.path.join(os.path.dirname(self.base_path), segment['file'])
+            if not segment['closed'] and os.path.isfile(path):
+                dropped = recover(path)
+                segment['bytes'] = os.path.getsize(path)
+                logging.warning(f"Recovered unclosed log segment {segment['file']} ({dropped} bytes dropped)")
+        self._write_manifest()
+
+    def _close_segment(self):
+        self._sink.close()
+        segment = self.segments[-1]
+        path = os.path.join(os.path.dirname(self.base_path), segment['file'])
+        segment['bytes'] = os.path.getsize(path)
+        segment['closed'] = True
+        self._unsynced.append(path)
+        self._sink = None
+        self._write_manifest()
+        logging.debug(f"Closed log segment {segment['file']} ({segment['samples']} samples)")
+
+    def _write_manifest(self):
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'created': self._created,
+            'gate_time': self.gate_time,
+            'max_bytes': self.max_bytes,
+            'max_duration': self.max_duration,
+            'segments': self.segments,
+        }
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f_out:
+            json.dump(manifest, f_out, indent=1)
+            # the manifest must not be replaced by an empty file after a crash
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+
+def recover_csv(path: str):
+    """
+    Drops an incomplete last row (interrupted write) from a CSV log. Returns the number of bytes dropped.
+    """
+    with open(path, 'r+b') as f_out:
+        size = f_out.seek(0, os.SEEK_END)
+        end = size
+        # find the end of the last complete row (a crash can also leave zeros at the end of the file)
+        while end > 0:
+            start = max(end - 4096, 0)
+            f_out.seek(start)
+            block = f_out.read(end - start)
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f_out.truncate(end)
+    return size - end
+
+
+def recover(path: str):
+    """
+    Repairs a log (CSV or binary) left by an interrupted write: drops the incomplete data at its end (see
+    binlog.recover() and recover_csv()). Returns the number of bytes dropped.
+    """
+    with open(path, 'rb') as f_in:
+        binary = f_in.read(len(binlog.MAGIC)) == binlog.MAGIC
+    return binlog.recover(path) if binary else recover_csv(path)
+
+
+class _Staging:
+    """
+    One staging buffer: a growable array per column and the time its first sample was added.
+    """
+    def __init__(self, dtypes, capacity):
+        self.columns = [np.empty(capacity, dtype=dt) for dt in dtypes]
+        self.npoints = 0
+        self.t_first = None
+
+    def append(self, columns):
+        npoints = len(columns[0])
+        if self.npoints + npoints > self.columns[0].shape[0]:
+            capacity = max(2 * self.columns[0].shape[0], self.npoints + npoints)
+            self.columns = [np.concatenate((column[:self.npoints], np.empty(capacity - self.npoints, column.dtype)))
+                            for column in self.columns]
+        for column, values in zip(self.columns, columns):
+            column[self.npoints:self.npoints + npoints] = values
+        if self.npoints == 0:
+            self.t_first = time.monotonic()
+        self.npoints += npoints
+
+    def views(self):
+        return [column[:self.npoints] for column in self.columns]
+
+    def clear(self):
+        self.npoints = 0
+        self.t_first = None
+
+
+class StorageWriter:
+    """
+    Writes columns of samples to 'sink' from a background thread. write() never touches the disk: it copies the data
+    into the active staging buffer and, when 'flush_samples' samples or 'flush_bytes' bytes are staged, queues the
+    buffer for the writer thread and continues in an empty one. The writer thread also flushes staged data older than
+    'flush_interval' seconds. Give None to disable one criterion (at least one must be set).
+    If the writer falls behind, extra staging buffers are allocated (see stats) instead of blocking the caller, write()
+    only blocks (backpressure) when 'max_buffers' buffers are waiting for the writer.
+    'durability' is one of DURABILITY_LEVELS (see the module documentation), the sink is synced with its sync() method
+    (flush() if it has none). The sink is only ever used by the writer thread (flush() queues a request to it), until
+    close() has stopped it.
+    """
+    def __init__(self, sink, *, dtypes: list, flush_samples: int = DEFAULT_FLUSH_SAMPLES, flush_bytes: int = None,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, buffers: int = DEFAULT_STAGING_BUFFERS,
+                 max_buffers: int = DEFAULT_MAX_STAGING_BUFFERS, durability: str = 'none',
+                 fsync_interval: float = DEFAULT_FSYNC_INTERVAL):
+        if flush_samples is None and flush_bytes is None and flush_interval is None:
+            raise ValueError("At least one flush criterion (samples, bytes or interval) must be given")
+        for name, value in (('samples', flush_samples), ('bytes', flush_bytes), ('interval', flush_interval)):
+            if value is not None and value <= 0:
+                raise ValueError(f"Flush {name} must be positive, got {value}")
+        if buffers < 2 or max_buffers < buffers:
+            raise ValueError(f"At least 2 staging buffers (and no more than max_buffers) are required, got {buffers}")
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Unknown durability {durability}, use one of {DURABILITY_LEVELS}")
+        if fsync_interval <= 0:
+            raise ValueError(f"Sync interval must be positive, got {fsync_interval}")
+
+        self.sink = sink
+        self.dtypes = [np.dtype(dt) for dt in dtypes]
+        self.sample_bytes = sum(dt.itemsize for dt in self.dtypes)
+        self.flush_samples = flush_samples
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_buffers = max_buffers
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+
+        limits = [limit for limit in (flush_samples, flush_bytes and flush_bytes // self.sample_bytes) if limit]
+        capacity = max(min(limits), 1) if limits else DEFAULT_FLUSH_SAMPLES
+        self._free = [_Staging(self.dtypes, capacity) for _ in range(buffers - 1)]
+        self._active = _Staging(self.dtypes, capacity)
+        self._queue = deque()
+        self._cond = th.Condition()
+        self._halt = False
+        # flush() requests: made, being handled by the writer, handled
+        self._flush_requests = 0
+        self._flushing = 0
+        self._flushed = 0
+
+        # counters
+        self.flushes = 0
+        self.samples_written = 0
+        self.samples_dropped = 0
+        self.errors = 0
+        self.extra_buffers = 0
+        self.max_backlog = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self._latencies = deque(maxlen=LATENCY_HISTORY)
+        self._max_latency = 0.0
+        self.syncs = 0
+        self.sync_time = 0.0
+        self._max_sync_latency = 0.0
+        self._last_sync = time.monotonic()
+        # data written since the last sync
+        self._unsynced = False
+
+        self._thread = th.Thread(name='Storage Writer', target=self._run, daemon=True)
+        self._thread.start()
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def write(self, *columns):
+        """
+        Stages a block of samples (one sequence per column, all of the same length). Only copies the data.
+        """
+        if len(columns) != len(self.dtypes):
+            raise ValueError(f"Wrong number of columns: got {len(columns)} required {len(self.dtypes)}")
+        with self._cond:
+            if self._halt:
+                raise RuntimeError('Storage writer is closed')
+            self._active.append(columns)
+            if self._is_due(self._active, time.monotonic()):
+                if len(self._queue) >= self.max_buffers - 1:
+                    # the writer is too far behind: wait for it
+                    self.stalls += 1
+                    t0 = time.perf_counter()
+                    self._cond.wait_for(lambda: len(self._queue) < self.max_buffers - 1 or self._halt)
+                    self.stall_time += time.perf_counter() - t0
+                self._swap()
+
+    def flush(self, timeout: float = None):
+        """
+        Queues whatever is staged and waits until the writer has written everything and flushed the sink (synced it
+        too unless the durability is 'none'). Returns False on timeout.
+        """
+        with self._cond:
+            if self._halt:
+                raise RuntimeError('Storage writer is closed')
+            self._swap()
+            self._flush_requests += 1
+            request = self._flush_requests
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._flushed >= request, timeout)
+
+    def close(self, timeout: float = None):
+        """
+        Writes what is left, stops the writer thread and closes the sink.
+        """
+        with self._cond:
+            if self._halt:
+                return
+            self._swap()
+            self._halt = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.warning(f'Storage writer did not finish within {timeout}s')
+        elif self.durability != 'none':
+            self.sink.flush()
+            self._sync()
+        self.sink.close()
+
+    @property
+    def backlog(self):
+        """
+        Samples staged or queued but not written yet.
+        """
+        with self._cond:
+            return self._active.npoints + sum(staging.npoints for staging in self._queue)
+
+    @property
+    def stats(self):
+        with self._cond:
+            latencies = np.array(self._latencies)
+            return {
+                'flushes': self.flushes,
+                'samples_written': self.samples_written,
+                'bytes_written': self.samples_written * self.sample_bytes,
+                'samples_dropped': self.samples_dropped,
+                'errors': self.errors,
+                'backlog_samples': self._active.npoints + sum(staging.npoints for staging in self._queue),
+                'backlog_buffers': len(self._queue),
+                'max_backlog_buffers': self.max_backlog,
+                'extra_buffers': self.extra_buffers,
+                'stalls': self.stalls,
+                'stall_time_s': self.stall_time,
+                'write_latency_p50_ms': 1e3 * float(np.median(latencies)) if len(latencies) else None,
+                'write_latency_p99_ms': 1e3 * float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'write_latency_max_ms': 1e3 * self._max_latency,
+                'syncs': self.syncs,
+                'sync_time_s': self.sync_time,
+                'sync_latency_max_ms': 1e3 * self._max_sync_latency,
+            }
+
+    #############
+    # INTERNALS #
+    #############
+    def _is_due(self, staging, now):
+        if staging.npoints == 0:
+            return False
+        if self.flush_samples is not None and staging.npoints >= self.flush_samples:
+            return True
+        if self.flush_bytes is not None and staging.npoints * self.sample_bytes >= self.flush_bytes:
+            return True
+        return self.flush_interval is not None and now - staging.t_first >= self.flush_interval
+
+    def _swap(self):
+        # called with the lock held: hands the active buffer to the writer and continues in a free one
+        if self._active.npoints == 0:
+            return
+        self._queue.append(self._active)
+        self.max_backlog = max(self.max_backlog, len(self._queue))
+        if self._free:
+            self._active = self._free.pop()
+        else:
+            self.extra_buffers += 1
+            self._active = _Staging(self.dtypes, self._queue[-1].columns[0].shape[0])
+        self._cond.notify_all()
+
+    def _next(self):
+        # next staging buffer to write, _FLUSH once the buffers queued before a flush() are written, _SYNC when a
+        # periodic sync is due without any write, None on halt
+        with self._cond:
+            while not self._queue and not self._halt and self._flushed == self._flush_requests:
+                now = time.monotonic()
+                timeouts = []
+                if self.flush_interval is not None:
+                    if self._active.npoints == 0:
+                        timeouts.append(self.flush_interval)
+                    elif self._active.t_first + self.flush_interval <= now:
+                        self._swap()
+                        continue
+                    else:
+                        timeouts.append(self._active.t_first + self.flush_interval - now)
+                if self.durability == 'periodic' and self._unsynced:
+                    if self._last_sync + self.fsync_interval <= now:
+                        return _SYNC
+                    timeouts.append(self._last_sync + self.fsync_interval - now)
+                self._cond.wait(min(timeouts, default=None))
+            # on halt whatever is still queued is written first
+            if self._queue:
+                return self._queue.popleft()
+            if self._flushed < self._flush_requests:
+                self._flushing = self._flush_requests
+                return _FLUSH
+            return None
+
+    def _sync_due(self):
+        if self.durability == 'chunk':
+            # batched: sync once the buffers already waiting are written too
+            with self._cond:
+                return not self._queue
+        return self.durability == 'periodic' and time.monotonic() - self._last_sync >= self.fsync_interval
+
+    def _sync(self):
+        sync = getattr(self.sink, 'sync', self.sink.flush)
+        t0 = time.perf_counter()
+        try:
+            sync()
+        except OSError as e:
+            logging.error(f'Could not sync storage. Msg: {str(e)}')
+            # retried at the next interval, not in a loop
+            self._last_sync = time.monotonic()
+            with self._cond:
+                self.errors += 1
+            return
+        latency = time.perf_counter() - t0
+        self._last_sync = time.monotonic()
+        self._unsynced = False
+        with self._cond:
+            self.syncs += 1
+            self.sync_time += latency
+            self._max_sync_latency = max(self._max_sync_latency, latency)
+
+    def _flush(self):
+        try:
+            self.sink.flush()
+        except OSError as e:
+            logging.error(f'Could not flush storage. Msg: {str(e)}')
+            with self._cond:
+                self.errors += 1
+        if self.durability != 'none':
+            self._sync()
+        with self._cond:
+            self._flushed = self._flushing
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            staging = self._next()
+            if staging is None:
+                break
+            if staging is _SYNC:
+                self._sync()
+                continue
+            if staging is _FLUSH:
+                self._flush()
+                continue
+
+            t0 = time.perf_counter()
+            try:
+                self.sink.write(*staging.views())
+            except (OSError, ValueError) as e:
+                logging.error(f'Could not write {staging.npoints} samples to storage. Msg: {str(e)}')
+                written = False
+            else:
+                written = True
+                self._unsynced = True
+            latency = time.perf_counter() - t0
+            if written and self._sync_due():
+                self._sync()
+
+            with self._cond:
+                if written:
+                    self.flushes += 1
+                    self.samples_written += staging.npoints
+                    self._latencies.append(latency)
+                    self._max_latency = max(self._max_latency, latency)
+                else:
+                    self.errors += 1
+                    self.samples_dropped += staging.npoints
+                staging.clear()
+                self._free.append(staging)
+                self._cond.notify_all()
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    gate_time = 50e-6
+    nblocks, gates = 2000, 500
+    with tempfile.TemporaryDirectory() as folder:
+        for sink in (CsvLogWriter(os.path.join(folder, 'test.csv'), ['Time', 'Counts'], dtypes=[np.float64, np.uint32]),
+                     binlog.BinaryLogWriter(os.path.join(folder, 'test.bpc'), gate_time=gate_time)):
+            writer = StorageWriter(sink, dtypes=[np.float64, np.uint32], flush_samples=20000)
+            t0 = time.perf_counter()
+            for i in range(nblocks):
+                writer.write(gate_time * np.arange(i * gates, (i + 1) * gates), np.random.poisson(10, gates))
+            t_write = time.perf_counter() - t0
+            writer.close()
+            print(f'{type(sink).__name__}: {1e6 * t_write / nblocks:.1f}us per block on the caller side, '
+                  f'{time.perf_counter() - t0:.2f}s in total', writer.stats)
@@ -0,0 +1,300 @@
+"""
+Module implements a supervised readout. A worker thread reads blocks from the hardware and hands them to a sink, a
+watchdog thread tracks the time since the last successful read and, when it exceeds a deadline derived from the block
+duration (or the worker reports an error), cancels the worker and restarts the acquisition.
+
+With a driverprocess.DriverProcess the hung driver is killed together with its process, so no worker is left behind.
+With an in-process hamamatsu.Hamamatsu a thread stuck in the driver cannot be killed: it is cancelled (it drops its data
+and exits as soon as the driver call returns) and counted in 'stray_workers' until then. Reads hold a lock on the
+handle, the restart waits for it: the hardware is not restarted (nor read by a new worker) while the stray worker is
+still inside the driver, the restart fails instead (and is tried again, up to 'max_restarts'). Use a process-isolated
+driver when the driver can hang for good.
+"""
+import logging
+import threading as th
+import time
+
+# the readout is considered stalled after DEADLINE_FACTOR block durations without data (but never less than
+# MIN_DEADLINE seconds)
+DEFAULT_DEADLINE_FACTOR = 5.0
+DEFAULT_MIN_DEADLINE = 1.0
+# give up after this many restarts in a row without a successful read
+DEFAULT_MAX_RESTARTS = 5
+
+# events passed to the on_event callback
+EVENT_STALL = 'stall'
+EVENT_ERROR = 'error'
+EVENT_RESTART = 'restart'
+EVENT_FAILED = 'failed'
+
+
+class ReadoutSupervisor:
+    """
+    Reads blocks from 'hardware' (already set up) and passes each one to 'sink(block)', the block is released when
+    sink returns. start()/stop() also start and stop the hardware counting.
+    'on_event(kind, info)' (optional) is called from the watchdog thread on stalls, errors, restarts and when the
+    supervisor gives up. 'info' is a dictionary (see stats['history'] for restarts).
+    """
+    def __init__(self, hardware, sink, *, on_event=None, deadline_factor: float = DEFAULT_DEADLINE_FACTOR,
+                 min_deadline: float = DEFAULT_MIN_DEADLINE, max_restarts: int = DEFAULT_MAX_RESTARTS):
+        self.hardware = hardware
+        self.sink = sink
+        self.on_event = on_event
+        self.deadline_factor = deadline_factor
+        self.min_deadline = min_deadline
+        self.max_restarts = max_restarts
+
+        self._halt = th.Event()
+        self._wake = th.Event()
+        self._lock = th.Lock()
+        # held by the worker while it reads the hardware
+        self._read_lock = th.Lock()
+        self._worker = None
+        self._watchdog = None
+        self._generation = 0
+        self._last_read = 0.0
+        self._failure = None
+        self._stray = []
+
+        # time axis continuity across in-process restarts (gate times restart from zero at each count_start)
+        self._t_offset = 0.0
+        self._t_end = 0.0
+        self._t_recv = 0.0
+
+        self.restarts = 0
+        self.stalls = 0
+        self.errors = 0
+        self.history = []
+        self._failed_restarts = 0
+
+    ####################
+    # CLIENT INTERFACE #
+    ####################
+    def start(self):
+        if self.is_running:
+            raise RuntimeError('Readout already running')
+
+        self._halt.clear()
+        self._wake.clear()
+        self._failure = None
+        self._t_offset = self._t_end = 0.0
+        self._failed_restarts = 0
+
+        self._count_start()
+        self._last_read = time.monotonic()
+        self._t_recv = time.time()
+        self._start_worker()
+        self._watchdog = th.Thread(name='Readout Watchdog', target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def stop(self, timeout: float = None):
+        """
+        Stops the worker and the hardware counting. Returns False if the worker did not stop within timeout (default:
+        the stall deadline); the driver process, if any, is then killed.
+        """
+        if timeout is None:
+            timeout = self.deadline
+
+        self._halt.set()
+        self._wake.set()
+        if self._watchdog is not None and self._watchdog is not th.current_thread():
+            self._watchdog.join(timeout)
+
+        with self._lock:
+            self._generation += 1
+            worker = self._worker
+            self._worker = None
+
+        stopped = True
+        if worker is not None:
+            worker.join(timeout)
+            if worker.is_alive():
+                stopped = False
+                if hasattr(self.hardware, 'kill'):
+                    logging.warning('Readout worker stuck in driver, killing the driver process')
+                    self.hardware.kill()
+                    self.hardware.is_counting = False
+                else:
+                    self._stray.append(worker)
+
+        if self.hardware.is_counting:
+            self.hardware.count_stop()
+        return stopped
+
+    @property
+    def is_running(self):
+        return self._watchdog is not None and self._watchdog.is_alive()
+
+    @property
+    def deadline(self):
+        """
+        Seconds without data after which the readout is considered stalled.
+        """
+        _, _, gate_time = self.hardware.get_gatetime_data()
+        return max(self.deadline_factor * self.hardware.gates * gate_time, self.min_deadline)
+
+    @property
+    def stray_workers(self):
+        self._stray = [worker for worker in self._stray if worker.is_alive()]
+        return len(self._stray)
+
+    @property
+    def stats(self):
+        return {
+            'restarts': self.restarts,
+            'stalls': self.stalls,
+            'errors': self.errors,
+            'lost_s': sum(record['lost_s'] for record in self.history),
+            'lost_samples': sum(record['lost_samples'] for record in self.history),
+            'stray_workers': self.stray_workers,
+            'history': list(self.history),
+        }
+
+    #############
+    # INTERNALS #
+    #############
+    def _start_worker(self):
+        with self._lock:
+            self._generation += 1
+            self._worker = th.Thread(name='Data Reader', target=self._work, args=(self._generation,), daemon=True)
+            self._worker.start()
+
+    def _work(self, generation):
+        while generation == self._generation and not self._halt.is_set():
+            try:
+                with self._read_lock:
+                    block = self.hardware.read_block()
+            except (RuntimeError, TimeoutError) as e:
+                if generation == self._generation and not self._halt.is_set():
+                    self._failure = e
+                    self._wake.set()
+                return
+
+            with block:
+                if generation != self._generation:
+                    # cancelled while waiting on the driver: this data belongs to an abandoned acquisition
+                    return
+                block.t_start += self._t_offset
+                self._t_end = block.t_start + len(block) * block.gate_time
+                self._t_recv = block.t_recv
+                self._last_read = time.monotonic()
+                self._failed_restarts = 0
+                self.sink(block)
+
+    def _watch(self):
+        while not self._halt.is_set():
+            deadline = self.deadline
+            self._wake.wait(deadline / 4)
+            self._wake.clear()
+            if self._halt.is_set():
+                break
+
+            failure = self._failure
+            stalled_for = time.monotonic() - self._last_read
+            if failure is not None:
+                self.errors += 1
+                self._notify(EVENT_ERROR, {'error': str(failure)})
+            elif stalled_for > deadline:
+                self.stalls += 1
+                self._notify(EVENT_STALL, {'stalled_s': stalled_for, 'deadline_s': deadline})
+            else:
+                continue
+
+            if self._failed_restarts >= self.max_restarts:
+                self._notify(EVENT_FAILED, {'restarts': self._failed_restarts})
+                self._halt.set()
+                break
+
+            try:
+                self._restart(stalled_for, failure)
+            except (RuntimeError, TimeoutError) as e:
+                self._failure = e
+                self._wake.set()
+            self._failed_restarts += 1
+
+    def _restart(self, stalled_for, failure):
+        # cancel the current worker
+        with self._lock:
+            self._generation += 1
+            old = self._worker
+            self._worker = None
+        self._failure = None
+
+        if hasattr(self.hardware, 'restart'):
+            # process-isolated driver: kill and respawn, it keeps the time axis continuous by itself
+            self.hardware.restart()
+            if old is not None:
+                old.join(self.deadline)
+            if old is not None and old.is_alive():
+                self._stray.append(old)
+        else:
+            if old is not None:
+                old.join(self.deadline / 4)
+                if old.is_alive():
+                    self._stray.append(old)
+            self._count_start(restart=True)
+
+        t_restart = time.time()
+        lost = max(t_restart - self._t_recv, 0.0)
+        if not hasattr(self.hardware, 'restart'):
+            self._t_offset = self._t_end + lost
+
+        _, _, gate_time = self.hardware.get_gatetime_data()
+        record = {
+            'time': t_restart,
+            'reason': str(failure) if failure is not None else f'no data for {stalled_for:.2f}s',
+            'lost_s': lost,
+            'lost_samples': int(lost / gate_time),
+        }
+        self.restarts += 1
+        self.history.append(record)
+
+        self._last_read = time.monotonic()
+        self._start_worker()
+        self._notify(EVENT_RESTART, record)
+
+    def _count_start(self, restart=False):
+        # a worker still inside the driver would stamp its block on the restarted handle (and move its gate count)
+        if not self._read_lock.acquire(timeout=self.deadline):
+            raise RuntimeError('Readout worker still stuck in the driver, the hardware cannot be restarted in-process '
+                               '(use a process-isolated driver)')
+        try:
+            if restart and self.hardware.is_counting:
+                try:
+                    self.hardware.count_stop()
+                except (RuntimeError, TimeoutError) as e:
+                    logging.warning(f'Could not stop counting before restart. Msg: {str(e)}')
+            self.hardware.count_start()
+        finally:
+            self._read_lock.release()
+
+    def _notify(self, kind, info):
+        logging.log(logging.INFO if kind == EVENT_RESTART else logging.WARNING, f'Readout {kind}: {info}')
+        if self.on_event is not None:
+            self.on_event(kind, info)
+
+
+if __name__ == '__main__':
+    from .hamamatsu import Hamamatsu
+
+    hw = Hamamatsu.open()
+    hw.gate_time = '1MS'
+    hw.setup(mode=1)
+
+    # make the driver hang once
+    read_block = hw.read_block
+    calls = [0]
+
+    def hanging_read():
+        calls[0] += 1
+        if calls[0] == 5:
+            time.sleep(3.0)
+        return read_block()
+    hw.read_block = hanging_read
+
+    received = []
+    sup = ReadoutSupervisor(hw, lambda b: received.append(b.t_start), on_event=lambda k, i: print(k, i))
+    sup.start()
+    time.sleep(4.0)
+    print(f'stopped cleanly: {sup.stop()}')
+    print(f'{len(received)} blocks, last t_start {received[-1]:.2f}s', sup.stats)
@@ -3,7 +3,9 @@ import faulthandler
 
 from PyQt5.QtWidgets import QApplication
 
+from PhotonCounter import hamamatsu, replaylib
 from PhotonCounter.photoncounter_gui import PhotonCounterGui
+from PhotonCounter.Gui.framescheduler import DEFAULT_MAX_FPS
 
 import logging
 fmt = "[%(asctime)s] [%(levelname)s] [%(funcName)s(): line %(lineno)s] [PID:%(process)d TID:%(thread)d] %(message)s"
@@ -14,11 +16,33 @@ APP_NAME = "BaLi Photon Counter"
 APP_VERSION = "0.2"
 
 
+def _option(sys_argv, name, default=None):
+    # value following 'name' on the command line
+    if name in sys_argv and sys_argv.index(name) + 1 < len(sys_argv):
+        return sys_argv[sys_argv.index(name) + 1]
+    return default
+
+
 class PhotonCounter(QApplication):
     def __init__(self, sys_argv):
         super(PhotonCounter, self).__init__(sys_argv)
 
-        self.gui = PhotonCounterGui()
+        # '--replay <log> [--replay-speed N]' reads a recorded session instead of the hardware (in this process only)
+        replay = _option(sys_argv, '--replay')
+        if replay is not None:
+            replaylib.configure(path=replay, speed=float(_option(sys_argv, '--replay-speed', 1.0)))
+            hamamatsu.set_library(replaylib)
+
+        # '--isolated-driver' runs the hardware driver in a separate process
+        # '--live-session' publishes the samples in a memory-mapped file other processes can follow
+        # '--history-budget <MB>' is the RAM kept for the plot history (older points go to disk)
+        # '--incremental-plot' only adds the new points to the plot instead of redrawing the display window
+        # '--max-fps <N>' caps the plot updates per second
+        self.gui = PhotonCounterGui(isolated_driver='--isolated-driver' in sys_argv and replay is None,
+                                    live_session='--live-session' in sys_argv,
+                                    history_budget=int(float(_option(sys_argv, '--history-budget', 64)) * 2**20),
+                                    incremental_plot='--incremental-plot' in sys_argv,
+                                    max_fps=float(_option(sys_argv, '--max-fps', DEFAULT_MAX_FPS)))
         self.gui.show()
 
         self.setApplicationName(APP_NAME)
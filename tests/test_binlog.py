@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pytest
+
+from PhotonCounter import binlog
+from PhotonCounter.binlog import BinaryLogWriter
+
+
+def _blocks():
+    # 50us blocks of 700 samples, 3 gates missing after the third one
+    times, counts = [], []
+    t_start = 0.0
+    for i in range(8):
+        times.append(t_start + np.arange(700) * 50e-6)
+        counts.append(np.random.default_rng(i).poisson(20 * (i + 1), 700).astype(np.uint32))
+        t_start = times[-1][-1] + (4 if i == 2 else 1) * 50e-6
+    return times, counts
+
+
+def _write(path, times, counts, **kwargs):
+    with BinaryLogWriter(path, gate_time=50e-6, uid=1, chunk_size=256, **kwargs) as writer:
+        for block_times, block_counts in zip(times, counts):
+            writer.write(block_times, block_counts)
+    return writer
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'session.bpc')
+    times, counts = _blocks()
+    writer = _write(path, times, counts)
+
+    header, t, c = binlog.load(path)
+    assert header['gate_time'] == 50e-6 and header['uid'] == 1 and header['chunk_size'] == 256
+    assert writer.samples == len(c) == 8 * 700
+    np.testing.assert_allclose(t, np.concatenate(times), rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(c, np.concatenate(counts))
+
+    # the file is mapped as it is, the gap closes a chunk early
+    _, chunks = binlog.open_chunks(path)
+    assert chunks['npoints'].sum() == len(c)
+    assert np.count_nonzero(chunks['npoints'][:-1] < 256) == 1
+    _, t2, c2 = binlog.load(path, mmap=True)
+    np.testing.assert_array_equal(c2, c)
+
+    # the groups of chunks cover the file once
+    groups = list(binlog.iter_blocks(path, samples=1000))
+    assert len(groups) > 1
+    np.testing.assert_array_equal(np.concatenate([group[2] for group in groups]), c)
+
+
+def test_irregular_times(tmp_path):
+    path = str(tmp_path / 'session.bpc')
+    times = np.cumsum(np.random.default_rng(0).integers(1, 4, 1000)) * 50e-6
+    counts = np.arange(1000, dtype=np.uint32)
+    _write(path, [times], [counts])
+    _, t, c = binlog.load(path)
+    np.testing.assert_allclose(t, times, rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(c, counts)
+
+
+def test_append(tmp_path):
+    path = str(tmp_path / 'session.bpc')
+    times, counts = _blocks()
+    _write(path, times[:4], counts[:4])
+    _write(path, times[4:], counts[4:])
+    _, t, c = binlog.load(path)
+    np.testing.assert_array_equal(c, np.concatenate(counts))
+
+    with pytest.raises(ValueError):
+        BinaryLogWriter(path, gate_time=50e-6, chunk_size=512)
+
+
+def test_csv_conversion(tmp_path):
+    path = str(tmp_path / 'session.bpc')
+    times, counts = _blocks()
+    _write(path, times, counts)
+
+    csv_path = binlog.binary_to_csv(path)
+    with open(csv_path) as f_in:
+        assert f_in.readline() == '# GATE TIME 50US.\n'
+    converted = binlog.csv_to_binary(csv_path, str(tmp_path / 'converted.bpc'), chunk_size=256)
+    header, t, c = binlog.load(converted)
+    assert header['gate_time'] == 50e-6
+    np.testing.assert_allclose(t, np.concatenate(times), rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(c, np.concatenate(counts))
+
+
+@pytest.mark.parametrize('delta', [True, False])
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_codecs(codec, delta):
+    # small counts, and steps that wrap around uint32
+    counts = np.concatenate((np.random.default_rng(0).poisson(5, 1000), [0, 2**32 - 1, 0, 2**31, 7])).astype(np.uint32)
+    payload = binlog.encode_counts(counts, codec, delta=delta)
+    assert len(payload) < counts.nbytes / 2
+    np.testing.assert_array_equal(binlog.decode_counts(payload, len(counts), codec, delta=delta), counts)
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'lzma'])
+def test_compressed_round_trip(tmp_path, codec):
+    path = str(tmp_path / 'session.bpc')
+    times, counts = _blocks()
+    _write(path, times[:5], counts[:5], codec=codec)
+    # appending keeps the codec of the file
+    _write(path, times[5:], counts[5:], codec=codec)
+
+    header, t, c = binlog.load(path)
+    assert binlog.is_compressed(header) and header['codec'] == codec
+    np.testing.assert_allclose(t, np.concatenate(times), rtol=0, atol=1e-9)
+    np.testing.assert_array_equal(c, np.concatenate(counts))
+    np.testing.assert_array_equal(np.concatenate([group[2] for group in binlog.iter_blocks(path, 1000)]), c)
+    with pytest.raises(ValueError):
+        binlog.open_chunks(path)
+    with pytest.raises(ValueError):
+        BinaryLogWriter(path, gate_time=50e-6, chunk_size=256)
+
+    plain = str(tmp_path / 'plain.bpc')
+    _write(plain, times, counts)
+    assert os.path.getsize(path) < os.path.getsize(plain) / 2
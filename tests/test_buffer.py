@@ -0,0 +1,107 @@
+import threading as th
+import time
+
+import numpy as np
+import pytest
+
+from PhotonCounter.buffer import RingBuffer, SimpleBuffer
+
+
+@pytest.mark.parametrize('cls', [SimpleBuffer, RingBuffer])
+def test_shrink_during_pushes(tmp_path, cls):
+    path = tmp_path / 'log.csv'
+    kwargs = {'dtypes': [np.float64, np.uint32]} if cls is RingBuffer else {}
+    buffer = cls(1000, str(path), ['Time', 'Counts'], save=True, **kwargs)
+
+    npoints = 0
+    for size in (None, 100, 7, 2000):
+        if size is not None:
+            buffer.size = size
+        buffer.push_block(np.arange(npoints, npoints + 800) * 1e-3, np.arange(npoints, npoints + 800))
+        npoints += 800
+    buffer.close()
+
+    # the 7 points left by the smallest size, then the last block
+    assert len(buffer) == 807
+    # every point was saved once, in order
+    counts = np.loadtxt(path, delimiter=',', comments='#')[:, 1]
+    np.testing.assert_array_equal(counts, np.arange(npoints))
+
+
+class _Sink:
+    def __init__(self):
+        self.samples = 0
+        self.closed = False
+
+    def write(self, *columns):
+        time.sleep(1e-4)
+        assert not self.closed, 'closed during a write'
+        self.samples += len(columns[0])
+
+    def close(self):
+        self.closed = True
+
+
+def test_sinks_swapped_during_pushes(tmp_path):
+    path = tmp_path / 'log.csv'
+    buffer = RingBuffer(100, str(path), ['Time', 'Counts'], dtypes=[np.float64, np.uint32], save=True)
+    sinks = []
+    errors = []
+    halt = th.Event()
+
+    def push():
+        npoints = 0
+        while not halt.is_set():
+            try:
+                buffer.push_block(np.arange(npoints, npoints + 10) * 1e-3, np.arange(npoints, npoints + 10))
+            except AssertionError as e:
+                errors.append(e)
+            npoints += 10
+        return npoints
+
+    pusher = th.Thread(target=lambda: sinks.append(push()))
+    pusher.start()
+    for _ in range(200):
+        buffer.close()
+        sinks.insert(0, _Sink())
+        buffer.log = buffer.live = sinks[0]
+        time.sleep(1e-3)
+    halt.set()
+    pusher.join()
+    buffer.close()
+
+    assert not errors
+    # every block reached the log and the live file attached at the time, the CSV file got the others
+    *sinks, npoints = sinks
+    saved = len(np.loadtxt(path, delimiter=',', comments='#', ndmin=2)) if path.exists() else 0
+    assert sum(sink.samples for sink in sinks) == 2 * (npoints - saved)
+
+
+def test_timebase(tmp_path):
+    path = tmp_path / 'log.csv'
+    buffer = RingBuffer(1000, str(path), ['Time', 'Counts'], dtypes=[np.float64, np.uint32], save=True, timebase=True)
+    plain = RingBuffer(1000, str(tmp_path / 'plain.csv'), ['Time', 'Counts'], dtypes=[np.float64, np.uint32])
+
+    t_start = 0.0
+    pushed = []
+    for i in range(12):
+        times = t_start + np.arange(300) * 50e-6
+        buffer.push_block(times, np.arange(i * 300, (i + 1) * 300))
+        plain.push_block(times, np.arange(i * 300, (i + 1) * 300))
+        pushed.append(times)
+        # a gap between some of the blocks
+        t_start = times[-1] + (1 + i % 3) * 50e-6
+        if i == 6:
+            buffer.size = plain.size = 250
+    buffer.close()
+
+    for mine, expected in zip(buffer.last(), plain.last()):
+        np.testing.assert_allclose(mine, expected, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(buffer[-1], plain[-1], rtol=0, atol=1e-12)
+    np.testing.assert_allclose(buffer[3:7][0], plain[3:7][0], rtol=0, atol=1e-12)
+    # only the counts (and the first time and step of a few blocks) are stored
+    assert 2 * buffer.nbytes < plain.nbytes
+    # the CSV file gets the times too
+    saved = np.loadtxt(path, delimiter=',', comments='#')
+    np.testing.assert_array_equal(saved[:, 1], np.arange(12 * 300))
+    np.testing.assert_allclose(saved[:, 0], np.concatenate(pushed), rtol=0, atol=1e-9)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from PhotonCounter.decimation import MinMaxPyramid, envelope, minmax
+
+
+def _bins_brute_force(x, y, starts, t_stop):
+    # min, max and mean of the samples of each bin: from its start to the start of the next one
+    stops = np.append(starts[1:], np.inf if t_stop is None else t_stop)
+    out = []
+    for start, stop in zip(starts, stops):
+        values = y[(x >= start) & (x < stop)]
+        out.append((values.min(), values.max(), values.mean()))
+    return np.array(out).T
+
+
+@pytest.mark.parametrize('npoints', [1, 999, 1000, 1001])
+def test_minmax(npoints):
+    x = np.arange(npoints) * 1e-3
+    y = np.random.default_rng(npoints).poisson(20, npoints)
+    t, ymin, ymax = minmax(x, y, 100)
+    assert len(t) <= 100
+    size = -(-npoints // 100)
+    for k in range(len(t)):
+        assert t[k] == x[k * size]
+        assert ymin[k] == y[k * size:(k + 1) * size].min() and ymax[k] == y[k * size:(k + 1) * size].max()
+    xx, yy = envelope(t, ymin, ymax)
+    assert len(xx) == len(yy) == 2 * len(t)
+    np.testing.assert_array_equal(yy[1::2], ymax)
+
+
+def test_pyramid_against_brute_force():
+    rng = np.random.default_rng(0)
+    npoints = 50000
+    x = np.arange(npoints) * 1e-3
+    y = rng.poisson(20, npoints).astype(float)
+    # a few spikes that must survive any decimation
+    spikes = rng.choice(npoints, 20, replace=False)
+    y[spikes] = 1000
+
+    pyramid = MinMaxPyramid(base=4, factor=3, level_bins=16)
+    start = 0
+    while start < npoints:
+        stop = start + int(rng.integers(1, 500))
+        pyramid.push(x[start:stop], y[start:stop])
+        start = stop
+    assert len(pyramid) == npoints
+    # the number of levels grows with the logarithm of the samples, each one keeps at most 2 * 16 bins (plus the bins
+    # of one push)
+    assert pyramid.levels <= int(np.log(npoints / 4) / np.log(3)) + 2
+    assert pyramid.nbytes <= pyramid.levels * 4 * 8 * (2 * 16 + 500 // 4)
+
+    for t_start, t_stop, max_bins in [(49.9, None, 100), (45.0, None, 20), (0.0, None, 20), (40.0, 47.0, 20),
+                                      (49.99, 49.995, 10)]:
+        t, ymin, ymax, ymean = pyramid.window(t_start, t_stop, max_bins)
+        assert 0 < len(t) <= max_bins + 1
+        # the first bin holds t_start
+        assert t[0] <= t_start and (len(t) == 1 or t[1] > t_start)
+        assert np.all(np.diff(t) > 0)
+        # the last bin may go past t_stop: only the complete ones are checked
+        complete = len(t) if t_stop is None else len(t) - 1
+        expected = _bins_brute_force(x, y, t, t_stop)
+        np.testing.assert_array_equal(ymin[:complete], expected[0][:complete])
+        np.testing.assert_array_equal(ymax[:complete], expected[1][:complete])
+        np.testing.assert_allclose(ymean[:complete], expected[2][:complete])
+        # no spike is lost
+        inside = spikes[(x[spikes] >= t[0]) & (x[spikes] < (t_stop if t_stop is not None else np.inf))]
+        for spike in inside:
+            assert ymax[np.searchsorted(t, x[spike], side='right') - 1] == 1000
+
+    pyramid.clear()
+    assert len(pyramid) == 0 and len(pyramid.window(0.0)[0]) == 0
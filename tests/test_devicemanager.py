@@ -0,0 +1,78 @@
+import threading as th
+import time
+
+import numpy as np
+import pytest
+
+from PhotonCounter import fakelib
+from PhotonCounter.devicemanager import DeviceManager, _UnitWorker
+from PhotonCounter.hamamatsu import BufferPool, Hamamatsu
+
+
+@pytest.fixture
+def unthrottled():
+    fakelib.configure(realtime=False)
+    yield
+    fakelib.reset_config()
+
+
+def _block(pool, seq):
+    block = pool.acquire()
+    block.seq = seq
+    block.t_start = seq * len(block) * 1e-3
+    block.gate_time = 1e-3
+    block.data[:] = seq
+    return block
+
+
+def test_collect_skips_dropped_head():
+    pool = BufferPool(10)
+    manager = DeviceManager([Hamamatsu()])
+    worker = _UnitWorker(0, manager.devices[0], manager)
+    worker.alive = True
+    manager._workers = [worker]
+    # blocks 0..2 were dropped from the full queue
+    worker.queue.extend((seq, _block(pool, seq)) for seq in (3, 4))
+
+    with manager.cond:
+        blocks = manager._collect()
+    assert blocks is not None
+    merged = manager._build(blocks)
+    assert merged.seq == 3
+    assert np.all(merged.counts == 3)
+    assert manager.blocks_lost == 3
+
+    with manager.cond:
+        assert manager._build(manager._collect()).seq == 4
+        assert manager._collect() is None
+    assert manager.blocks_lost == 3
+    assert pool.available == pool.size
+
+
+def test_merge_resumes_after_consumer_stall(unthrottled):
+    manager = DeviceManager([Hamamatsu.open()], queue_size=8)
+    manager.setup('50US')
+    merged = []
+    paused = th.Event()
+
+    def callback(block):
+        if not paused.is_set():
+            # the queue overflows while the consumer is away
+            paused.set()
+            time.sleep(0.5)
+        merged.append(block.seq)
+
+    try:
+        manager.start(callback)
+        time.sleep(1.0)
+        assert manager.stop()
+    finally:
+        manager.close()
+
+    stats = manager.stats
+    assert stats['dropped'][0] > 0
+    # every block read was either merged, dropped or counted as lost
+    assert len(merged) > 100
+    assert stats['merged'] == len(merged)
+    assert np.all(np.diff(merged) > 0)
+    assert stats['lost'] == merged[-1] + 1 - len(merged)
@@ -0,0 +1,53 @@
+import time
+
+import pytest
+from PyQt5.QtCore import QCoreApplication
+
+from PhotonCounter.Gui.framescheduler import FrameScheduler
+
+
+@pytest.fixture(scope='module')
+def app():
+    yield QCoreApplication.instance() or QCoreApplication([])
+
+
+def test_skipped_frames(app):
+    frames = []
+    scheduler = FrameScheduler(lambda: frames.append(time.monotonic()), max_fps=100)
+    scheduler.start()
+    assert scheduler.is_running
+
+    # no data: nothing rendered, nothing skipped
+    for _ in range(5):
+        scheduler._on_tick()
+    assert scheduler.stats['frames_rendered'] == 0
+    assert scheduler.stats['frames_skipped'] == 0
+
+    # data rendered at the next tick
+    scheduler.notify(3)
+    scheduler._on_tick()
+    assert scheduler.stats['frames_rendered'] == 1
+    assert scheduler.stats['frames_skipped'] == 0
+
+    # data waiting while the GUI thread is busy for 10 periods
+    scheduler.notify()
+    time.sleep(0.1)
+    scheduler.notify()
+    scheduler._on_tick()
+    stats = scheduler.stats
+    assert stats['frames_rendered'] == 2
+    assert stats['blocks_rendered'] == 5
+    assert 9 <= stats['frames_skipped'] <= 12
+
+    # what comes after the last tick is rendered at stop
+    scheduler.notify()
+    scheduler.stop()
+    assert not scheduler.is_running
+    assert scheduler.stats['frames_rendered'] == 3
+    # nothing is counted while stopped
+    fps = scheduler.stats['fps']
+    time.sleep(0.05)
+    scheduler.notify()
+    assert scheduler.stats['frames_skipped'] == stats['frames_skipped']
+    assert scheduler.stats['fps'] == fps
+    assert len(frames) == 3
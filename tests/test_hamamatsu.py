@@ -0,0 +1,88 @@
+import time
+
+import numpy as np
+import pytest
+
+from PhotonCounter import fakelib
+from PhotonCounter.hamamatsu import BufferPool, Hamamatsu
+
+
+@pytest.fixture
+def hardware():
+    fakelib.reset_config()
+    hw = Hamamatsu.open()
+    yield hw
+    hw.close()
+
+
+def test_stamp_host_stall(hardware):
+    hardware.gate_time = '50US'
+    hardware.setup(mode=1)
+    hardware.count_start()
+
+    starts, late = [], []
+    for i in range(30):
+        if i == 10:
+            # the host falls behind, the unit keeps its data
+            time.sleep(0.2)
+        with hardware.read_block() as block:
+            starts.append(block.t_start)
+            late.append(block.late)
+            assert block.gap == 0
+    hardware.count_stop()
+
+    np.testing.assert_allclose(starts, np.arange(30) * 500 * 50e-6)
+    assert hardware.blocks_lost == 0
+    # the blocks buffered during the stall are reported as late, the readout then catches up
+    assert late[10] and not late[-1]
+    assert hardware.blocks_late == sum(late)
+
+
+def test_pool_refcounts():
+    pool = BufferPool(100, size=2)
+    block = pool.acquire()
+    assert pool.available == 1
+
+    # two consumers hold the block, it goes back to the pool with the last reference
+    block.retain()
+    block.retain()
+    block.release()
+    block.release()
+    assert pool.available == 1
+    with block:
+        pass
+    assert pool.available == 2
+    with pytest.raises(RuntimeError):
+        block.release()
+    with pytest.raises(RuntimeError):
+        block.retain()
+
+    # the pool grows when every buffer is in use
+    blocks = [pool.acquire() for _ in range(3)]
+    assert pool.size == 3 and pool.misses == 1
+    for block in blocks:
+        block.release()
+    assert pool.available == pool.size
+
+
+def test_read_reuses_buffers(hardware):
+    hardware.gate_time = '50US'
+    hardware.setup(mode=1)
+    hardware.count_start()
+    held = []
+    for i in range(40):
+        block = hardware.read_block()
+        if i % 10 == 0:
+            # a slow consumer keeps a few blocks for a while
+            held.append(block.retain())
+        block.release()
+        if len(held) > 2:
+            held.pop(0).release()
+    hardware.count_stop()
+
+    pool = hardware.pool
+    assert pool.misses == 0
+    assert pool.available == pool.size - len(held)
+    for block in held:
+        block.release()
+    assert pool.available == pool.size
@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+from PhotonCounter.livefile import LiveSessionReader, LiveSessionWriter, remove, segment_path
+
+
+def _samples(start, npoints):
+    return (start + np.arange(npoints)) * 1e-3, np.arange(start, start + npoints, dtype=np.uint32)
+
+
+def _writer(path, capacity=100):
+    return LiveSessionWriter(path, ['Time', 'Counts'], dtypes=[np.float64, np.uint32], gate_time=1e-3,
+                             capacity=capacity)
+
+
+def test_segments_grow(tmp_path):
+    path = str(tmp_path / 'session.live')
+    writer = _writer(path)
+    reader = LiveSessionReader(path)
+    assert len(reader) == 0 and not reader.wait(timeout=0.0)
+
+    seen = []
+    early = None
+    for start in range(0, 1000, 70):
+        writer.write(*_samples(start, min(70, 1000 - start)))
+        assert reader.wait(timeout=0.0)
+        times, counts = reader.read_new()
+        seen.append(counts)
+        if early is None:
+            early = counts
+    np.testing.assert_array_equal(np.concatenate(seen), np.arange(1000))
+    # the views handed out before new segments were mapped are still valid
+    np.testing.assert_array_equal(early, np.arange(70))
+
+    # segments of 100, 200, 400 and 800 records, the new ones are created at their full size
+    assert [os.path.isfile(segment_path(path, k)) for k in range(5)] == [True] * 4 + [False]
+    assert len(reader.chunks(50, 750)) == 4
+    times, counts = reader.columns(50, 750)
+    np.testing.assert_array_equal(counts, np.arange(50, 750))
+    np.testing.assert_allclose(times, np.arange(50, 750) * 1e-3)
+    # within a segment: a view on the file
+    assert not reader.columns(300, 700)[1].flags.owndata
+
+    # another process sees the same samples
+    script = ('import sys; from PhotonCounter.livefile import LiveSessionReader; '
+              'r = LiveSessionReader(sys.argv[1]); print(len(r), int(r.columns()[1].sum()))')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    output = subprocess.run([sys.executable, '-c', script, path], capture_output=True, text=True, env=env, check=True)
+    assert output.stdout.split() == ['1000', str(sum(range(1000)))]
+
+    writer.close()
+    reader.close()
+    remove(path)
+    assert not any(os.path.isfile(segment_path(path, k)) for k in range(4))
+
+
+def test_close_and_reopen(tmp_path):
+    path = str(tmp_path / 'session.live')
+    writer = _writer(path)
+    writer.write(*_samples(0, 250))
+    reader = LiveSessionReader(path)
+    assert len(reader.read_new()[0]) == 250
+    writer.close()
+
+    # the reader is told that nothing more is coming, the last segment is cut to the valid records
+    assert reader.closed and not reader.wait(timeout=1.0)
+    assert os.path.getsize(segment_path(path, 1)) == 150 * writer.dtype.itemsize
+
+    # appending extends the last segment again
+    writer = _writer(path)
+    assert writer.samples == 250
+    writer.write(*_samples(250, 400))
+    assert not reader.closed
+    assert reader.wait(timeout=0.0)
+    np.testing.assert_array_equal(reader.read_new()[1], np.arange(250, 650))
+    writer.close()
+
+    with LiveSessionReader(path) as reopened:
+        assert reopened.closed and len(reopened) == 650
+        np.testing.assert_array_equal(reopened.records['Counts'], np.arange(650))
+        assert reopened.gate_time == 1e-3
+    reader.close()
@@ -0,0 +1,55 @@
+import threading as th
+import time
+
+import pytest
+
+from PhotonCounter.pipeline import DROP_NEWEST, DROP_OLDEST, KEEP_ALL, AcquisitionPipeline
+
+
+class _Block:
+    def __init__(self, seq):
+        self.seq = seq
+        self.refs = 1
+
+    def retain(self):
+        self.refs += 1
+        return self
+
+    def release(self):
+        assert self.refs > 0
+        self.refs -= 1
+
+
+@pytest.mark.parametrize('policy, expected', [
+    (DROP_OLDEST, [0] + list(range(7, 10))),
+    (DROP_NEWEST, list(range(4))),
+    (KEEP_ALL, list(range(10))),
+])
+def test_policies(policy, expected):
+    gate = th.Event()
+    received = []
+
+    def consume(blocks):
+        gate.wait()
+        received.extend(block.seq for block in blocks)
+
+    pipeline = AcquisitionPipeline()
+    consumer = pipeline.add_consumer('slow', consume, maxsize=3, batch_size=1, policy=policy)
+    pipeline.start()
+
+    blocks = [_Block(seq) for seq in range(10)]
+    pipeline.put(blocks[0])
+    # block 0 is being processed, the others wait in the queue
+    while consumer.depth:
+        time.sleep(1e-3)
+    for block in blocks[1:]:
+        pipeline.put(block)
+    gate.set()
+    assert pipeline.drain(timeout=5.0)
+    pipeline.stop()
+
+    assert received == expected
+    assert consumer.stats['dropped'] == 10 - len(expected)
+    assert consumer.stats['overflows'] == (6 if policy == KEEP_ALL else 0)
+    # every reference taken by the consumer was given back
+    assert all(block.refs == 1 for block in blocks)
@@ -0,0 +1,48 @@
+import logging
+
+import numpy as np
+import pytest
+
+from PhotonCounter import fakelib, hamamatsu, replaylib
+from PhotonCounter.binlog import BinaryLogWriter
+from PhotonCounter.hamamatsu import Hamamatsu
+
+
+@pytest.fixture
+def recording(tmp_path):
+    path = str(tmp_path / 'session.bpc')
+    writer = BinaryLogWriter(path, gate_time=50e-6)
+    # 5 blocks of 500 gates and a partial one, without gaps
+    writer.write(np.arange(2700) * 50e-6, np.arange(2700, dtype=np.uint32))
+    writer.close()
+    yield path
+    replaylib.reset_config()
+    hamamatsu.set_library(fakelib)
+
+
+def test_replay_slower_than_real_time(recording, caplog):
+    replaylib.configure(path=recording, speed=0.5)
+    hamamatsu.set_library(replaylib)
+    hw = Hamamatsu.open()
+    try:
+        hw.gate_time = '50US'
+        hw.setup(mode=1)
+        hw.count_start()
+        starts, counts = [], []
+        with caplog.at_level(logging.WARNING):
+            while True:
+                try:
+                    block = hw.read_block()
+                except RuntimeError:
+                    break
+                with block:
+                    assert block.gap == 0 and not block.late
+                    starts.append(block.t_start)
+                    counts.append(block.data.copy())
+    finally:
+        hw.close()
+
+    np.testing.assert_allclose(starts, np.arange(5) * 500 * 50e-6)
+    np.testing.assert_array_equal(np.concatenate(counts), np.arange(2500))
+    assert hw.blocks_late == 0
+    assert 'dropped the last 200 samples' in caplog.text
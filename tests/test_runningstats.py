@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from PhotonCounter.runningstats import STATS, StreamingStats
+
+
+def _brute_force(values, window, alpha=None):
+    alpha = 2.0 / (window + 1) if alpha is None else alpha
+    out = {name: np.empty(len(values)) for name in STATS}
+    ema = values[0]
+    for i in range(len(values)):
+        run = values[max(i - window + 1, 0):i + 1]
+        ema = (1 - alpha) * ema + alpha * values[i]
+        out['mean'][i] = run.mean()
+        out['ema'][i] = ema
+        out['var'][i] = run.var()
+        out['min'][i] = run.min()
+        out['max'][i] = run.max()
+    return out
+
+
+def _push(stats, values, seed=0):
+    # blocks of random sizes, single samples included
+    rng = np.random.default_rng(seed)
+    start = 0
+    while start < len(values):
+        stop = start + int(rng.choice([1, 3, 50, 700]))
+        stats.push(values[start:stop])
+        start = stop
+
+
+def _check(stats, expected, start=0):
+    for name, result in zip(STATS, stats.read(start)):
+        np.testing.assert_allclose(result, expected[name][start:], rtol=1e-9, atol=1e-6, err_msg=name)
+
+
+@pytest.mark.parametrize('window', [1, 7, 100])
+@pytest.mark.parametrize('offset', [0.0, 1e6])
+def test_against_brute_force(window, offset):
+    values = offset + np.random.default_rng(window).poisson(20, 3000)
+    stats = StreamingStats(window)
+    _push(stats, values)
+    assert len(stats) == len(values)
+
+    expected = _brute_force(values, window)
+    _check(stats, expected)
+    assert stats.mean_min == pytest.approx(expected['mean'].min())
+    assert stats.mean_max == pytest.approx(expected['mean'].max())
+    for name, result in zip(STATS, stats.last(10)):
+        np.testing.assert_allclose(result, expected[name][-10:], rtol=1e-9, atol=1e-6)
+
+
+def test_window_and_alpha_change():
+    values = np.random.default_rng(0).poisson(20, 2000).astype(float)
+    stats = StreamingStats(10)
+    _push(stats, values)
+
+    stats.window = 33
+    _check(stats, _brute_force(values, 33))
+    stats.alpha = 0.5
+    _check(stats, _brute_force(values, 33, alpha=0.5))
+    # the pushes after the change use the new parameters
+    more = np.random.default_rng(1).poisson(20, 500).astype(float)
+    _push(stats, more)
+    _check(stats, _brute_force(np.concatenate((values, more)), 33, alpha=0.5))
+
+
+def test_capacity():
+    values = np.random.default_rng(0).poisson(20, 5000).astype(float)
+    stats = StreamingStats(50, capacity=1000)
+    _push(stats, values[:4000])
+    # a block larger than what is kept
+    stats.push(values[4000:])
+    expected = _brute_force(values, 50)
+
+    # the last 'capacity' samples are kept at least, the older ones are NaN
+    assert np.all(np.isnan(stats.read(0, 100)[0]))
+    _check(stats, expected, len(values) - 1000)
+    mean, = stats.read(3900, 4100, ['mean'])
+    assert mean.shape == (200,) and np.all(np.isnan(mean[:100]))
+    np.testing.assert_allclose(mean[100:], expected['mean'][4000:4100])
+
+    stats.clear()
+    assert len(stats) == 0 and stats.read(0)[0].shape == (0,)
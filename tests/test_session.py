@@ -0,0 +1,98 @@
+import os
+
+import numpy as np
+import pytest
+
+from PhotonCounter.binlog import BinaryLogWriter
+from PhotonCounter.session import INDEX_STRIDE, INDEX_SUFFIX, SessionReader
+from PhotonCounter.storage import CsvLogWriter
+
+FORMATS = ['csv', 'counts_only', 'binary', 'zlib']
+
+
+def _samples(start, npoints):
+    # 1ms gates, 5 of them missing after the 12000th sample
+    rows = start + np.arange(npoints)
+    times = (rows + 5 * (rows >= 12000)) * 1e-3
+    return times, rows.astype(np.uint32)
+
+
+class _CountsOnly:
+    # the older CSV logs: gate time header line, one count per row
+    def __init__(self, path):
+        new_file = not os.path.isfile(path)
+        self._file = open(path, 'a')
+        if new_file:
+            self._file.write('# GATE TIME 1MS.\n#Counts\n')
+
+    def write(self, times, counts):
+        np.savetxt(self._file, counts, fmt='%d')
+
+    def close(self):
+        self._file.close()
+
+
+def _write(path, fmt, start, npoints):
+    if fmt == 'csv':
+        writer = CsvLogWriter(path, ['Time', 'Counts'], dtypes=[np.float64, np.uint32], header='# GATE TIME 1MS.')
+    elif fmt == 'counts_only':
+        writer = _CountsOnly(path)
+    else:
+        writer = BinaryLogWriter(path, gate_time=1e-3, chunk_size=1000, codec='none' if fmt == 'binary' else fmt)
+    writer.write(*_samples(start, npoints))
+    writer.close()
+
+
+@pytest.fixture(params=FORMATS)
+def session(tmp_path, request):
+    fmt = request.param
+    path = str(tmp_path / ('session.csv' if 'csv' in fmt or fmt == 'counts_only' else 'session.bpc'))
+    _write(path, fmt, 0, 20000)
+    return path, fmt
+
+
+def test_range_queries(session):
+    path, fmt = session
+    # the counts-only logs have no time column: no gap
+    times, counts = _samples(0, 20000) if fmt != 'counts_only' else (np.arange(20000) * 1e-3, np.arange(20000))
+    with SessionReader(path) as reader:
+        assert len(reader) == 20000
+        assert reader.gate_time == 1e-3
+        assert reader.t_start == 0.0 and reader.t_stop == pytest.approx(times[-1])
+        # a handful of index entries, not one per sample
+        assert 1 < len(reader.index) <= 20000 // min(INDEX_STRIDE, 1000) + 1
+
+        for t_start, t_stop in [(None, None), (3.0001, 3.5), (11.99, 12.01), (None, 0.01), (19.9, None), (30.0, 40.0)]:
+            t, c = reader.read(t_start, t_stop)
+            keep = np.ones(len(times), dtype=bool)
+            if t_start is not None:
+                keep &= times >= t_start
+            if t_stop is not None:
+                keep &= times < t_stop
+            np.testing.assert_allclose(t, times[keep], rtol=0, atol=1e-9)
+            np.testing.assert_array_equal(c, counts[keep])
+
+        chunks = list(reader.iter_chunks(2.5, 17.5, chunk_size=3000))
+        assert all(len(t) == 3000 for t, _ in chunks[:-1]) and 0 < len(chunks[-1][0]) <= 3000
+        np.testing.assert_array_equal(np.concatenate([c for _, c in chunks]), counts[(times >= 2.5) & (times < 17.5)])
+
+
+def test_growing_session(session):
+    path, fmt = session
+    reader = SessionReader(path)
+    assert os.path.isfile(path + INDEX_SUFFIX)
+    _write(path, fmt, 20000, 5000)
+
+    # the index is extended, the old entries are kept
+    index = reader.index.copy()
+    reader.refresh()
+    assert len(reader) == 25000
+    np.testing.assert_array_equal(reader.index[:len(index)], index)
+    _, counts = reader.read(19.0)
+    assert counts[-1] == 24999
+    reader.close()
+
+    # the saved index is reused
+    with SessionReader(path) as reopened:
+        assert len(reopened) == 25000
+        np.testing.assert_array_equal(reopened.index, reader.index)
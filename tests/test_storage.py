@@ -0,0 +1,147 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pytest
+
+from PhotonCounter import binlog
+from PhotonCounter.binlog import BinaryLogWriter
+from PhotonCounter.session import SegmentedSession
+from PhotonCounter.storage import CsvLogWriter, RotatingLog, StorageWriter, recover
+
+
+def _samples(start, npoints):
+    return (start + np.arange(npoints)) * 1e-3, np.arange(start, start + npoints, dtype=np.uint32)
+
+
+@pytest.mark.parametrize('codec', ['none', 'zlib'])
+def test_recover_binary(tmp_path, codec):
+    path = str(tmp_path / 'session.bpc')
+    with BinaryLogWriter(path, gate_time=1e-3, chunk_size=100, codec=codec) as writer:
+        writer.write(*_samples(0, 1000))
+    size = os.path.getsize(path)
+
+    # a crash in the middle of a chunk, or after the file was extended but before the data reached the disk
+    with open(path, 'ab') as f_out:
+        f_out.write(b'\x01' * 300 + b'\x00' * 500)
+    assert recover(path) == 800
+    assert os.path.getsize(path) == size
+    assert recover(path) == 0
+
+    # a record cut short
+    with open(path, 'r+b') as f_out:
+        f_out.truncate(size - 10)
+    assert recover(path) > 0
+    _, times, counts = binlog.load(path)
+    np.testing.assert_array_equal(counts, np.arange(900))
+
+    # the writer repairs the file before appending
+    with open(path, 'ab') as f_out:
+        f_out.write(b'\x01' * 30)
+    with BinaryLogWriter(path, gate_time=1e-3, chunk_size=100, codec=codec) as writer:
+        writer.write(*_samples(900, 100))
+    _, times, counts = binlog.load(path)
+    np.testing.assert_array_equal(counts, np.arange(1000))
+    np.testing.assert_allclose(times, np.arange(1000) * 1e-3)
+
+
+def test_recover_csv(tmp_path):
+    path = str(tmp_path / 'log.csv')
+    writer = CsvLogWriter(path, ['Time', 'Counts'], dtypes=[np.float64, np.uint32])
+    writer.write(*_samples(0, 10))
+    writer.close()
+    with open(path, 'a') as f_out:
+        f_out.write('0.01,1')
+    assert recover(path) == len('0.01,1')
+
+    writer = CsvLogWriter(path, ['Time', 'Counts'], dtypes=[np.float64, np.uint32])
+    writer.write(*_samples(10, 10))
+    writer.close()
+    saved = np.loadtxt(path, delimiter=',', comments='#')
+    np.testing.assert_array_equal(saved[:, 1], np.arange(20))
+
+
+class _Sink:
+    def __init__(self):
+        self.samples = 0
+        self.syncs = 0
+        self.closed = False
+
+    def write(self, times, counts):
+        self.samples += len(times)
+
+    def flush(self):
+        pass
+
+    def sync(self):
+        self.syncs += 1
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.parametrize('durability', ['none', 'periodic', 'chunk'])
+def test_durability(durability):
+    sink = _Sink()
+    writer = StorageWriter(sink, dtypes=[np.float64, np.uint32], flush_samples=100, durability=durability,
+                           fsync_interval=60.0)
+    for start in range(0, 10000, 50):
+        writer.write(*_samples(start, 50))
+    assert writer.flush(timeout=5.0)
+    syncs = sink.syncs
+    writer.close(timeout=5.0)
+
+    assert sink.samples == 10000 and sink.closed
+    assert writer.stats['samples_written'] == 10000
+    if durability == 'none':
+        assert sink.syncs == 0
+    elif durability == 'periodic':
+        # flush() and close() sync, the interval is never reached
+        assert syncs == 1 and sink.syncs == 2
+    else:
+        # at most one sync per buffer written, fewer when the writer had several buffers to write at once
+        assert 1 <= syncs <= 100
+        assert sink.syncs == writer.stats['syncs']
+
+
+def _rotating(base):
+    return RotatingLog(base, lambda path: BinaryLogWriter(path, gate_time=1e-3, chunk_size=100), extension='.bpc',
+                       gate_time=1e-3, max_duration=1.0)
+
+
+def test_rotation_resumes_manifest(tmp_path, caplog):
+    base = str(tmp_path / 'session')
+    log = _rotating(base)
+    for start in range(0, 2500, 250):
+        log.write(*_samples(start, 250))
+    # crash while the third segment is written: its data reached the file, followed by garbage
+    log.flush()
+    with open(str(tmp_path / 'session_0003.bpc'), 'ab') as f_out:
+        f_out.write(b'\x01' * 123)
+    with open(log.manifest_path) as f_in:
+        segments = json.load(f_in)['segments']
+    assert [segment['closed'] for segment in segments] == [True, True, False]
+    # exactly one second per segment
+    assert [segment['samples'] for segment in segments[:2]] == [1000, 1000]
+
+    with caplog.at_level(logging.WARNING):
+        log = _rotating(base)
+    assert 'session_0003.bpc (123 bytes dropped)' in caplog.text
+    for start in range(2500, 4000, 250):
+        log.write(*_samples(start, 250))
+    log.close()
+
+    with open(log.manifest_path) as f_in:
+        segments = json.load(f_in)['segments']
+    assert [segment['file'] for segment in segments] == [f'session_{i:04d}.bpc' for i in range(1, 6)]
+    assert [segment['closed'] for segment in segments] == [True, True, False, True, True]
+    assert segments[2]['bytes'] == os.path.getsize(str(tmp_path / 'session_0003.bpc'))
+
+    session = SegmentedSession(log.manifest_path)
+    assert len(session) == 4000
+    times, counts = session.read()
+    np.testing.assert_array_equal(counts, np.arange(4000))
+    np.testing.assert_allclose(times, np.arange(4000) * 1e-3)
+    # only the segments of the range are read
+    assert [segment['file'] for segment in session.select(2.1, 2.4)] == ['session_0003.bpc']
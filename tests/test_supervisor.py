@@ -0,0 +1,122 @@
+import time
+
+import pytest
+
+from PhotonCounter.supervisor import EVENT_ERROR, EVENT_FAILED, EVENT_RESTART, EVENT_STALL, ReadoutSupervisor
+
+
+class _Block:
+    def __init__(self, seq, t_start):
+        self.seq = seq
+        self.t_start = t_start
+        self.gate_time = 1e-3
+        self.t_recv = time.time()
+
+    def __len__(self):
+        return 10
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+class _Hardware:
+    """
+    Blocks of 10 gates of 1ms every 10ms, the reads listed in 'faults' hang (a number of seconds) or fail (an exception).
+    """
+    gates = 10
+
+    def __init__(self, faults=None):
+        self.faults = faults or {}
+        self.is_counting = False
+        self.reads = 0
+        self.starts = 0
+
+    def get_gatetime_data(self):
+        return None, self.gates, 1e-3
+
+    def count_start(self):
+        self.is_counting = True
+        self.starts += 1
+        self._seq = 0
+
+    def count_stop(self):
+        self.is_counting = False
+
+    def read_block(self):
+        self.reads += 1
+        fault = self.faults.get(self.reads, 0.01)
+        if isinstance(fault, Exception):
+            raise fault
+        time.sleep(fault)
+        block = _Block(self._seq, self._seq * 10e-3)
+        self._seq += 1
+        return block
+
+
+def _run(hardware, duration, **kwargs):
+    blocks, events = [], []
+    supervisor = ReadoutSupervisor(hardware, lambda block: blocks.append((block.seq, block.t_start)),
+                                   on_event=lambda kind, info: events.append(kind), min_deadline=0.2, **kwargs)
+    supervisor.start()
+    time.sleep(duration)
+    stopped = supervisor.stop()
+    return supervisor, blocks, events, stopped
+
+
+def _check_restarted(blocks):
+    # the acquisition restarted from its first block, later on the time axis
+    restart = [seq for seq, _ in blocks].index(0, 1)
+    before, after = blocks[:restart], blocks[restart:]
+    assert [seq for seq, _ in before] == list(range(len(before)))
+    assert [seq for seq, _ in after] == list(range(len(after)))
+    assert after[0][1] >= before[-1][1] + 10e-3
+    return before, after
+
+
+def test_restart_after_hang():
+    hardware = _Hardware({5: 0.6})
+    supervisor, blocks, events, stopped = _run(hardware, 1.2)
+
+    assert stopped and not supervisor.is_running and not hardware.is_counting
+    # the hardware is not restarted while the hung worker is inside the driver (the restart fails), then it is
+    stats = supervisor.stats
+    assert events == [EVENT_STALL] + [EVENT_ERROR] * stats['errors'] + [EVENT_RESTART]
+    assert stats['errors'] >= 1 and hardware.starts == 2
+    assert stats['restarts'] == 1 and stats['stalls'] == 1 and stats['stray_workers'] == 0
+    # the block of the hung read belongs to the abandoned acquisition: dropped
+    before, after = _check_restarted(blocks)
+    assert len(before) == 4 and len(after) > 10
+    assert stats['lost_s'] >= 0.2 and stats['lost_samples'] == int(stats['history'][0]['lost_s'] / 1e-3)
+
+
+def test_restart_after_error():
+    supervisor, blocks, events, stopped = _run(_Hardware({5: RuntimeError('read failed')}), 0.5)
+    assert stopped
+    assert events == [EVENT_ERROR, EVENT_RESTART]
+    assert supervisor.stats['history'][0]['reason'] == 'read failed'
+    _check_restarted(blocks)
+
+
+def test_give_up():
+    hardware = _Hardware({read: TimeoutError('no answer') for read in range(3, 100)})
+    supervisor, blocks, events, stopped = _run(hardware, 1.0, max_restarts=3)
+    assert events == [EVENT_ERROR, EVENT_RESTART] * 3 + [EVENT_ERROR, EVENT_FAILED]
+    assert not supervisor.is_running
+    assert [seq for seq, _ in blocks] == [0, 1]
+
+
+def test_start_again():
+    hardware = _Hardware()
+    supervisor, blocks, events, stopped = _run(hardware, 0.2)
+    assert stopped and not events and blocks
+    # a new acquisition: the time axis starts from zero again
+    blocks.clear()
+    supervisor.start()
+    with pytest.raises(RuntimeError):
+        supervisor.start()
+    time.sleep(0.2)
+    assert supervisor.stop()
+    assert blocks[0] == (0, 0.0) and hardware.starts == 2